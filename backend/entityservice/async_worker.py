@@ -20,6 +20,8 @@ celery.conf.broker_transport_options = Config.CELERY_BROKER_TRANSPORT_OPTIONS
 celery.conf.result_backend_transport_options = Config.CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS
 celery.conf.worker_prefetch_multiplier = Config.CELERYD_PREFETCH_MULTIPLIER
 celery.conf.worker_max_tasks_per_child = Config.CELERYD_MAX_TASKS_PER_CHILD
+# Each worker also consumes from its own queue, used for locality aware routing of comparison tasks.
+celery.conf.worker_direct = Config.LOCALITY_AWARE_ROUTING
 
 if Config.CELERYD_CONCURRENCY > 0:
     # If set to 0, let celery choose the default, which is the number of available CPUs on the machine.
@@ -19,7 +19,9 @@ logger = structlog.get_logger()
 class RunState(Enum):
     """
     A run state is stored in the cache to provide a fast method of
-    differentiating between an active, completed, or deleted run.
+    differentiating between an active, completed, deleted or failed run.
+    Tasks working on a run check it to stop early once the run is no
+    longer active.
 
     An unlikely option of ``MISSING`` will occur if there is
     no corresponding entry in redis for a ``run_id``. Note redis
@@ -29,6 +31,7 @@ class RunState(Enum):
     ACTIVE = b'active'
     COMPLETE = b'complete'
     DELETED = b'deleted'
+    ERROR = b'error'
 
 
 def _set_run_state(run_id, state):
@@ -61,6 +64,10 @@ def set_run_state_complete(run_id):
     return _set_run_state(run_id, state=RunState.COMPLETE)
 
 
+def set_run_state_error(run_id):
+    return _set_run_state(run_id, state=RunState.ERROR)
+
+
 def is_run_active(run_id):
     return RunState.ACTIVE == _get_run_state(run_id)
 
@@ -0,0 +1,189 @@
+"""
+Node local cache of decoded chunks of encodings.
+
+When a large block is split into chunks, every chunk of one data provider is compared
+with every chunk of the other, so the same chunk is fetched from the database by many
+comparison tasks. This cache stores the chunks as files in a directory shared by all the
+worker processes of a host (by default in ``/dev/shm``), so only the first task on each
+host has to query the database and unpack the encodings.
+
+Each file holds the entity ids of a chunk as native uint32 followed by the concatenated
+encodings, which are read back as the arrays of an ``EncodingBlock`` without copying them.
+Files are grouped per project so they can be removed when the project is deleted. As database ids are never reused, entries left on other hosts can't be served
+for a different chunk; they are evicted in least recently used order once the cache
+exceeds its byte budget.
+
+The total size of the entries is kept in a file of the cache directory, updated under a lock by
+every process writing to the cache, so the entries are only listed when the cache is over budget.
+The total may overcount (e.g. after a project is cleared), in which case the scan corrects it.
+"""
+import fcntl
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import structlog
+
+from entityservice.encoding_block import EncodingBlock
+from entityservice.settings import Config
+
+logger = structlog.get_logger()
+
+_ENTITY_ID_SIZE = np.dtype(np.uint32).itemsize
+_TOTAL_BYTES_FILENAME = 'total-bytes'
+
+
+class LocalBlockCache:
+    """
+    Node local cache of chunks of encodings of a project.
+
+    Keeps count of the cache hits and misses of this instance.
+
+    :param project_id: The project the cached chunks belong to.
+    :param directory: Directory holding the cache. Defaults to ``Config.BLOCK_CACHE_DIR``.
+    :param max_bytes: Byte budget of the whole cache (for all projects). Defaults to
+        ``Config.BLOCK_CACHE_MAX_BYTES``, 0 disables the cache.
+    """
+
+    def __init__(self, project_id, directory=None, max_bytes=None):
+        self.project_id = project_id
+        self.directory = Config.BLOCK_CACHE_DIR if directory is None else directory
+        self.max_bytes = Config.BLOCK_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.max_bytes > 0
+
+    def _project_directory(self):
+        return os.path.join(self.directory, str(self.project_id))
+
+    def _path(self, chunk_info):
+        start, stop = chunk_info['range']
+        name = f"{chunk_info['dataproviderId']}-{chunk_info['block_id']}-{start}-{stop}"
+        if chunk_info.get('popcounts'):
+            name += '-p{}-{}'.format(*chunk_info['popcounts'])
+        return os.path.join(self._project_directory(), name + '.bin')
+
+    def get(self, chunk_info, encoding_size):
+        """
+        Return the cached chunk as an :class:`EncodingBlock`, or None if it isn't cached.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(chunk_info)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+
+        record_size = encoding_size + _ENTITY_ID_SIZE
+        if len(data) % record_size:
+            logger.warning("Ignoring corrupted block cache entry", path=path)
+            self.misses += 1
+            return None
+        count = len(data) // record_size
+        entity_ids = np.frombuffer(data, dtype=np.uint32, count=count)
+        encodings = np.frombuffer(data, dtype=np.uint8, offset=count * _ENTITY_ID_SIZE).reshape(count, encoding_size)
+        self.hits += 1
+        return EncodingBlock(entity_ids, encodings)
+
+    def put(self, chunk_info, block):
+        """
+        Store a chunk, given as an :class:`EncodingBlock`.
+
+        Failing to write to the cache isn't an error, the chunk simply won't be cached.
+        """
+        if not self.enabled or len(block) == 0:
+            return
+        if block.nbytes > self.max_bytes:
+            return
+        path = self._path(chunk_info)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first, so other processes never see a partial entry.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(block.entity_ids.tobytes())
+                f.write(np.ascontiguousarray(block.encodings).data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Couldn't write to the block cache", error=str(e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        try:
+            self._add_to_total_bytes(block.nbytes)
+        except OSError as e:
+            logger.warning("Couldn't update the size of the block cache", error=str(e))
+
+    def _add_to_total_bytes(self, num_bytes):
+        """
+        Add the size of a new entry to the total size of the cache, evicting entries if the
+        total exceeds the byte budget or is unknown.
+        """
+        fd = os.open(os.path.join(self.directory, _TOTAL_BYTES_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            # the lock is released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                total_bytes = int(f.read()) + num_bytes
+            except ValueError:
+                # the scan counts the new entry
+                total_bytes = None
+            if total_bytes is None or total_bytes > self.max_bytes:
+                total_bytes = self._evict()
+            f.seek(0)
+            f.truncate()
+            f.write(str(total_bytes))
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache fits into its byte budget.
+
+        :return: the total size of the remaining entries.
+        """
+        entries = []
+        total_bytes = 0
+        for project_entry in _scandir(self.directory):
+            if not project_entry.is_dir():
+                continue
+            for entry in _scandir(project_entry.path):
+                if entry.name.endswith('.bin'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return total_bytes
+        for _, size, path in sorted(entries):
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+        return total_bytes
+
+    def clear(self):
+        """Remove all the cached chunks of the project from this host."""
+        if self.directory:
+            shutil.rmtree(self._project_directory(), ignore_errors=True)
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except OSError:
+        return []
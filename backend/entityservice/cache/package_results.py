@@ -0,0 +1,56 @@
+"""
+Track which copy of a comparison task first computed a work package.
+
+When speculative execution is enabled, a work package can be computed by its original task
+and by a speculative copy. The first copy to claim the package wins, the other one discards
+its own results. The records are kept until they expire, as a speculative copy may only
+start after the run has completed.
+"""
+import json
+
+from entityservice.cache.connection import connect_to_redis
+from entityservice.settings import Config as globalconfig
+
+
+def _get_run_packages_key(run_id):
+    return f'run-packages:{run_id}'
+
+
+def claim_package_progress(run_id, package_id, config=None):
+    """
+    Return True for the first caller only, who is then responsible for recording the
+    progress of the package.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_run_packages_key(run_id)
+    claimed = r.hsetnx(key, f'progress:{package_id}', 1)
+    r.expire(key, config.CACHE_EXPIRY)
+    return bool(claimed)
+
+
+def claim_package_result(run_id, package_id, result, config=None):
+    """
+    Record the result of a package, unless a result has already been recorded.
+
+    :param result: The result of the comparison task, a list of JSON serializable values.
+    :return: The result of the package, which is the given result for the first caller.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_run_packages_key(run_id)
+    field = f'result:{package_id}'
+    r.hsetnx(key, field, json.dumps(list(result)))
+    r.expire(key, config.CACHE_EXPIRY)
+    return tuple(json.loads(r.hget(key, field)))
+
+
+def get_package_result(run_id, package_id):
+    """Return the recorded result of a package, or None if it hasn't been computed yet."""
+    r = connect_to_redis(read_only=True)
+    res = r.hget(_get_run_packages_key(run_id), f'result:{package_id}')
+    if res is None:
+        return None
+    return tuple(json.loads(res))
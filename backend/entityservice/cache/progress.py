@@ -28,6 +28,32 @@ def get_total_number_of_comparisons(project_id):
         return total_comparisons
 
 
+def save_total_number_of_comparisons_for_run(run_id, total_comparisons, config=None):
+    """
+    Record the number of comparisons scheduled for a run. This can be less than the total number of
+    comparisons of the project, as comparisons ruled out by the run's threshold are skipped.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_run_hash_key(run_id)
+    r.hset(key, 'total_comparisons', total_comparisons)
+    r.expire(key, config.CACHE_EXPIRY)
+
+
+def get_total_number_of_comparisons_for_run(project_id, run_id):
+    r = connect_to_redis(read_only=True)
+    res = r.hget(_get_run_hash_key(run_id), 'total_comparisons')
+    if res:
+        return _convert_redis_result_to_int(res)
+    else:
+        with db.DBConn() as conn:
+            threshold = db.get_run(conn, run_id)['threshold']
+            total_comparisons = db.get_total_comparisons_for_project(conn, project_id, threshold=threshold)
+        save_total_number_of_comparisons_for_run(run_id, total_comparisons)
+        return total_comparisons
+
+
 @retry(wait=wait_random_exponential(multiplier=1, max=60),
        retry=(retry_if_exception_type(MasterNotFoundError) | retry_if_exception_type(ConnectionError) | retry_if_exception_type(TimeoutError)),
        stop=stop_after_delay(120))
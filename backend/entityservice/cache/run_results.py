@@ -0,0 +1,265 @@
+"""
+Result files of the comparison tasks of a run, waiting to be aggregated.
+
+Comparison tasks add their result file when they finish. Whenever enough files are waiting,
+a merge task takes them, merges them into a single file and adds that back. By the end of the
+run only a handful of files are left for the final aggregation.
+
+A waiting file is a 4-tuple (number of candidate pairs, file size, file name, sources), where
+sources lists the names of the comparison result files merged into it. The aggregation uses
+them to find comparison results that never made it into the record.
+
+A merge holds its files for ``Config.AGGREGATION_MERGE_LEASE_SECONDS``, after which they are put
+back to the waiting files, in case the worker merging them died. The final aggregation takes all the
+waiting files, which stay recorded until ``finish_aggregation`` so that a retried aggregation finds
+them again.
+
+When the completion of the comparison tasks of a run is tracked in redis instead of with a chord,
+the number of packages still to compute is also kept here, see ``mark_package_done``.
+"""
+import json
+import time
+
+from entityservice.cache.connection import connect_to_redis
+from entityservice.settings import Config as globalconfig
+
+
+def _get_waiting_files_key(run_id):
+    return f'run-result-files:{run_id}'
+
+
+def _get_recorded_files_key(run_id):
+    return f'run-result-files-recorded:{run_id}'
+
+
+def _get_merges_key(run_id):
+    return f'run-result-merges:{run_id}'
+
+
+def _get_aggregated_files_key(run_id):
+    return f'run-result-files-aggregated:{run_id}'
+
+
+def _get_outstanding_packages_key(run_id):
+    return f'run-outstanding-packages:{run_id}'
+
+
+def _get_done_packages_key(run_id):
+    return f'run-done-packages:{run_id}'
+
+
+def _load(value):
+    num, filesize, filename, sources = json.loads(value)
+    return num, filesize, filename, sources
+
+
+def add_result_file(run_id, num, filesize, filename, sources=None, config=None):
+    """
+    Record a result file waiting to be aggregated. A file is only recorded once, e.g. the result
+    of a package recorded by both copies of a speculatively executed comparison task.
+
+    :param sources: names of the comparison result files merged into this file. Defaults to the file itself.
+    :return: The number of files waiting.
+    """
+    if config is None:
+        config = globalconfig
+    if sources is None:
+        sources = [filename]
+    r = connect_to_redis()
+    key = _get_waiting_files_key(run_id)
+    recorded_key = _get_recorded_files_key(run_id)
+
+    def record_file(pipe):
+        if pipe.sismember(recorded_key, filename):
+            return
+        pipe.multi()
+        pipe.sadd(recorded_key, filename)
+        pipe.expire(recorded_key, config.CACHE_EXPIRY)
+        pipe.rpush(key, json.dumps([num, filesize, filename, sources]))
+        pipe.expire(key, config.CACHE_EXPIRY)
+
+    res = r.transaction(record_file, recorded_key)
+    if not res:
+        return r.llen(key)
+    _, _, num_waiting, _ = res
+    return num_waiting
+
+
+def _restore_expired_merges(r, run_id, config):
+    """Put the files of the merges of a run holding them for longer than their lease back to the waiting files."""
+    key = _get_waiting_files_key(run_id)
+    merges_key = _get_merges_key(run_id)
+
+    def restore_files(pipe):
+        now = time.time()
+        expired = {}
+        for merge_id, value in pipe.hgetall(merges_key).items():
+            started, merge_files = json.loads(value)
+            if now - started > config.AGGREGATION_MERGE_LEASE_SECONDS:
+                expired[merge_id] = merge_files
+        if not expired:
+            return
+        pipe.multi()
+        for merge_id, merge_files in expired.items():
+            for result_file in merge_files:
+                pipe.rpush(key, json.dumps(result_file))
+            pipe.hdel(merges_key, merge_id)
+        pipe.expire(key, config.CACHE_EXPIRY)
+
+    r.transaction(restore_files, merges_key)
+
+
+def start_merge(run_id, merge_id, num_files, config=None):
+    """
+    Take ``num_files`` waiting files to merge them, if that many are waiting.
+
+    Until the merge is finished, aborted or its lease expires, the files are recorded as being
+    merged under ``merge_id``.
+
+    :return: The list of files to merge, or None if not enough files are waiting.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_waiting_files_key(run_id)
+    merges_key = _get_merges_key(run_id)
+    _restore_expired_merges(r, run_id, config)
+
+    def take_files(pipe):
+        values = pipe.lrange(key, 0, num_files - 1)
+        if len(values) < num_files:
+            return None
+        pipe.multi()
+        pipe.ltrim(key, num_files, -1)
+        pipe.hset(merges_key, merge_id, json.dumps([time.time(), [json.loads(value) for value in values]]))
+        pipe.expire(merges_key, config.CACHE_EXPIRY)
+        return [_load(value) for value in values]
+
+    return r.transaction(take_files, key, value_from_callable=True)
+
+
+def finish_merge(run_id, merge_id, num, filesize, filename, sources, config=None):
+    """
+    Replace the files of a merge by the merged file, unless the lease of the merge has expired.
+
+    :return: The number of files waiting, or None if the files of the merge have been put back
+        to the waiting files.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_waiting_files_key(run_id)
+    merges_key = _get_merges_key(run_id)
+
+    def replace_files(pipe):
+        if not pipe.hexists(merges_key, merge_id):
+            return
+        pipe.multi()
+        pipe.hdel(merges_key, merge_id)
+        pipe.rpush(key, json.dumps([num, filesize, filename, sources]))
+        pipe.expire(key, config.CACHE_EXPIRY)
+
+    res = r.transaction(replace_files, merges_key)
+    if not res:
+        return None
+    _, num_waiting, _ = res
+    return num_waiting
+
+
+def abort_merge(run_id, merge_id, config=None):
+    """Put the files of a failed merge back to the waiting files."""
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_waiting_files_key(run_id)
+    merges_key = _get_merges_key(run_id)
+
+    def restore_files(pipe):
+        value = pipe.hget(merges_key, merge_id)
+        pipe.multi()
+        if value is not None:
+            _, merge_files = json.loads(value)
+            for result_file in merge_files:
+                pipe.rpush(key, json.dumps(result_file))
+            pipe.expire(key, config.CACHE_EXPIRY)
+        pipe.hdel(merges_key, merge_id)
+
+    r.transaction(restore_files, merges_key)
+
+
+def take_all_result_files(run_id, config=None):
+    """
+    Take all the waiting files of a run for the final aggregation, unless some files are still
+    being merged.
+
+    The files are returned again by later calls, e.g. from a retried aggregation, until
+    ``finish_aggregation`` is called.
+
+    :return: The list of files to aggregate, or None if merges are in progress.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_waiting_files_key(run_id)
+    merges_key = _get_merges_key(run_id)
+    aggregated_key = _get_aggregated_files_key(run_id)
+    _restore_expired_merges(r, run_id, config)
+
+    def take_files(pipe):
+        if pipe.hlen(merges_key) > 0:
+            return None
+        aggregated = pipe.lrange(aggregated_key, 0, -1)
+        values = pipe.lrange(key, 0, -1)
+        pipe.multi()
+        if values:
+            pipe.rpush(aggregated_key, *values)
+            pipe.expire(aggregated_key, config.CACHE_EXPIRY)
+        pipe.delete(key)
+        return [_load(value) for value in aggregated + values]
+
+    return r.transaction(take_files, key, merges_key, aggregated_key, value_from_callable=True)
+
+
+def finish_aggregation(run_id):
+    """Forget the files taken by the final aggregation, once it has saved its output."""
+    r = connect_to_redis()
+    r.delete(_get_aggregated_files_key(run_id))
+
+
+def set_outstanding_packages(run_id, num_packages, config=None):
+    """Record the number of packages of a run to compute, before scheduling them."""
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    p = r.pipeline()
+    p.multi()
+    p.set(_get_outstanding_packages_key(run_id), num_packages, ex=config.CACHE_EXPIRY)
+    p.delete(_get_done_packages_key(run_id))
+    p.execute()
+
+
+def mark_package_done(run_id, package_id, config=None):
+    """
+    Record that a package of a run has been computed. Packages computed again, e.g. by a
+    redelivered task, are only counted once.
+
+    :return: The number of packages left to compute, or None if the package was already done.
+    """
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_outstanding_packages_key(run_id)
+    done_key = _get_done_packages_key(run_id)
+
+    def mark_done(pipe):
+        if pipe.sismember(done_key, package_id):
+            return
+        pipe.multi()
+        pipe.sadd(done_key, package_id)
+        pipe.expire(done_key, config.CACHE_EXPIRY)
+        pipe.decr(key)
+
+    res = r.transaction(mark_done, done_key)
+    if not res:
+        return None
+    return res[-1]
@@ -0,0 +1,36 @@
+"""
+Ids of the comparison tasks scheduled for a run, so they can be revoked in bulk when the run
+is cancelled, i.e. deleted or failed.
+"""
+from entityservice.cache.connection import connect_to_redis
+from entityservice.settings import Config as globalconfig
+
+
+def _get_run_tasks_key(run_id):
+    return f'run-tasks:{run_id}'
+
+
+def add_run_task_ids(run_id, task_ids, config=None):
+    """Record the ids of tasks scheduled for a run."""
+    if config is None:
+        config = globalconfig
+    if not task_ids:
+        return
+    r = connect_to_redis()
+    key = _get_run_tasks_key(run_id)
+    p = r.pipeline()
+    p.sadd(key, *task_ids)
+    p.expire(key, config.CACHE_EXPIRY)
+    p.execute()
+
+
+def take_run_task_ids(run_id):
+    """Remove and return the ids of the tasks scheduled for a run."""
+    r = connect_to_redis()
+    key = _get_run_tasks_key(run_id)
+    p = r.pipeline()
+    p.multi()
+    p.smembers(key)
+    p.delete(key)
+    task_ids, _ = p.execute()
+    return [task_id.decode() for task_id in task_ids]
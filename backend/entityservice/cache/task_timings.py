@@ -0,0 +1,87 @@
+import structlog
+from redis.sentinel import MasterNotFoundError
+from tenacity import retry, wait_random_exponential, retry_if_exception_type, stop_after_delay
+
+from entityservice.cache.connection import connect_to_redis
+from entityservice.cost_model import CostModel, LinearFit
+
+logger = structlog.get_logger()
+
+# Fits of the timings of the comparison tasks, shared by the whole deployment.
+FETCH_KEY = 'task-timings:fetch'
+COMPARE_KEY = 'task-timings:compare'
+OVERHEAD_KEY = 'task-timings:overhead'
+
+# Minimum number of tasks reported before the cost model is used.
+MIN_SAMPLES = 20
+# Once the number of tasks reported exceeds this, older timings get half the weight,
+# so the model follows changes of the deployment.
+MAX_SAMPLES = 2000
+
+
+@retry(wait=wait_random_exponential(multiplier=1, max=60),
+       retry=(retry_if_exception_type(MasterNotFoundError) | retry_if_exception_type(ConnectionError) | retry_if_exception_type(TimeoutError)),
+       stop=stop_after_delay(120))
+def save_task_timings(fetch_seconds, num_encodings, chunk_timings, overhead_seconds):
+    """
+    Record the timings of a comparison task.
+
+    This is safe to call from concurrent processes.
+
+    :param fetch_seconds: Time spent fetching and decoding encodings.
+    :param num_encodings: Number of encodings fetched.
+    :param chunk_timings: list of (number of comparisons, seconds) for each chunk compared.
+    :param overhead_seconds: The remaining time spent by the task.
+    """
+    r = connect_to_redis()
+    p = r.pipeline()
+    p.multi()
+    for field, increment in LinearFit.increments(num_encodings, fetch_seconds).items():
+        p.hincrbyfloat(FETCH_KEY, field, increment)
+    for num_comparisons, seconds in chunk_timings:
+        for field, increment in LinearFit.increments(num_comparisons, seconds).items():
+            p.hincrbyfloat(COMPARE_KEY, field, increment)
+    p.hincrbyfloat(OVERHEAD_KEY, 'n', 1)
+    p.hincrbyfloat(OVERHEAD_KEY, 'sy', overhead_seconds)
+    p.execute()
+
+
+def _load_fit(r, key):
+    values = r.hgetall(key)
+    return LinearFit(**{field: float(values.get(field.encode(), 0)) for field in LinearFit.FIELDS})
+
+
+def _decay(pipe, key, fit):
+    pipe.hset(key, mapping={field: getattr(fit, field) / 2 for field in LinearFit.FIELDS})
+
+
+def get_cost_model():
+    """
+    Return the :class:`entityservice.cost_model.CostModel` fitted on the reported task timings,
+    or None if there are not enough timings yet.
+
+    The fits are read and decayed in a transaction watching them, which is retried if timings are
+    reported or the fits decayed by another process in the meantime.
+    """
+    r = connect_to_redis()
+
+    def load_fits(pipe):
+        fetch, compare, overhead = (_load_fit(pipe, key) for key in (FETCH_KEY, COMPARE_KEY, OVERHEAD_KEY))
+        if overhead.n > MAX_SAMPLES:
+            pipe.multi()
+            for key, fit in ((FETCH_KEY, fetch), (COMPARE_KEY, compare), (OVERHEAD_KEY, overhead)):
+                _decay(pipe, key, fit)
+        return fetch, compare, overhead
+
+    fetch, compare, overhead = r.transaction(load_fits, FETCH_KEY, COMPARE_KEY, OVERHEAD_KEY,
+                                             value_from_callable=True)
+    if overhead.n < MIN_SAMPLES or compare.n < MIN_SAMPLES:
+        return None
+
+    fetch_latency, fetch_per_encoding = fetch.solve()
+    chunk_overhead, compare_per_comparison = compare.solve()
+    return CostModel(task_overhead=overhead.sy / overhead.n,
+                     fetch_latency=fetch_latency,
+                     fetch_per_encoding=fetch_per_encoding,
+                     chunk_overhead=chunk_overhead,
+                     compare_per_comparison=compare_per_comparison)
@@ -0,0 +1,33 @@
+"""
+Work packages of comparison tasks too large to be sent in the task messages.
+
+They are kept in a hash per run until the run's comparisons are aggregated, or until they expire.
+"""
+from entityservice.cache.connection import connect_to_redis
+from entityservice.settings import Config as globalconfig
+
+
+def _get_work_packages_key(run_id):
+    return f'run-work-packages:{run_id}'
+
+
+def save_work_package(run_id, package_id, encoded_package, config=None):
+    if config is None:
+        config = globalconfig
+    r = connect_to_redis()
+    key = _get_work_packages_key(run_id)
+    p = r.pipeline()
+    p.hset(key, package_id, encoded_package)
+    p.expire(key, config.CACHE_EXPIRY)
+    p.execute()
+
+
+def load_work_package(run_id, package_id):
+    """Return the encoded work package, or None if it has been removed."""
+    r = connect_to_redis(read_only=True)
+    return r.hget(_get_work_packages_key(run_id), package_id)
+
+
+def remove_work_packages(run_id):
+    r = connect_to_redis()
+    r.delete(_get_work_packages_key(run_id))
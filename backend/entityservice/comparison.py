@@ -0,0 +1,402 @@
+"""
+Comparison of encodings using the Dice coefficient.
+
+Two implementations are available:
+
+- anonlink's ``dice_coefficient_accelerated`` which works on Python ``bytes``.
+- :func:`dice_coefficient_numpy`, a vectorized implementation working on packed
+  ``uint64`` matrices. It precomputes the popcount of every encoding and never
+  looks at the bits of a pair whose Dice upper bound ``2*min(pa, pb)/(pa + pb)``
+  is below the threshold.
+
+:func:`compare_encodings` is used by the comparison tasks, it picks an implementation
+for each chunk according to ``Config.COMPARISON_KERNEL``. Large chunks can be split into
+tiles of rows compared concurrently on a thread pool of the process, as both
+implementations spend most of their time without holding the GIL.
+"""
+import array
+import math
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import anonlink
+import numpy as np
+from structlog import get_logger
+
+from entityservice.encoding_block import EncodingBlock
+from entityservice.settings import Config
+
+logger = get_logger()
+
+KERNELS = {'auto', 'anonlink', 'numpy'}
+
+# Number of bytes of unpacked bits in a tile of records.
+TILE_BYTES = 4 * 1024 * 1024
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Per process estimates of the number of pairs each kernel evaluates per second.
+# Seeded with conservative values and refined with every chunk compared.
+_kernel_rates = {
+    'anonlink': 50_000_000.0,
+    'numpy': 8_000_000.0,
+}
+_RATE_SMOOTHING = 0.2
+
+# Chunks are only split into row tiles of at least that many records.
+MIN_ROWS_PER_THREAD_TILE = 256
+# Number of row tiles per thread, more tiles even out the work left after popcount pruning.
+THREAD_TILES_PER_THREAD = 4
+
+_thread_pool = None
+_thread_pool_size = 0
+_thread_pool_lock = threading.Lock()
+
+
+def pack_encodings(encodings):
+    """
+    Pack a sequence of equally sized encodings into a contiguous ``(n, words)`` uint64 matrix.
+
+    Encodings whose size isn't a multiple of 8 bytes are zero padded, which
+    doesn't change their popcount.
+
+    :param encodings: A sequence of bytes-like encodings, an :class:`EncodingBlock`, a 2D uint8 array
+        of encodings, or an already packed matrix. Contiguous arrays of encodings whose size is a multiple
+        of 8 bytes are viewed without copying.
+    :return: A 2D numpy array of dtype uint64.
+    """
+    if isinstance(encodings, EncodingBlock):
+        encodings = encodings.encodings
+    if isinstance(encodings, np.ndarray) and encodings.dtype == np.uint64 and encodings.ndim == 2:
+        return encodings
+    n = len(encodings)
+    if n == 0:
+        return np.empty((0, 1), dtype=np.uint64)
+    if isinstance(encodings, np.ndarray) and encodings.dtype == np.uint8 and encodings.ndim == 2:
+        raw = encodings
+        encoding_size = raw.shape[1]
+    else:
+        raw = np.frombuffer(b''.join(encodings), dtype=np.uint8)
+        if len(raw) % n:
+            raise ValueError('inconsistent encoding length')
+        encoding_size = len(raw) // n
+        raw = raw.reshape(n, encoding_size)
+    padding = -encoding_size % 8
+    if padding:
+        raw = np.hstack([raw, np.zeros((n, padding), dtype=np.uint8)])
+    return np.ascontiguousarray(raw).view(np.uint64)
+
+
+def popcounts(packed):
+    """Return the number of set bits of each row of a packed encoding matrix."""
+    return _POPCOUNT_TABLE[packed.view(np.uint8)].sum(axis=1, dtype=np.uint32)
+
+
+def binary_popcounts(binary_encodings, encoding_size):
+    """
+    Return the popcount of each encoding in the internal binary format.
+
+    See :func:`entityservice.serialization.binary_format`, the 4 byte entity id
+    preceding each encoding isn't counted.
+
+    :param binary_encodings: list of the encodings, or array of them as packed by
+        :func:`entityservice.serialization.binary_pack_encodings`.
+    """
+    if len(binary_encodings) == 0:
+        return np.empty(0, dtype=np.uint32)
+    if not isinstance(binary_encodings, np.ndarray):
+        binary_encodings = b''.join(binary_encodings)
+    raw = np.frombuffer(binary_encodings, dtype=np.uint8).reshape(-1, encoding_size + 4)
+    return _POPCOUNT_TABLE[raw[:, 4:]].sum(axis=1, dtype=np.uint32)
+
+
+def _unpack_bits(packed):
+    """
+    Unpack encodings into a float32 matrix of zeros and ones.
+
+    The popcount of the intersection of two encodings is then the dot product of
+    their rows, which lets BLAS do the heavy lifting. Counts are exact as long as
+    encodings have less than 2**24 bits.
+    """
+    return np.unpackbits(packed.view(np.uint8), axis=1).astype(np.float32)
+
+
+def _popcount_window(sorted_popcounts, popcount_min, popcount_max, threshold):
+    """
+    Return the half open index range ``[lo, hi)`` of ``sorted_popcounts`` that could reach
+    the threshold with an encoding whose popcount lies between ``popcount_min`` and ``popcount_max``.
+
+    The bound follows from ``dice(a, b) <= 2 * min(pa, pb) / (pa + pb)``.
+    """
+    if threshold <= 0:
+        return np.zeros_like(popcount_min, dtype=np.intp), np.full_like(popcount_max, len(sorted_popcounts), dtype=np.intp)
+    # A small tolerance keeps the window inclusive of pairs exactly on the threshold,
+    # the exact comparison happens after computing the similarity.
+    lower = np.asarray(popcount_min, dtype=np.float64) * threshold / (2 - threshold) - 1e-9
+    upper = np.asarray(popcount_max, dtype=np.float64) * (2 - threshold) / threshold + 1e-9
+    lo = np.searchsorted(sorted_popcounts, lower, side='left')
+    hi = np.searchsorted(sorted_popcounts, upper, side='right')
+    return lo, hi
+
+
+def count_candidate_comparisons(popcounts0, popcounts1, threshold):
+    """
+    Count the pairs of records whose popcounts permit a similarity of at least ``threshold``.
+
+    This is the number of comparisons :func:`dice_coefficient_numpy` has to evaluate
+    (up to the tiling granularity).
+    """
+    sorted_popcounts1 = np.sort(popcounts1)
+    lo, hi = _popcount_window(sorted_popcounts1, popcounts0, popcounts0, threshold)
+    return int(np.sum(hi - lo))
+
+
+def _top_k_per_row(sims, rec_is0, rec_is1, k):
+    """Keep the k most similar candidates for every record of the first dataset."""
+    order = np.lexsort((rec_is1, -sims, rec_is0))
+    sorted_rows = rec_is0[order]
+    row_starts = np.searchsorted(sorted_rows, sorted_rows, side='left')
+    keep = order[np.arange(len(order)) - row_starts < k]
+    return sims[keep], rec_is0[keep], rec_is1[keep]
+
+
+def dice_coefficient_numpy(datasets, threshold, k=None, tile_bytes=TILE_BYTES):
+    """
+    Find the Dice coefficients of all pairs of encodings above a threshold.
+
+    A drop in replacement for ``anonlink.similarities.dice_coefficient_accelerated``.
+    The records of both datasets are sorted by popcount and the first dataset is
+    processed in tiles of rows. Each tile is only compared against the window of the
+    second dataset that can reach the threshold.
+
+    :param datasets: A length 2 sequence of datasets. A dataset is either a sequence of
+        bytes-like encodings or a packed uint64 matrix as returned by :func:`pack_encodings`.
+    :param threshold: Only pairs with a similarity of at least this value are returned.
+    :param k: Only return the top k candidates for every record of the first dataset.
+        ``None`` returns all candidates.
+    :param tile_bytes: Size of the unpacked bits of a tile of records. Determines the
+        granularity of the popcount filter and the intermediate memory.
+    :return: A 3-tuple of:
+        - similarity scores, sorted in decreasing order,
+        - a 2-tuple of record index arrays,
+        - the number of pairs that were actually compared.
+    """
+    if len(datasets) != 2:
+        raise NotImplementedError(f'expected 2 datasets, got {len(datasets)}')
+    packed0, packed1 = map(pack_encodings, datasets)
+    n0, n1 = len(packed0), len(packed1)
+    if n0 == 0 or n1 == 0:
+        return array.array('d'), (array.array('I'), array.array('I')), 0
+    if packed0.shape[1] != packed1.shape[1]:
+        raise ValueError('inconsistent encoding length')
+    num_bits = packed0.shape[1] * 64
+
+    popcounts0 = popcounts(packed0)
+    popcounts1 = popcounts(packed1)
+    order0 = np.argsort(popcounts0, kind='stable')
+    order1 = np.argsort(popcounts1, kind='stable')
+    sorted_popcounts0 = popcounts0[order0]
+    sorted_popcounts1 = popcounts1[order1]
+    sorted1 = packed1[order1]
+
+    tile_size = max(1, tile_bytes // (num_bits * 4))
+
+    found_sims, found_is0, found_is1 = [], [], []
+    num_compared = 0
+    for row_start in range(0, n0, tile_size):
+        row_stop = min(row_start + tile_size, n0)
+        lo, hi = _popcount_window(sorted_popcounts1,
+                                  sorted_popcounts0[row_start], sorted_popcounts0[row_stop - 1],
+                                  threshold)
+        lo, hi = int(lo), int(hi)
+        if lo >= hi:
+            continue
+        rows = order0[row_start:row_stop]
+        tile0 = _unpack_bits(packed0[rows])
+        tile_popcounts0 = sorted_popcounts0[row_start:row_stop].astype(np.float64)
+        num_compared += (row_stop - row_start) * (hi - lo)
+        for col_start in range(lo, hi, tile_size):
+            col_stop = min(col_start + tile_size, hi)
+            intersections = tile0 @ _unpack_bits(sorted1[col_start:col_stop]).T
+            denominators = tile_popcounts0[:, None] + sorted_popcounts1[None, col_start:col_stop]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sims = np.where(denominators > 0, 2.0 * intersections.astype(np.float64) / denominators, 0.0)
+            tile_is0, tile_is1 = np.nonzero(sims >= threshold)
+            if len(tile_is0):
+                found_sims.append(sims[tile_is0, tile_is1])
+                found_is0.append(rows[tile_is0])
+                found_is1.append(order1[col_start + tile_is1])
+
+    if not found_sims:
+        return array.array('d'), (array.array('I'), array.array('I')), num_compared
+
+    sims = np.concatenate(found_sims)
+    rec_is0 = np.concatenate(found_is0).astype(np.uint32)
+    rec_is1 = np.concatenate(found_is1).astype(np.uint32)
+    if k is not None and k < n1:
+        sims, rec_is0, rec_is1 = _top_k_per_row(sims, rec_is0, rec_is1, k)
+
+    # Same order as anonlink: decreasing similarity, then increasing record indices.
+    order = np.lexsort((rec_is1, rec_is0, -sims))
+    return (array.array('d', sims[order].tobytes()),
+            (array.array('I', rec_is0[order].tobytes()), array.array('I', rec_is1[order].tobytes())),
+            num_compared)
+
+
+def _update_rate(kernel, num_pairs, elapsed):
+    if num_pairs > 0 and elapsed > 0:
+        measured = num_pairs / elapsed
+        _kernel_rates[kernel] = (1 - _RATE_SMOOTHING) * _kernel_rates[kernel] + _RATE_SMOOTHING * measured
+
+
+def _choose_kernel(num_comparisons, num_candidate_comparisons):
+    """Pick the kernel expected to finish first, given the measured rates of this process."""
+    anonlink_estimate = num_comparisons / _kernel_rates['anonlink']
+    numpy_estimate = num_candidate_comparisons / _kernel_rates['numpy']
+    return 'numpy' if numpy_estimate < anonlink_estimate else 'anonlink'
+
+
+def _get_thread_pool(num_threads):
+    """Return the thread pool of this process, created on first use (i.e. after celery forked the worker)."""
+    global _thread_pool, _thread_pool_size
+    with _thread_pool_lock:
+        if _thread_pool is None or _thread_pool_size != num_threads:
+            if _thread_pool is not None:
+                _thread_pool.shutdown(wait=False)
+            _thread_pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='comparison')
+            _thread_pool_size = num_threads
+        return _thread_pool
+
+
+def _row_tiles(num_rows, num_threads):
+    """Split ``range(num_rows)`` into consecutive tiles for ``num_threads`` threads."""
+    num_tiles = min(num_threads * THREAD_TILES_PER_THREAD, num_rows // MIN_ROWS_PER_THREAD_TILE)
+    if num_tiles <= 1:
+        return [(0, num_rows)]
+    tile_size = math.ceil(num_rows / num_tiles)
+    return [(start, min(start + tile_size, num_rows)) for start in range(0, num_rows, tile_size)]
+
+
+def _compare_with_kernel(encodings0, encodings1, threshold, k, kernel, log):
+    """
+    Compare two chunks with the given kernel, 'anonlink' or 'numpy'.
+
+    :return: A 4-tuple of similarity scores, the 2-tuple of record index arrays, the kernel that was
+        actually used and the number of pairs that were compared.
+    """
+    num_comparisons = len(encodings0) * len(encodings1)
+    if kernel == 'anonlink':
+        start = time.perf_counter()
+        try:
+            sims, (rec_is0, rec_is1) = anonlink.similarities.dice_coefficient_accelerated(
+                datasets=(encodings0, encodings1),
+                threshold=threshold,
+                k=k)
+        except NotImplementedError as e:
+            log.warning(f"Encodings couldn't be compared using anonlink, falling back to numpy. {e}")
+            kernel = 'numpy'
+        else:
+            _update_rate('anonlink', num_comparisons, time.perf_counter() - start)
+            return sims, (rec_is0, rec_is1), kernel, num_comparisons
+
+    start = time.perf_counter()
+    sims, (rec_is0, rec_is1), num_compared = dice_coefficient_numpy((encodings0, encodings1), threshold, k=k)
+    _update_rate('numpy', num_compared, time.perf_counter() - start)
+    return sims, (rec_is0, rec_is1), kernel, num_compared
+
+
+def _merge_tile_results(tile_results):
+    """
+    Merge the results of row tiles into one result, sorted like the results of a single chunk:
+    by decreasing similarity, then increasing record indices.
+
+    :param tile_results: list of (first row of the tile, sims, (rec_is0, rec_is1)), the record
+        indices of the first dataset being relative to the tile.
+    """
+    sims = np.concatenate([np.frombuffer(tile_sims, dtype=np.float64) for _, tile_sims, _ in tile_results])
+    rec_is0 = np.concatenate([np.frombuffer(tile_is0, dtype=np.uint32) + np.uint32(row_start)
+                              for row_start, _, (tile_is0, _) in tile_results])
+    rec_is1 = np.concatenate([np.frombuffer(tile_is1, dtype=np.uint32) for _, _, (_, tile_is1) in tile_results])
+    order = np.lexsort((rec_is1, rec_is0, -sims))
+    return (array.array('d', sims[order].tobytes()),
+            (array.array('I', rec_is0[order].tobytes()), array.array('I', rec_is1[order].tobytes())))
+
+
+def compare_encodings(encodings0, encodings1, threshold, k=None, kernel=None, log=None, num_threads=None):
+    """
+    Compute the similarity of two chunks of encodings with the configured kernel.
+
+    With ``kernel='auto'`` the popcounts of both chunks are computed up front, and
+    the kernel with the smaller estimated run time is used. The numpy kernel is also
+    used whenever anonlink can't compare the encodings.
+
+    With more than one thread, large chunks are split into tiles of rows of ``encodings0``
+    which are compared concurrently, and their results merged.
+
+    :param encodings0: :class:`EncodingBlock`, 2D uint8 array or sequence of bytes-like encodings.
+    :param encodings1: :class:`EncodingBlock`, 2D uint8 array or sequence of bytes-like encodings.
+    :param threshold: the similarity threshold.
+    :param k: the maximum number of candidates per record of ``encodings0``.
+    :param kernel: one of 'auto', 'anonlink' or 'numpy'. Defaults to ``Config.COMPARISON_KERNEL``.
+    :param num_threads: number of threads to compare with. Defaults to ``Config.COMPARISON_THREADS_PER_TASK``.
+    :return: A 3-tuple of:
+        - similarity scores, sorted in decreasing order,
+        - a 2-tuple of record index arrays,
+        - a dict of statistics about the comparison: the used ``kernel``,
+          the number of ``comparisons``, the number of ``pruned`` comparisons
+          and the number of row ``tiles`` compared concurrently.
+    """
+    if log is None:
+        log = logger
+    if kernel is None:
+        kernel = Config.COMPARISON_KERNEL
+    if kernel not in KERNELS:
+        raise ValueError(f"Unknown comparison kernel '{kernel}'")
+    if num_threads is None:
+        num_threads = Config.COMPARISON_THREADS_PER_TASK
+    # The kernels take the arrays of encodings, anonlink reads each row as a bytes-like record.
+    if isinstance(encodings0, EncodingBlock):
+        encodings0 = encodings0.encodings
+    if isinstance(encodings1, EncodingBlock):
+        encodings1 = encodings1.encodings
+    num_comparisons = len(encodings0) * len(encodings1)
+
+    if kernel == 'auto':
+        packed0, packed1 = pack_encodings(encodings0), pack_encodings(encodings1)
+        num_candidate_comparisons = count_candidate_comparisons(popcounts(packed0), popcounts(packed1), threshold)
+        kernel = _choose_kernel(num_comparisons, num_candidate_comparisons)
+        log.debug(f"Using {kernel} kernel. Popcount filter leaves {num_candidate_comparisons} "
+                  f"out of {num_comparisons} comparisons")
+        if kernel == 'numpy':
+            encodings0, encodings1 = packed0, packed1
+    elif kernel == 'numpy' and num_threads > 1:
+        # pack once for all the tiles
+        encodings0, encodings1 = pack_encodings(encodings0), pack_encodings(encodings1)
+
+    tiles = _row_tiles(len(encodings0), num_threads) if num_threads > 1 else [(0, len(encodings0))]
+    if len(tiles) == 1:
+        sims, (rec_is0, rec_is1), kernel, num_compared = _compare_with_kernel(
+            encodings0, encodings1, threshold, k, kernel, log)
+    else:
+        pool = _get_thread_pool(num_threads)
+        futures = [pool.submit(_compare_with_kernel, encodings0[row_start:row_stop], encodings1, threshold, k,
+                               kernel, log)
+                   for row_start, row_stop in tiles]
+        tile_results = []
+        num_compared = 0
+        used_kernels = set()
+        for (row_start, _), future in zip(tiles, futures):
+            tile_sims, tile_indices, tile_kernel, tile_compared = future.result()
+            tile_results.append((row_start, tile_sims, tile_indices))
+            used_kernels.add(tile_kernel)
+            num_compared += tile_compared
+        sims, (rec_is0, rec_is1) = _merge_tile_results(tile_results)
+        # a tile falling back to numpy means they all did
+        kernel = 'numpy' if 'numpy' in used_kernels else kernel
+
+    return sims, (rec_is0, rec_is1), {'kernel': kernel,
+                                      'comparisons': num_comparisons,
+                                      'pruned': num_comparisons - num_compared,
+                                      'tiles': len(tiles)}
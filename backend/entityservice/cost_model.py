@@ -0,0 +1,105 @@
+"""
+Cost model of the comparison tasks, used to size the work packages.
+
+The duration of a comparison task is modelled as::
+
+    task_overhead + fetch_latency + fetch_per_encoding * encodings
+                  + sum over chunks of (chunk_overhead + compare_per_comparison * comparisons)
+
+The parameters are fitted by least squares on timings reported by the comparison tasks,
+see :mod:`entityservice.cache.task_timings`.
+"""
+import math
+
+
+class LinearFit:
+    """
+    Running sums for a least squares fit of ``y = intercept + slope * x``.
+
+    :param n: number of samples.
+    :param sx: sum of x.
+    :param sy: sum of y.
+    :param sxx: sum of x squared.
+    :param sxy: sum of x * y.
+    """
+    FIELDS = ('n', 'sx', 'sy', 'sxx', 'sxy')
+
+    def __init__(self, n=0.0, sx=0.0, sy=0.0, sxx=0.0, sxy=0.0):
+        self.n = n
+        self.sx = sx
+        self.sy = sy
+        self.sxx = sxx
+        self.sxy = sxy
+
+    @staticmethod
+    def increments(x, y):
+        """The amounts to add to the sums for a new sample."""
+        return {'n': 1, 'sx': x, 'sy': y, 'sxx': x * x, 'sxy': x * y}
+
+    def add(self, x, y):
+        for field, increment in self.increments(x, y).items():
+            setattr(self, field, getattr(self, field) + increment)
+
+    def solve(self):
+        """
+        Return (intercept, slope). Both are kept non negative, if the samples don't allow
+        to separate them the intercept is 0.
+        """
+        if self.n == 0 or self.sx <= 0:
+            return 0.0, 0.0
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if denominator > 1e-9 * self.n * self.sxx:
+            slope = (self.n * self.sxy - self.sx * self.sy) / denominator
+            intercept = (self.sy - slope * self.sx) / self.n
+            if slope > 0 and intercept >= 0:
+                return intercept, slope
+        return 0.0, max(self.sy, 0.0) / self.sx
+
+
+class CostModel:
+    """
+    Estimates the duration of comparison tasks.
+
+    :param task_overhead: seconds spent per task, on top of fetching and comparing encodings.
+    :param fetch_latency: seconds spent per task fetching encodings, regardless of their number.
+    :param fetch_per_encoding: seconds spent fetching and decoding each encoding.
+    :param chunk_overhead: seconds spent per chunk, regardless of its number of comparisons.
+    :param compare_per_comparison: seconds spent per comparison.
+    """
+
+    def __init__(self, task_overhead, fetch_latency, fetch_per_encoding, chunk_overhead, compare_per_comparison):
+        self.task_overhead = task_overhead
+        self.fetch_latency = fetch_latency
+        self.fetch_per_encoding = fetch_per_encoding
+        self.chunk_overhead = chunk_overhead
+        self.compare_per_comparison = compare_per_comparison
+
+    def estimate_chunk(self, size1, size2):
+        """Estimated seconds to fetch and compare a chunk of size1 and size2 encodings."""
+        return (self.chunk_overhead
+                + self.fetch_per_encoding * (size1 + size2)
+                + self.compare_per_comparison * size1 * size2)
+
+    def estimate_package(self, package):
+        """Estimated seconds to compute a package of chunks, as created by the planner."""
+        seconds = self.task_overhead + self.fetch_latency
+        for chunk_left, chunk_right in package:
+            seconds += self.estimate_chunk(chunk_left['range'][1] - chunk_left['range'][0],
+                                           chunk_right['range'][1] - chunk_right['range'][0])
+        return seconds
+
+    def chunk_size_aim(self, task_duration):
+        """
+        Return the number of comparisons of a square chunk estimated to take ``task_duration`` seconds
+        in a task on its own, or None if the model can't tell.
+        """
+        if self.compare_per_comparison <= 0:
+            return None
+        budget = task_duration - self.task_overhead - self.fetch_latency - self.chunk_overhead
+        if budget <= 0:
+            return None
+        # A square chunk of n x n encodings takes compare * n**2 + fetch * 2n seconds
+        a = self.compare_per_comparison
+        b = 2 * self.fetch_per_encoding
+        n = (-b + math.sqrt(b * b + 4 * a * budget)) / (2 * a)
+        return int(n * n)
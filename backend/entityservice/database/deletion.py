@@ -72,3 +72,25 @@ def delete_project_data(conn, project_id):
                     id = ANY(%s)""", (dp_ids,)
             )
         log.debug("Committing removal of project resource")
+
+
+def delete_dataprovider_encodings(conn, dp_id):
+    """
+    Deletes the encodings of a data provider, and their block memberships. The blocks are kept.
+    """
+    log = logger.bind(dp_id=dp_id)
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE
+                FROM encodingblocks
+                WHERE
+                    dp = %s
+                """, [dp_id])
+            cur.execute("""
+                DELETE
+                FROM encodings
+                WHERE
+                    dp = %s
+                """, [dp_id])
+    log.info("Encodings of the data provider removed")
@@ -1,13 +1,20 @@
-from typing import List
+from typing import Dict, List
 
+import numpy as np
 import opentracing
 import psycopg2
 import psycopg2.extras
 
-from entityservice.database.util import execute_returning_id, logger, query_db, compute_encoding_ids
+from entityservice.database.util import execute_returning_id, logger, query_db, \
+    binary_copy_rows, BinaryCopyRowsSource
 from entityservice.errors import RunDeleted
 from entityservice.database.selections import get_block_metadata
 
+# Number of rows serialized at once when streaming rows into the database with COPY.
+COPY_BATCH_ROWS = 65536
+# Size of the reads of the rows by psycopg2.
+COPY_BUFFER_BYTES = 1024 * 1024
+
 
 def insert_new_project(cur, result_type, schema, access_token, project_id, num_parties, name, notes, uses_blocking):
     sql_query = """
@@ -52,19 +59,22 @@ def insert_blocking_metadata(db, dp_id, blocks):
     Insert new entries into the blocks table.
 
     :param blocks: A dict mapping block id to the number of encodings per block.
+    :return: A dict mapping the block names to the ids of the inserted blocks.
     """
     logger.info("Adding blocking metadata to database")
     sql_insertion_query = """
         INSERT INTO blocks
         (dp, block_name, count, state)
         VALUES %s
+        RETURNING block_name, block_id
         """
 
     logger.info("Preparing SQL for bulk insert of blocks")
     values = [(dp_id, block_name, blocks[block_name], 'pending') for block_name in blocks]
 
     with db.cursor() as cur:
-        psycopg2.extras.execute_values(cur, sql_insertion_query, values)
+        inserted = psycopg2.extras.execute_values(cur, sql_insertion_query, values, fetch=True)
+    return {block_name.strip(): block_id for block_name, block_id in inserted}
 
 
 def insert_encoding_metadata(db, clks_filename, dp_id, receipt_token, encoding_count, block_count):
@@ -93,43 +103,133 @@ def update_upload_state(db, dp_id, receipt_token, state='error'):
 
 
 def insert_encodings_into_blocks(db, dp_id: int, block_names: List[List[str]], entity_ids: List[int],
-                                 encodings: List[bytes], page_size: int = 4096):
+                                 encodings: List[bytes], popcounts: List[int] = None,
+                                 block_lookup: Dict[str, int] = None, batch_size: int = COPY_BATCH_ROWS):
     """
     Bulk load blocking and encoding data into the database.
-    See https://hakibenita.com/fast-load-data-python-postgresql#copy-data-from-a-string-iterator-with-buffer-size
 
-    :param page_size:
-        Maximum number of rows to fetch in a given sql statement/network transfer. A larger page size
-        will require more local memory, but could be faster due to less network transfers.
+    Both tables are loaded with a binary ``COPY ... FROM STDIN``, whose rows are serialized
+    ``batch_size`` at a time while the database consumes them.
+    See https://hakibenita.com/fast-load-data-python-postgresql#copy-data-from-a-string-iterator-with-buffer-size
 
+    :param encodings: Encodings in the internal binary format, which all have the same size. Either a list
+        of them, or an array as packed by :func:`entityservice.serialization.binary_pack_encodings`.
+    :param popcounts:
+        Optional number of set bits of each encoding. Used to skip comparisons of encodings
+        which can't be similar enough.
+    :param block_lookup:
+        Optional dict mapping the block names to their ids, as returned by :func:`insert_blocking_metadata`.
+        Looked up in the database if not given.
+    :param batch_size:
+        Maximum number of rows serialized at once. A larger batch size will require more local memory.
     """
-    ## first we have to look up the block numbers corresponding to the given block_names
-    block_info_iter = get_block_metadata(db, dp_id)
-    block_lookup = {bl_name: bl_id for bl_name, bl_id, _ in block_info_iter}
+    if block_lookup is None:
+        block_lookup = {bl_name: bl_id for bl_name, bl_id, _ in get_block_metadata(db, dp_id)}
+    if len(encodings) == 0:
+        return
 
-    encodings_insertion_query = "INSERT INTO encodings (encoding_id, encoding, dp) VALUES %s"
-    blocks_insertion_query = "INSERT INTO encodingblocks (dp, entity_id, encoding_id, block_id) VALUES %s"
     # we differentiate between entity_id and encoding_id.
     # The entity_id is the id that the dataprovider assigns to an entity. Usually the row number of that entity in the
     # dataset.
     # The encoding_id is used internally to address encodings uniquely.
+    entity_ids = np.asarray(entity_ids, dtype=np.int64)
+    # vectorized compute_encoding_ids
+    encoding_ids = (dp_id << 32) + entity_ids
+    if isinstance(encodings, np.ndarray):
+        encoding_dtype = f'S{encodings.dtype.itemsize}'
+        encodings = encodings.view(encoding_dtype)
+    else:
+        encoding_dtype = f'S{len(encodings[0])}'
+        encodings = np.frombuffer(b''.join(encodings), dtype=encoding_dtype)
+
+    def encoding_rows():
+        for start in range(0, len(encodings), batch_size):
+            stop = start + batch_size
+            columns = [('>i8', encoding_ids[start:stop]),
+                       (encoding_dtype, encodings[start:stop]),
+                       ('>i4', dp_id)]
+            if popcounts is not None:
+                columns.append(('>i2', popcounts[start:stop]))
+            yield binary_copy_rows(columns)
+
+    def encodingblock_rows():
+        block_entity_ids, block_encoding_ids, block_ids = [], [], []
+        for entity_id, encoding_id, names in zip(entity_ids.tolist(), encoding_ids.tolist(), block_names):
+            for block_name in names:
+                block_entity_ids.append(entity_id)
+                block_encoding_ids.append(encoding_id)
+                block_ids.append(block_lookup[block_name])
+            if len(block_ids) >= batch_size:
+                yield binary_copy_rows([('>i4', dp_id), ('>i4', block_entity_ids), ('>i8', block_encoding_ids),
+                                        ('>i4', block_ids)])
+                block_entity_ids, block_encoding_ids, block_ids = [], [], []
+        if block_ids:
+            yield binary_copy_rows([('>i4', dp_id), ('>i4', block_entity_ids), ('>i8', block_encoding_ids),
+                                    ('>i4', block_ids)])
+
+    encoding_columns = "encoding_id, encoding, dp, popcount" if popcounts is not None else "encoding_id, encoding, dp"
+    with db.cursor() as cur:
+        with opentracing.tracer.start_span('insert-encodings-to-db'):
+            cur.copy_expert(f"COPY encodings ({encoding_columns}) FROM STDIN WITH binary",
+                            BinaryCopyRowsSource(encoding_rows()), size=COPY_BUFFER_BYTES)
+        with opentracing.tracer.start_span('insert-encodingblocks-to-db'):
+            cur.copy_expert("COPY encodingblocks (dp, entity_id, encoding_id, block_id) FROM STDIN WITH binary",
+                            BinaryCopyRowsSource(encodingblock_rows()), size=COPY_BUFFER_BYTES)
+
+
+def update_block_popcount_histograms(db, dp_id):
+    """
+    Compute the popcount histogram of every block of a data provider from the stored
+    encodings. Encodings without a popcount are ignored.
+    """
+    sql_query = """
+        UPDATE blocks
+        SET popcount_histogram = histograms.histogram
+        FROM (
+            SELECT block_id, jsonb_object_agg(popcount, num_encodings) AS histogram
+            FROM (
+                SELECT encodingblocks.block_id, encodings.popcount, count(*) AS num_encodings
+                FROM encodingblocks, encodings
+                WHERE
+                  encodingblocks.dp = %(dp_id)s AND
+                  encodings.encoding_id = encodingblocks.encoding_id AND
+                  encodings.popcount IS NOT NULL
+                GROUP BY encodingblocks.block_id, encodings.popcount
+            ) AS popcount_counts
+            GROUP BY block_id
+        ) AS histograms
+        WHERE blocks.block_id = histograms.block_id
+        """
+    with db.cursor() as cur:
+        cur.execute(sql_query, {'dp_id': dp_id})
 
-    encoding_ids = compute_encoding_ids(map(int, entity_ids), dp_id)
-    encoding_data = ((eid, encoding, dp_id) for eid, encoding in zip(encoding_ids, encodings))
 
-    def block_data_generator(entity_ids, encoding_ids, block_ids):
-        for en_id, eid, block_ids in zip(entity_ids, encoding_ids, block_ids):
-            for block_id in block_ids:
-                yield dp_id, en_id, eid, block_lookup[block_id]
+def update_block_ordinals(db, dp_id):
+    """
+    Number the encodings of every block of a data provider from 0, ordered by popcount then entity id.
 
+    A chunk of a block, or of a popcount band of a block, is then a contiguous range of ordinals.
+    Encodings without a popcount come last.
+    """
+    sql_query = """
+        UPDATE encodingblocks
+        SET ordinal = ordinals.ordinal
+        FROM (
+            SELECT encodingblocks.block_id, encodingblocks.encoding_id,
+                   row_number() OVER (PARTITION BY encodingblocks.block_id
+                                      ORDER BY encodings.popcount, encodingblocks.entity_id) - 1 AS ordinal
+            FROM encodingblocks, encodings
+            WHERE
+              encodingblocks.dp = %(dp_id)s AND
+              encodings.encoding_id = encodingblocks.encoding_id
+        ) AS ordinals
+        WHERE
+          encodingblocks.dp = %(dp_id)s AND
+          encodingblocks.block_id = ordinals.block_id AND
+          encodingblocks.encoding_id = ordinals.encoding_id
+        """
     with db.cursor() as cur:
-        with opentracing.tracer.start_span('insert-encodings-to-db'):
-            psycopg2.extras.execute_values(cur, encodings_insertion_query, encoding_data, page_size=page_size)
-        with opentracing.tracer.start_span('insert-encodingblocks-to-db'):
-            psycopg2.extras.execute_values(cur,
-                                           blocks_insertion_query,
-                                           list(block_data_generator(entity_ids, encoding_ids, block_names)),
-                                           page_size=page_size)
+        cur.execute(sql_query, {'dp_id': dp_id})
 
 
 def set_dataprovider_upload_state(db, dp_id, state='error'):
@@ -144,17 +244,25 @@ def set_dataprovider_upload_state(db, dp_id, state='error'):
         cur.execute(sql_update, [state, dp_id])
 
 
-def insert_similarity_score_file(db, run_id, filename):
+def insert_similarity_score_file(db, run_id, filename, manifest=None):
+    """
+    Record the similarity scores of a run.
+
+    :param filename: The similarity scores file, or the common prefix of the shards of a sharded result.
+    :param manifest: The description of the shards of a sharded result.
+    """
     with db.cursor() as cur:
         insertion_query = """
             INSERT into similarity_scores
-              (run, file)
+              (run, file, manifest)
             VALUES
-              (%s, %s)
+              (%s, %s, %s)
             RETURNING id;
             """
+        if manifest is not None:
+            manifest = psycopg2.extras.Json(manifest)
         try:
-            result_id = execute_returning_id(cur, insertion_query, [run_id, filename])
+            result_id = execute_returning_id(cur, insertion_query, [run_id, filename, manifest])
         except psycopg2.IntegrityError as e:
             raise RunDeleted(run_id)
     return result_id
@@ -362,8 +470,8 @@ def progress_run_stage(db, run_id):
 
 def get_created_runs_and_queue(db, project_id):
     """
-    returns the run_ids of all runs for this project who's state is 'created' and sets the state of those runs
-    to 'queued'.
+    returns the run_ids and thresholds of all runs for this project who's state is 'created' and sets the state
+    of those runs to 'queued'.
     This is necessary to avoid a race condition which led to executing a run twice. (#194)
     """
     with db.cursor() as cur:
@@ -373,7 +481,7 @@ def get_created_runs_and_queue(db, project_id):
             WHERE
               state = 'created' AND project = %s
             RETURNING
-              run_id;
+              run_id, threshold;
         """
         cur.execute(sql_query, [project_id])
         res = cur.fetchall()
@@ -3,13 +3,13 @@ from datetime import timedelta
 from entityservice.database.util import query_db, execute_returning_id
 
 
-def get_latest_rate(db):
+def get_latest_rate(db, default=1):
     select_query = 'select ts, rate from metrics order by ts desc limit 1'
     res = query_db(db, select_query, one=True)
     if res is None:
         # Just to avoid annoying divide by zero errors return a low rate
         # if the true value is unknown
-        current_rate = 1
+        current_rate = default
     else:
         current_rate = res['rate']
 
@@ -14,6 +14,7 @@ class Encoding(Base):
     encoding_id = Column(BigInteger, primary_key=True)
     encoding = Column(LargeBinary, nullable=False)
     dp = Column(ForeignKey('dataproviders.id', ondelete='CASCADE'))
+    popcount = Column(SmallInteger)
 
 
 class Metric(Base):
@@ -110,6 +111,8 @@ class Block(Base):
     block_id = Column(Integer, primary_key=True)
     count = Column(Integer, nullable=False)
     state = Column(Enum(BlockState, name='processedstate'), nullable=False)
+    # Maps popcount to the number of encodings in the block with that popcount
+    popcount_histogram = Column(JSONB())
 
     dataprovider = relationship('Dataprovider')
 
@@ -154,7 +157,10 @@ class SimilarityScore(Base):
 
     id = Column(Integer, primary_key=True)
     run = Column(ForeignKey('runs.run_id', ondelete='CASCADE'), index=True)
-    file = Column(CHAR(70), nullable=False)
+    # The result file, or the common prefix of the shards of a sharded result
+    file = Column(Text, nullable=False)
+    # Description of the shards of a sharded result
+    manifest = Column(JSONB)
 
     run1 = relationship('Run')
 
@@ -187,5 +193,8 @@ t_encodingblocks = Table(
     Column('dp', ForeignKey('dataproviders.id', ondelete='CASCADE')),
     Column('entity_id', Integer),
     Column('encoding_id', ForeignKey('encodings.encoding_id', ondelete='CASCADE'), index=True),
-    Column('block_id', ForeignKey('blocks.block_id'), index=True)
+    Column('block_id', ForeignKey('blocks.block_id'), index=True),
+    # Position of the encoding within its block, ordered by popcount then entity id
+    Column('ordinal', Integer),
+    Index('ix_encodingblocks_block_id_ordinal', 'block_id', 'ordinal')
 )
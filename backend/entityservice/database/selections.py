@@ -1,8 +1,11 @@
 import io
 import itertools
 
-from entityservice.database.util import query_db, logger, binary_format, compute_encoding_ids
+from entityservice.database.util import query_db, logger, binary_format, compute_encoding_ids, \
+    BinaryCopyEncodingsSink
 from entityservice.errors import ProjectDeleted, RunDeleted, DataProviderDeleted
+from entityservice.popcount_banding import plan_block_comparisons, count_planned_comparisons
+from entityservice.settings import Config
 
 
 def select_dataprovider_id(db, project_id, receipt_token):
@@ -228,7 +231,7 @@ def get_smaller_dataset_size_for_project(db, project_id):
     return query_result['smaller']
 
 
-def get_total_comparisons_for_project(db, project_id):
+def get_total_comparisons_for_project(db, project_id, threshold=None, chunk_size_aim=None):
     """
     Returns the number of comparisons that a project requires.
 
@@ -238,13 +241,17 @@ def get_total_comparisons_for_project(db, project_id):
         then sum number of comparisons for each block
     Sum the number of comparisons in all blocks together.
 
+    If a threshold is given, comparisons which are ruled out by the popcount histograms of the
+    blocks are not counted, in the same way as they are skipped when creating the comparison jobs.
+
     :return total number of comparisons for this project
     """
-
+    if chunk_size_aim is None:
+        chunk_size_aim = Config.CHUNK_SIZE_AIM
     # The full computation is *hard* to do in postgres, so we return an array of sizes
     # for each block and then use Python to find the pairwise combinations.
     sql_query = """
-        select block_name, array_agg(count) as counts
+        select block_name, array_agg(count ORDER BY dp) as counts, array_agg(popcount_histogram ORDER BY dp) as histograms
         from blocks
         where dp in (
             select id from dataproviders where project = %s
@@ -255,8 +262,13 @@ def get_total_comparisons_for_project(db, project_id):
     query_results = query_db(db, sql_query, [project_id])
     total_comparisons = 0
     for block in query_results:
-        num_comparisons_in_block = sum(c0 * c1 for c0, c1 in itertools.combinations(block['counts'], 2))
-        total_comparisons += num_comparisons_in_block
+        if threshold is None:
+            histograms = [None] * len(block['counts'])
+        else:
+            histograms = [_parse_popcount_histogram(h) for h in block['histograms']]
+        for (c0, h0), (c1, h1) in itertools.combinations(zip(block['counts'], histograms), 2):
+            band_pairs = plan_block_comparisons(h0, c0, h1, c1, threshold, chunk_size_aim)
+            total_comparisons += count_planned_comparisons(band_pairs, c0, c1)
 
     return total_comparisons
 
@@ -285,25 +297,39 @@ def get_uploads_columns(db, dp_id, columns):
     return [result[column] for column in columns]
 
 
-def get_encodingblock_ids(db, dp_id, block_id=None, offset=0, limit=None):
-    """Yield all entity ids in either a single block, or all blocks for a given data provider."""
+def get_encodingblock_ids(db, dp_id, block_id=None, offset=0, limit=None, popcount_range=None):
+    """
+    Yield all entity ids in either a single block, or all blocks for a given data provider.
+
+    :param popcount_range: Optional (lowest, highest) popcount. If given, only entities whose
+        encoding has a popcount within that range are considered.
+    """
+    filters = []
+    if block_id:
+        filters.append("AND encodingblocks.block_id = %(block_id)s")
+    if popcount_range:
+        filters.append("AND encodings.encoding_id = encodingblocks.encoding_id")
+        filters.append("AND encodings.popcount BETWEEN %(popcount_min)s AND %(popcount_max)s")
     sql_query = """
-        SELECT entity_id 
-        FROM encodingblocks
-        WHERE dp = %(dp_id)s
+        SELECT encodingblocks.entity_id
+        FROM {}
+        WHERE encodingblocks.dp = %(dp_id)s
         {}
         ORDER BY
-          entity_ID ASC
+          encodingblocks.entity_id ASC
         OFFSET %(offset)s
         LIMIT %(limit)s
-        """.format("AND block_id = %(block_id)s" if block_id else "")
+        """.format("encodingblocks, encodings" if popcount_range else "encodingblocks", "\n        ".join(filters))
     # Specifying a name for the cursor creates a server-side cursor, which prevents all of the
     # records from being downloaded at once.
     cur_name = f'encodingblockfetcher-{dp_id}'
     if block_id:
         cur_name = f'encodingblockfetcher-{dp_id}-{block_id}'
-    cur = db.cursor(cur_name)
     args = {'dp_id': dp_id, 'block_id': block_id, 'offset': offset, 'limit': limit}
+    if popcount_range:
+        args['popcount_min'], args['popcount_max'] = popcount_range
+        cur_name += f'-{args["popcount_min"]}-{args["popcount_max"]}'
+    cur = db.cursor(cur_name)
     cur.execute(sql_query, args)
     yield from iterate_cursor_results(cur)
 
@@ -325,6 +351,103 @@ def get_block_metadata(db, dp_id):
     cur.close()
 
 
+def get_block_names(db, block_ids):
+    """Return a dict mapping the given block ids to their block names."""
+    sql_query = """
+        SELECT block_id, block_name
+        FROM blocks
+        WHERE block_id = ANY(%s)
+        """
+    with db.cursor() as cur:
+        cur.execute(sql_query, (list(block_ids),))
+        return {block_id: block_name.strip() for block_id, block_name in cur.fetchall()}
+
+
+def get_multi_block_memberships(db, block_ranges):
+    """
+    Return the names of the blocks of the entities of ranges of blocks, for the entities belonging to more
+    than one block. All the ranges are looked up in a single query.
+
+    :param block_ranges: list of (block id, start, stop, popcount range) tuples, selecting the encodings of
+        a range of ordinals of a block as :func:`get_encodings_of_block_range` does. The popcount range may
+        be None.
+    :return: list of the memberships of each range: a dict mapping entity id to the frozenset of its block
+        names. Entities in a single block are left out.
+    """
+    # The encodings of a popcount band follow the encodings with a lower popcount, counted in the histogram
+    sql_query = """
+        WITH ranges AS (
+          SELECT r.range_index, r.block_id, band.start + r.start AS start, band.start + r.stop AS stop
+          FROM unnest(%s::int[], %s::int[], %s::int[], %s::int[])
+                 WITH ORDINALITY AS r(block_id, start, stop, popcount_min, range_index),
+               LATERAL (
+                 SELECT coalesce(sum(histogram.count::int), 0) AS start
+                 FROM blocks, jsonb_each_text(blocks.popcount_histogram) AS histogram(popcount, count)
+                 WHERE
+                   blocks.block_id = r.block_id AND
+                   histogram.popcount::int < r.popcount_min
+               ) AS band
+        )
+        SELECT ranges.range_index, members.entity_id, array_agg(blocks.block_name)
+        FROM ranges, encodingblocks AS members, encodingblocks, blocks
+        WHERE
+          members.block_id = ranges.block_id AND
+          members.ordinal >= ranges.start AND
+          members.ordinal < ranges.stop AND
+          encodingblocks.encoding_id = members.encoding_id AND
+          blocks.block_id = encodingblocks.block_id
+        GROUP BY ranges.range_index, members.entity_id
+        HAVING count(*) > 1
+        """
+    block_ids, starts, stops, popcount_mins = [], [], [], []
+    for block_id, start, stop, popcount_range in block_ranges:
+        block_ids.append(block_id)
+        starts.append(start)
+        stops.append(stop)
+        popcount_mins.append(popcount_range[0] if popcount_range else 0)
+    memberships = [{} for _ in block_ranges]
+    if not block_ranges:
+        return memberships
+    with db.cursor() as cur:
+        cur.execute(sql_query, (block_ids, starts, stops, popcount_mins))
+        for range_index, entity_id, block_names in cur.fetchall():
+            memberships[range_index - 1][entity_id] = frozenset(block_name.strip() for block_name in block_names)
+    return memberships
+
+
+def dataprovider_has_overlapping_blocks(db, dp_id):
+    """Whether some encodings of a data provider belong to more than one block."""
+    sql_query = """
+        SELECT coalesce(sum(blocks.count), 0) > uploads.count AS overlapping
+        FROM uploads LEFT JOIN blocks ON blocks.dp = uploads.dp
+        WHERE uploads.dp = %s
+        GROUP BY uploads.count
+        """
+    result = query_db(db, sql_query, [dp_id], one=True)
+    return result is not None and result['overlapping']
+
+
+def _parse_popcount_histogram(histogram):
+    """JSON object keys are strings, convert them back to popcounts."""
+    if histogram is None:
+        return None
+    return {int(popcount): count for popcount, count in histogram.items()}
+
+
+def get_block_popcount_histograms(db, dp_id):
+    """Yield block id and popcount histogram for each block of a given data provider."""
+    sql_query = """
+        SELECT block_id, popcount_histogram
+        FROM blocks
+        WHERE dp = %s
+        """
+    cur = db.cursor(f'blockhistogramfetcher-{dp_id}')
+    cur.execute(sql_query, (dp_id,))
+    for block_id, histogram in iterate_cursor_results(cur, one=False):
+        yield block_id, _parse_popcount_histogram(histogram)
+    cur.close()
+
+
 def iterate_cursor_results(cur, one=True, page_size=4096):
     while True:
         rows = cur.fetchmany(page_size)
@@ -337,13 +460,16 @@ def iterate_cursor_results(cur, one=True, page_size=4096):
                 yield row
 
 
-def execute_select_query_in_binary(cur, select_query):
+def execute_select_query_in_binary(cur, select_query, args=None):
     """Yields raw bytes from postgres given a query.
 
     :param cur: db cursor
     :param select_query: An sql query
+    :param args: Optional parameters of the query. COPY doesn't take parameters, so they are bound client side.
     :raises AssertionError if the database implements an unhandled extension or the EOF is corrupt.
     """
+    if args is not None:
+        select_query = cur.mogrify(select_query, args).decode()
 
     copy_to_stream_query = """COPY ({}) TO STDOUT WITH binary""".format(select_query)
     stream = io.BytesIO()
@@ -374,6 +500,55 @@ def get_chunk_of_encodings(db, dp_id, entity_ids, stored_binary_size=132):
     yield from execute_select_query_in_binary(cur, sql_query)
 
 
+def execute_select_encodings_query_in_binary(cur, select_query, encoding_size, args=None, expected_rows=0):
+    """Run a query selecting a single column of encodings in the internal binary format, see
+    :class:`entityservice.database.util.BinaryCopyEncodingsSink`.
+
+    The output of the query is parsed as it is received.
+
+    :return: a tuple of the uint32 array of entity ids and the ``(n, encoding_size)`` uint8 array of encodings.
+    """
+    if args is not None:
+        select_query = cur.mogrify(select_query, args).decode()
+    sink = BinaryCopyEncodingsSink(encoding_size, expected_rows=expected_rows)
+    cur.copy_expert("""COPY ({}) TO STDOUT WITH binary""".format(select_query), sink)
+    return sink.result()
+
+
+def get_encodings_of_block_range(db, block_id, start, stop, encoding_size, popcount_range=None):
+    """Fetch the encodings of a range of ordinals of a block, in a single query.
+
+    :param start: First ordinal of the range.
+    :param stop: Ordinal after the end of the range.
+    :param popcount_range: Optional (lowest, highest) popcount. If given, the range is relative to the
+        encodings of the block within that popcount band.
+    :return: a tuple of the uint32 array of entity ids and the ``(n, encoding_size)`` uint8 array of encodings.
+    """
+    cur = db.cursor()
+    # The encodings of a popcount band follow the encodings with a lower popcount, counted in the histogram
+    sql_query = """
+    WITH band AS (
+      SELECT coalesce(sum(histogram.count::int), 0) AS start
+      FROM blocks, jsonb_each_text(blocks.popcount_histogram) AS histogram(popcount, count)
+      WHERE
+        blocks.block_id = %(block_id)s AND
+        histogram.popcount::int < %(popcount_min)s
+    )
+    SELECT encodings.encoding
+    FROM band, encodingblocks, encodings
+    WHERE
+      encodingblocks.block_id = %(block_id)s AND
+      encodingblocks.ordinal >= band.start + %(start)s AND
+      encodingblocks.ordinal < band.start + %(stop)s AND
+      encodings.encoding_id = encodingblocks.encoding_id
+    ORDER BY encodingblocks.ordinal ASC
+    """
+    popcount_min = popcount_range[0] if popcount_range else 0
+    args = {'block_id': block_id, 'start': start, 'stop': stop, 'popcount_min': popcount_min}
+    return execute_select_encodings_query_in_binary(cur, sql_query, encoding_size, args,
+                                                    expected_rows=stop - start)
+
+
 def get_encodings_of_multiple_blocks(db, dp_id, block_ids):
 
     cur = db.cursor()
@@ -381,14 +556,14 @@ def get_encodings_of_multiple_blocks(db, dp_id, block_ids):
     SELECT encodingblocks.block_id, encodingblocks.entity_id, encodings.encoding 
     FROM encodingblocks, encodings
     WHERE
-      encodingblocks.dp = {} AND
+      encodingblocks.dp = %s AND
       encodingblocks.encoding_id = encodings.encoding_id AND 
-      encodingblocks.block_id IN ({})
+      encodingblocks.block_id = ANY(%s)
     ORDER BY
         block_id asc, entity_id asc
-    """.format(dp_id, ",".join(map(lambda s: f"'{s}'", block_ids)))
+    """
 
-    for row in execute_select_query_in_binary(cur, sql_query):
+    for row in execute_select_query_in_binary(cur, sql_query, (dp_id, list(block_ids))):
         if len(row) != 3:
             logger.warning(f'something went wrong! Got a row with this: {row}')
         bin_block_id, bin_encoding_id, bin_encoding = row
@@ -472,6 +647,24 @@ def get_similarity_scores_filename(db, run_id):
     return query_db(db, sql_query, [run_id], one=True)['file'].strip()
 
 
+def get_similarity_scores_manifest(db, run_id):
+    """Return the manifest of the shards of the similarity scores of a run, or None if they aren't sharded."""
+    sql_query = """
+        SELECT manifest FROM similarity_scores
+        WHERE
+          run = %s
+        """
+    return query_db(db, sql_query, [run_id], one=True)['manifest']
+
+
+def _similarity_scores_files(similarity_scores_row):
+    """The object store files of a row of the similarity_scores table."""
+    manifest = similarity_scores_row['manifest']
+    if manifest is not None:
+        return [shard['file'] for shard in manifest['shards']]
+    return [similarity_scores_row['file'].strip()]
+
+
 def get_run_status(db, run_id):
     sql_query = """
             SELECT state, stage, type, time_added, time_started, time_completed, error_msg
@@ -511,14 +704,14 @@ def get_all_objects_for_project(db, project_id):
 def get_project_similarity_files(db, project_id):
     query_response = query_db(db, """
             SELECT 
-              similarity_scores.file
+              similarity_scores.file, similarity_scores.manifest
             FROM 
               similarity_scores, runs
             WHERE 
               runs.run_id = similarity_scores.run AND
               runs.project = %s
             """, [project_id])
-    similarity_files = [res['file'] for res in query_response]
+    similarity_files = [file for res in query_response for file in _similarity_scores_files(res)]
     return similarity_files
 
 
@@ -535,3 +728,66 @@ def get_similarity_file_for_run(db, run_id):
     if len(similarity_files):
         assert len(similarity_files) == 1, "More than one similarity score file associated with a single run"
         return similarity_files[0]
+
+
+def get_similarity_files_for_run(db, run_id):
+    """Return all the object store files holding the similarity scores of a run, including shards."""
+    query_response = query_db(db, """
+            SELECT 
+              similarity_scores.file, similarity_scores.manifest
+            FROM 
+              similarity_scores
+            WHERE 
+              similarity_scores.run = %s
+            """, [run_id])
+    return [file for res in query_response for file in _similarity_scores_files(res)]
+
+
+def get_reusable_similarity_scores(db, project_id, threshold):
+    """
+    Find the similarity scores of a run of the project with a threshold less than or equal to
+    ``threshold``. The run may still be running, e.g. solving, as its similarity scores are only
+    recorded once complete. Of these, the run with the highest threshold is picked as it has the
+    fewest candidate pairs to filter.
+
+    :return: dict with the ``run`` id, its ``threshold`` and the object store ``files`` holding
+        its similarity scores, or None if no such run exists.
+    """
+    sql_query = """
+        SELECT 
+          similarity_scores.run, similarity_scores.file, similarity_scores.manifest, runs.threshold
+        FROM 
+          similarity_scores, runs
+        WHERE 
+          similarity_scores.run = runs.run_id AND
+          runs.project = %s AND
+          runs.state IN ('running', 'completed') AND
+          runs.threshold <= %s
+        ORDER BY runs.threshold DESC, runs.id
+        LIMIT 1
+        """
+    res = query_db(db, sql_query, [project_id, threshold], one=True)
+    if res is not None:
+        return {'run': res['run'], 'threshold': res['threshold'], 'files': _similarity_scores_files(res)}
+
+
+def get_pending_runs_with_lower_threshold(db, project_id, run_id):
+    """
+    Return the ids of the queued or running runs of the project whose similarity scores haven't
+    been recorded yet, and which come before the given run when ordered by threshold and then
+    by creation.
+    """
+    sql_query = """
+        SELECT runs.run_id
+        FROM runs, runs AS this_run
+        WHERE
+          this_run.run_id = %s AND
+          runs.project = %s AND
+          runs.state IN ('queued', 'running') AND
+          (runs.threshold, runs.id) < (this_run.threshold, this_run.id) AND
+          NOT EXISTS (
+            SELECT 1 FROM similarity_scores
+            WHERE similarity_scores.run = runs.run_id
+          )
+        """
+    return [res['run_id'] for res in query_db(db, sql_query, [run_id, project_id])]
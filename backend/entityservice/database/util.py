@@ -1,8 +1,10 @@
+import itertools
 import time
 from io import BytesIO
 from typing import Iterable
 
 import atexit
+import numpy as np
 import psycopg2
 import psycopg2.extras
 from psycopg2.pool import ThreadedConnectionPool
@@ -135,6 +137,10 @@ def execute_returning_id(cur, query, args):
         return resource_id
 
 
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00\x00\x00\x00\x00'
+BINARY_COPY_TRAILER = b'\xff\xff'
+
+
 def binary_format(stream: BytesIO):
     """
     parse binary format of Postgresql. This is a generator which yields one row at a time.
@@ -145,7 +151,7 @@ def binary_format(stream: BytesIO):
     # Need to read/remove the Postgres Binary Header, Trailer, and the per tuple info
     # https://www.postgresql.org/docs/current/sql-copy.html
     header = stream.read(15)
-    assert header == b'PGCOPY\n\xff\r\n\x00\x00\x00\x00\x00', "Invalid Binary Format"
+    assert header == BINARY_COPY_HEADER, "Invalid Binary Format"
     header_extension = stream.read(4)
     assert header_extension == b'\x00\x00\x00\x00', "Need to implement skipping postgres binary header extension"
     # now iterate over the rows
@@ -164,6 +170,136 @@ def binary_format(stream: BytesIO):
             yield row_values
 
 
+class BinaryCopyEncodingsSink:
+    """
+    File like sink for ``cursor.copy_expert``, parsing the binary output of a COPY query selecting
+    a single column of encodings in the internal binary format: a 4 byte entity id followed by
+    ``encoding_size`` bytes, see :func:`entityservice.serialization.binary_format`.
+
+    Every row of such a query has the same size, so the rows received are buffered up to
+    ``buffer_bytes`` and then viewed as a numpy structured array, whose fields are copied into
+    an array of entity ids and a contiguous ``(n, encoding_size)`` array of encodings. No Python
+    object is created per row, and apart from the buffer only the parsed arrays are kept in memory.
+
+    :param expected_rows: number of rows to allocate the arrays for. They grow as needed.
+    """
+
+    def __init__(self, encoding_size, expected_rows=0, buffer_bytes=1024 * 1024):
+        self.encoding_size = encoding_size
+        self.buffer_bytes = buffer_bytes
+        self._row_dtype = np.dtype([
+            ('num_fields', '>u2'),
+            ('field_size', '>i4'),
+            ('entity_id', '>u4'),
+            ('encoding', 'u1', (encoding_size,)),
+        ])
+        self._entity_ids = np.empty(expected_rows, dtype=np.uint32)
+        self._encodings = np.empty((expected_rows, encoding_size), dtype=np.uint8)
+        self._count = 0
+        self._buffer = bytearray()
+        self._header_read = False
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_bytes:
+            self._parse_buffer()
+        return len(data)
+
+    def _parse_buffer(self):
+        offset = 0
+        if not self._header_read:
+            if len(self._buffer) < len(BINARY_COPY_HEADER) + 4:
+                return
+            assert self._buffer[:len(BINARY_COPY_HEADER)] == BINARY_COPY_HEADER, "Invalid Binary Format"
+            assert self._buffer[len(BINARY_COPY_HEADER):len(BINARY_COPY_HEADER) + 4] == b'\x00\x00\x00\x00', \
+                "Need to implement skipping postgres binary header extension"
+            offset = len(BINARY_COPY_HEADER) + 4
+            self._header_read = True
+        num_rows = (len(self._buffer) - offset) // self._row_dtype.itemsize
+        if num_rows > 0:
+            rows = np.frombuffer(self._buffer, dtype=self._row_dtype, count=num_rows, offset=offset)
+            if np.any(rows['num_fields'] != 1) or np.any(rows['field_size'] != self.encoding_size + 4):
+                raise ValueError("Unexpected row in the binary COPY output, expected a single column of "
+                                 f"encodings of {self.encoding_size} bytes")
+            self._reserve(self._count + num_rows)
+            self._entity_ids[self._count:self._count + num_rows] = rows['entity_id']
+            self._encodings[self._count:self._count + num_rows] = rows['encoding']
+            self._count += num_rows
+            # the buffer can't be resized while numpy holds a view of it
+            del rows
+        del self._buffer[:offset + num_rows * self._row_dtype.itemsize]
+
+    def _reserve(self, num_rows):
+        capacity = len(self._entity_ids)
+        if num_rows <= capacity:
+            return
+        capacity = max(num_rows, 2 * capacity)
+        entity_ids = np.empty(capacity, dtype=np.uint32)
+        entity_ids[:self._count] = self._entity_ids[:self._count]
+        encodings = np.empty((capacity, self.encoding_size), dtype=np.uint8)
+        encodings[:self._count] = self._encodings[:self._count]
+        self._entity_ids, self._encodings = entity_ids, encodings
+
+    def result(self):
+        """
+        Parse the rest of the output once the COPY query has finished.
+
+        :return: a tuple of the uint32 array of entity ids and the uint8 array of encodings.
+        :raises AssertionError: if the output is incomplete or the database uses an unhandled extension.
+        """
+        self._parse_buffer()
+        assert self._header_read and self._buffer == BINARY_COPY_TRAILER, "Invalid Binary Format"
+        return self._entity_ids[:self._count], self._encodings[:self._count]
+
+
+def binary_copy_rows(columns):
+    """
+    Serialize rows of fixed size values in the binary format of ``COPY ... FROM STDIN WITH binary``.
+
+    :param columns: list of (dtype, values) of each column, in the order of the COPY column list. The
+        dtype is the big endian numpy type of the column, e.g. '>i8' for a bigint, or 'S<n>' for a
+        bytea whose values all have n bytes. Values are either a sequence or a single value for all rows.
+    :return: bytes of the rows, to be sent between the header and trailer, see :class:`BinaryCopyRowsSource`.
+    """
+    num_rows = max(len(values) for _, values in columns if not np.isscalar(values))
+    row_dtype = np.dtype([('num_fields', '>i2')] + [
+        field for i, (dtype, _) in enumerate(columns) for field in ((f'size{i}', '>i4'), (f'value{i}', dtype))])
+    rows = np.empty(num_rows, dtype=row_dtype)
+    rows['num_fields'] = len(columns)
+    for i, (dtype, values) in enumerate(columns):
+        rows[f'size{i}'] = row_dtype[f'value{i}'].itemsize
+        rows[f'value{i}'] = values
+    return rows.tobytes()
+
+
+class BinaryCopyRowsSource:
+    """
+    File like source for ``cursor.copy_expert`` of a ``COPY ... FROM STDIN WITH binary`` query,
+    reading the rows from an iterable of serialized batches of rows, see :func:`binary_copy_rows`.
+
+    Batches are only pulled from the iterable as the database consumes them, so the rows of a
+    whole upload never have to be held in memory.
+    """
+
+    def __init__(self, batches):
+        self._batches = itertools.chain([BINARY_COPY_HEADER + b'\x00\x00\x00\x00'], batches, [BINARY_COPY_TRAILER])
+        self._batch = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        while self._offset >= len(self._batch):
+            self._batch = next(self._batches, None)
+            self._offset = 0
+            if self._batch is None:
+                self._batch = b''
+                return b''
+        if size is None or size < 0:
+            size = len(self._batch) - self._offset
+        data = self._batch[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
 def compute_encoding_ids(entity_ids: Iterable[int], dp_id: int):
     """ compute unique encoding ids for given entity ids
     The user provides entity ids. Although unique for the user, different user can have the same entity ids.
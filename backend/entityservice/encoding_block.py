@@ -0,0 +1,92 @@
+"""
+Array-backed container for a chunk of encodings and the entity ids of their records.
+
+Chunks used to be lists of ``(entity_id, encoding)`` tuples, which cost a tuple, an int and a
+bytes object per record, several times the size of the encodings themselves. An
+:class:`EncodingBlock` holds the encodings in one contiguous ``(n, encoding_size)`` uint8 array
+and the entity ids in a uint32 array. Slices share the arrays of the block they are taken from.
+"""
+import array
+
+import numpy as np
+
+from entityservice.serialization import binary_format_dtype
+
+
+class EncodingBlock:
+    """
+    A chunk of equally sized encodings, with the entity id of each encoding.
+
+    :param entity_ids: sequence of the entity ids, converted to a uint32 array.
+    :param encodings: ``(n, encoding_size)`` uint8 array of the encodings.
+    """
+    __slots__ = ('entity_ids', 'encodings')
+
+    def __init__(self, entity_ids, encodings):
+        entity_ids = np.asarray(entity_ids, dtype=np.uint32)
+        if encodings.dtype != np.uint8 or encodings.ndim != 2:
+            raise ValueError('encodings must be a 2D uint8 array')
+        if len(entity_ids) != len(encodings):
+            raise ValueError("Length of entity ids and encodings don't match")
+        self.entity_ids = entity_ids
+        self.encodings = encodings
+
+    @classmethod
+    def empty(cls, encoding_size):
+        return cls(np.empty(0, dtype=np.uint32), np.empty((0, encoding_size), dtype=np.uint8))
+
+    @classmethod
+    def from_pairs(cls, pairs, encoding_size):
+        """Create a block from an iterable of (entity id, encoding bytes) tuples."""
+        pairs = list(pairs)
+        if not pairs:
+            return cls.empty(encoding_size)
+        entity_ids, encodings = zip(*pairs)
+        return cls(entity_ids, np.frombuffer(b''.join(encodings), dtype=np.uint8).reshape(-1, encoding_size))
+
+    @classmethod
+    def from_binary(cls, data, encoding_size):
+        """
+        Create a block from encodings in the internal binary format, see
+        :func:`entityservice.serialization.binary_format`.
+
+        :param data: bytes-like object of concatenated binary encodings.
+        """
+        records = np.frombuffer(data, dtype=binary_format_dtype(encoding_size))
+        return cls(records['entity_id'].astype(np.uint32), np.ascontiguousarray(records['encoding']))
+
+    @property
+    def encoding_size(self):
+        return self.encodings.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.entity_ids.nbytes + self.encodings.nbytes
+
+    def __len__(self):
+        return len(self.entity_ids)
+
+    def __getitem__(self, index):
+        """Slicing returns a block sharing the arrays of this block."""
+        if not isinstance(index, slice):
+            raise TypeError('EncodingBlock only supports slicing')
+        return EncodingBlock(self.entity_ids[index], self.encodings[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, EncodingBlock):
+            return NotImplemented
+        return np.array_equal(self.entity_ids, other.entity_ids) and np.array_equal(self.encodings, other.encodings)
+
+    def take_entity_ids(self, indices):
+        """
+        Map indices of records within this block to their entity ids.
+
+        :param indices: an ``array.array('I')`` of record indices, as returned by the comparison kernels.
+        :return: an ``array.array('I')`` of entity ids.
+        """
+        indices = np.frombuffer(indices, dtype=np.uint32) if len(indices) else np.empty(0, dtype=np.intp)
+        return array.array('I', self.entity_ids.take(indices).tobytes())
+
+    def to_pairs(self):
+        """Return the encodings as a list of (entity id, encoding bytes) tuples."""
+        return list(zip(self.entity_ids.tolist(), map(bytes, self.encodings)))
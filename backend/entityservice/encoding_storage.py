@@ -1,19 +1,23 @@
 from hashlib import blake2b
 
-import math
+import functools
+import itertools
+import operator
 from collections import defaultdict
-from itertools import zip_longest
-from typing import Iterator, List, Tuple, Iterable
+from typing import Dict, List, Tuple, Iterable
 
 import ijson
+import numpy as np
 import opentracing
 from flask import g
 from structlog import get_logger
 
 from entityservice import database as db
-from entityservice.database import insert_encodings_into_blocks, get_encodingblock_ids, \
-    get_chunk_of_encodings, get_encodings_of_multiple_blocks, DBConn
-from entityservice.serialization import deserialize_bytes, binary_format, binary_unpack_filters, binary_unpack_one
+from entityservice.encoding_block import EncodingBlock
+from entityservice.database import get_encodings_of_block_range, get_encodings_of_multiple_blocks, DBConn
+from entityservice.ingestion import group_records, ingest_encodings
+from entityservice.serialization import deserialize_bytes_batch, binary_format, binary_pack_encodings
+from entityservice.settings import Config
 from entityservice.utils import fmt_bytes
 
 logger = get_logger()
@@ -21,7 +25,7 @@ logger = get_logger()
 DEFAULT_BLOCK_ID = '1'
 
 
-def stream_json_clksnblocks(f):
+def stream_json_clksnblocks(f, group_size: int=None):
     """
     The provided file will be contain encodings and blocking information with
     the following structure:
@@ -34,141 +38,119 @@ def stream_json_clksnblocks(f):
         ]
     }
 
+    The records are only parsed here: their encodings are decoded and their block names hashed a group at
+    a time by :func:`prepare_encodings` with ``hash_blocks=True``.
+
     :param f: JSON file containing clksnblocks data.
-    :return: Generator of (entity_id, base64 encoding, iterable of hashed block names)
+    :return: Generator of (base64 encodings, block names) groups of records, see :func:`group_encodings`.
     """
     # At some point the user may supply the entity id. For now we use the order of uploaded encodings.
-    for i, obj in enumerate(ijson.items(f, 'clknblocks.item')):
-        b64_encoding, *blocks = obj
-        yield i, deserialize_bytes(b64_encoding), map(hash_block_name, blocks)
+    records = ((b64_encoding, blocks) for b64_encoding, *blocks in ijson.items(f, 'clknblocks.item'))
+    yield from group_encodings(records, group_size)
 
 
-def convert_encodings_from_base64_to_binary(encodings: Iterator[Tuple[str, str, List[str]]]):
+def group_encodings(records: Iterable[Tuple[str, List[str]]], group_size: int=None):
     """
-    :param encodings: Iterable object containing tuples of  (entity_id, base64 encoding, list of blocks)
-    :return: a tuple comprising:
-         (entity_id, binary encoding, list of blocks)
+    Cut an iterable of (base64 encoding, block names) records into (encodings, block names) groups,
+    see :func:`store_encodings_in_db`.
     """
-    # Peek at the first element to extract the encoding size
-    i, encoding_data, blocks = next(encodings)
-    encoding_size = len(encoding_data)
-    bit_packing_struct = binary_format(encoding_size)
-
-    def generator(first_i, first_encoding_data, first_blocks):
-        binary_packed_encoding = bit_packing_struct.pack(first_i, first_encoding_data)
-        yield first_i, binary_packed_encoding, first_blocks
-        for i, encoding_data, blocks in encodings:
-            binary_packed_encoding = bit_packing_struct.pack(i, encoding_data)
-            yield i, binary_packed_encoding, blocks
-
-    return encoding_size, generator(i, encoding_data, blocks)
+    for group in group_records(records, group_size or Config.INGESTION_GROUP_SIZE):
+        encodings, block_names = zip(*group)
+        yield list(encodings), list(block_names)
 
 
-def _grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks from an iterable"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
+def prepare_encodings(first_entity_id, group, hash_blocks=False, encoding_size=None):
+    """
+    Prepare a group of uploaded records for the database, see :func:`entityservice.ingestion.ingest_encodings`.
 
+    The encodings of the group are decoded together, and packed with their entity ids into one array.
 
-def _transpose(group):
+    :param group: (encodings, block names) of the records. The encodings are either a list of base64
+        strings, or a bytes-like slab of raw encodings back to back, in which case encoding_size is required.
+    :param hash_blocks: whether the block names are hashed with :func:`hash_block_name`, or already were.
+    :param encoding_size: the expected size of the encodings, if known.
+    :return: a tuple of the entity ids, the encodings packed by :func:`entityservice.serialization.binary_pack_encodings`
+        and the block names of the records.
+    :raises ValueError: if the encodings don't all have the same (expected) size.
     """
-    Given a list of 3-tuples from _grouper, return 3 lists.
-    Also filter out possible None values from _grouper
+    encodings, block_names = group
+    if isinstance(encodings, (bytes, bytearray, memoryview)):
+        if len(encodings) != encoding_size * len(block_names):
+            raise ValueError(f"Expected {len(block_names)} encodings of {encoding_size} bytes, got {len(encodings)} bytes")
+        encodings = np.frombuffer(encodings, dtype=np.uint8).reshape(len(block_names), encoding_size)
+    else:
+        encodings = deserialize_bytes_batch(encodings)
+        if encoding_size is not None and encodings.shape[1] != encoding_size:
+            raise ValueError(f"Expected encodings of {encoding_size} bytes, got {encodings.shape[1]} bytes")
+    entity_ids = np.arange(first_entity_id, first_entity_id + len(encodings), dtype=np.uint32)
+    if hash_blocks:
+        # block names are shared by many records, hash each of them once
+        names = {str(name) for blocks in block_names for name in blocks}
+        hashed_names = dict(zip(names, map(hash_block_name, names)))
+        block_names = [[hashed_names[str(name)] for name in blocks] for blocks in block_names]
+    return entity_ids, binary_pack_encodings(entity_ids, encodings), block_names
+
+
+def store_encodings_in_db(conn, dp_id, groups: Iterable[Tuple[object, List[List[str]]]],
+                          block_lookup: Dict[str, int]=None, prepare_group=prepare_encodings):
     """
-    a, b, c = [], [], []
-    for g in group:
-        # g can be None
-        if g is not None:
-
-            x, y, z = g
-            #if x is not None and y is not None and z is not None:
-            a.append(x)
-            b.append(y)
-            c.append(z)
-    return a, b, c
+    Store the records of an upload with the parallel ingestion pipeline, see :mod:`entityservice.ingestion`.
 
+    The records are given entity ids in order. The popcount of every encoding is stored alongside it, and once
+    all encodings are inserted the popcount histograms and the ordinals of the encodings within their blocks are
+    updated.
 
-def store_encodings_in_db(conn, dp_id, encodings: Iterator[Tuple[str, bytes, List[str]]], encoding_size: int=128):
+    :param groups: iterable of (encodings, block names) groups of records, see :func:`prepare_encodings`.
+    :param block_lookup: Optional dict mapping the block names of the data provider to their ids, as returned
+        by :func:`entityservice.database.insert_blocking_metadata`. Looked up once if not given.
+    :return: the size of the encodings, None if there are none.
     """
-    Group encodings + blocks into database transactions and execute.
-    """
-
-    for group in _grouper(encodings, n=_estimate_group_size(encoding_size)):
-        encoding_ids, encodings, blocks = _transpose(group)
-        assert len(blocks) == len(encodings), "Block length and encoding length don't match"
-        assert len(encoding_ids) == len(encodings), "Length of encoding ids and encodings don't match"
-        logger.debug("Processing group", num_encoding_ids=len(encoding_ids), num_blocks=len(blocks))
-        insert_encodings_into_blocks(conn, dp_id, block_names=blocks, entity_ids=encoding_ids, encodings=encodings)
+    return ingest_encodings(conn, dp_id, groups, prepare_group, block_lookup=block_lookup)
 
 
-def _estimate_group_size(encoding_size):
+def get_encoding_chunk(conn, chunk_info, encoding_size=128, cache=None):
     """
-    Given an encoding size (e.g. 128 B), estimate the number of encodings that will likely
-    be under 100MiB in data including blocks. Note this is hopefully very conservative
-    in estimating the average number of blocks each record is in.
-    """
-    network_transaction_size = 104857600  # 100MiB
-    blocks_per_record_estimate = 50
-    return math.ceil(network_transaction_size / ((blocks_per_record_estimate * 64) + (encoding_size + 4)))
-
+    Fetch the encodings of a chunk from the database.
 
-def get_encoding_chunk(conn, chunk_info, encoding_size=128):
+    :param cache: Optional :class:`entityservice.cache.block_cache.LocalBlockCache` which is
+        checked before querying the database, and which stores fetched chunks.
+    :return: a tuple of the :class:`EncodingBlock` of the chunk and its length.
+    """
+    if cache is not None:
+        block = cache.get(chunk_info, encoding_size)
+        if block is not None:
+            return block, len(block)
     chunk_range_start, chunk_range_stop = chunk_info['range']
-    dataprovider_id = chunk_info['dataproviderId']
-    block_id = chunk_info['block_id']
-    limit = chunk_range_stop - chunk_range_start
-    encoding_ids = get_encodingblock_ids(conn, dataprovider_id, block_id, chunk_range_start, limit)
-    encoding_iter = get_chunk_of_encodings(conn, dataprovider_id, encoding_ids, stored_binary_size=(encoding_size+4))
-    chunk_data = binary_unpack_filters(encoding_iter, encoding_size=encoding_size)
-    return chunk_data, len(chunk_data)
+    entity_ids, encodings = get_encodings_of_block_range(conn, chunk_info['block_id'], chunk_range_start,
+                                                         chunk_range_stop, encoding_size,
+                                                         popcount_range=chunk_info.get('popcounts'))
+    block = EncodingBlock(entity_ids, encodings)
+    if cache is not None:
+        cache.put(chunk_info, block)
+    return block, len(block)
 
 
 def get_encoding_chunks(conn, package, encoding_size=128):
-    """enrich the chunks in the package with the encodings and entity_ids"""
+    """enrich the chunks in the package with the :class:`EncodingBlock` of their encodings"""
     chunks_per_dp = defaultdict(list)
     for chunk_info_1, chunk_info_2 in package:
         chunks_per_dp[chunk_info_1['dataproviderId']].append(chunk_info_1)
         chunks_per_dp[chunk_info_2['dataproviderId']].append(chunk_info_2)
 
-    encodings_with_ids = {}
+    encoding_blocks = {}
     for dp_id in chunks_per_dp:
         #get all encodings for that dp, save in dict with blockID as key.
         chunks = sorted(chunks_per_dp[dp_id], key=lambda chunk: chunk['block_id'])
         block_ids = [chunk['block_id'] for chunk in chunks]
         values = get_encodings_of_multiple_blocks(conn, dp_id, block_ids)
-
-        bit_packing_struct = binary_format(encoding_size)
-
-        def block_values_iter(values):
-            block_id, entity_id, encoding = next(values)
-            entity_ids = [entity_id]
-            encodings = [binary_unpack_one(encoding, bit_packing_struct)[1]]
-            while True:
-                try:
-                    new_id, n_entity_id, n_encoding = next(values)
-                    if new_id == block_id:
-                        entity_ids.append(n_entity_id)
-                        encodings.append(binary_unpack_one(n_encoding, bit_packing_struct)[1])
-                    else:
-                        yield block_id, entity_ids, encodings
-                        block_id = new_id
-                        entity_ids = [n_entity_id]
-                        encodings = [binary_unpack_one(n_encoding, bit_packing_struct)[1]]
-                except StopIteration:
-                    yield block_id, entity_ids, encodings
-                    break
-
-        for block_id, entity_ids, encodings in block_values_iter(values):
-            encodings_with_ids[(dp_id, block_id)] = (entity_ids, encodings)
+        # the rows are ordered by block id, and the encodings carry their entity id
+        for block_id, rows in itertools.groupby(values, key=operator.itemgetter(0)):
+            encoding_blocks[(dp_id, block_id)] = EncodingBlock.from_binary(
+                b''.join(encoding for _, _, encoding in rows), encoding_size)
 
     for chunk_info_1, chunk_info_2 in package:
-        entity_ids, encodings = encodings_with_ids[(chunk_info_1['dataproviderId'], chunk_info_1['block_id'])]
-        chunk_info_1['encodings'] = encodings
-        chunk_info_1['entity_ids'] = entity_ids
-        entity_ids, encodings = encodings_with_ids[(chunk_info_2['dataproviderId'], chunk_info_2['block_id'])]
-        chunk_info_2['encodings'] = encodings
-        chunk_info_2['entity_ids'] = entity_ids
+        chunk_info_1['encodings'] = encoding_blocks[(chunk_info_1['dataproviderId'], chunk_info_1['block_id'])]
+        chunk_info_2['encodings'] = encoding_blocks[(chunk_info_2['dataproviderId'], chunk_info_2['block_id'])]
 
     return package
 
@@ -177,6 +159,8 @@ def upload_clk_data_binary(project_id, dp_id, encoding_iter, receipt_token, coun
     """
     Save the user provided binary-packed CLK data.
 
+    :param encoding_iter: iterable of (encodings, block names) groups, see :func:`include_encoding_id_in_binary_stream`.
+    :raises ValueError: if the encodings aren't all of the given size.
     """
     filename = None
     # Set the state to 'pending' in the uploads table
@@ -194,45 +178,77 @@ def upload_clk_data_binary(project_id, dp_id, encoding_iter, receipt_token, coun
         db.update_encoding_metadata_set_encoding_size(conn, dp_id, size)
 
         with opentracing.tracer.start_span('create-default-block-in-db', child_of=parent_span):
-            db.insert_blocking_metadata(conn, dp_id, {DEFAULT_BLOCK_ID: count})
+            block_lookup = db.insert_blocking_metadata(conn, dp_id, {DEFAULT_BLOCK_ID: count})
 
         with opentracing.tracer.start_span('upload-encodings-to-db', child_of=parent_span):
-            store_encodings_in_db(conn, dp_id, encoding_iter, size)
+            try:
+                store_encodings_in_db(conn, dp_id, encoding_iter, block_lookup=block_lookup,
+                                      prepare_group=functools.partial(prepare_encodings, encoding_size=size))
+            except Exception as e:
+                logger.warning("Failed while adding encodings to db", exc_info=e)
+                with DBConn() as error_conn:
+                    db.update_dataprovider_uploaded_state(error_conn, project_id, dp_id, 'error')
+                raise
 
         with opentracing.tracer.start_span('update-encoding-metadata', child_of=parent_span):
             db.update_encoding_metadata(conn, filename, dp_id, 'ready')
 
 
-def include_encoding_id_in_binary_stream(stream, size, count):
-    """
-    Inject an encoding_id and default block into a binary stream of encodings.
+def _read_slab(stream, num_bytes):
+    """Read up to num_bytes from a stream, which may return less per read."""
+    slab = stream.read(num_bytes)
+    if len(slab) == num_bytes or not slab:
+        return slab
+    slab = bytearray(slab)
+    while len(slab) < num_bytes:
+        data = stream.read(num_bytes - len(slab))
+        if not data:
+            break
+        slab += data
+    return slab
+
+
+def include_encoding_id_in_binary_stream(stream, size, count, block_names=None):
     """
+    Split a binary stream of encodings into groups for :func:`store_encodings_in_db`.
 
-    binary_formatter = binary_format(size)
+    The encodings of each group are read from the stream in one slab. The encoding ids are
+    assigned in order when storing the encodings.
+
+    :param block_names: Optional list of the block names of each encoding, by default they
+        are all in the default block.
+    """
+    group_size = Config.INGESTION_GROUP_SIZE
 
     def encoding_iterator(filter_stream):
-        # Assumes encoding id and block info not provided (yet)
-        for entity_id in range(count):
-            yield str(entity_id), binary_formatter.pack(entity_id, filter_stream.read(size)), [DEFAULT_BLOCK_ID]
+        for start in range(0, count, group_size):
+            num_encodings = min(group_size, count - start)
+            if block_names is None:
+                group_block_names = [[DEFAULT_BLOCK_ID]] * num_encodings
+            else:
+                group_block_names = block_names[start:start + num_encodings]
+            yield _read_slab(filter_stream, num_encodings * size), group_block_names
 
     return encoding_iterator(stream)
 
 
-def include_encoding_id_in_json_stream(stream, size, count):
+def include_encoding_id_in_json_stream(stream, size, count, block_names=None):
     """
-    Inject an encoding_id and default block into a ijson stream of encodings.
+    Split a ijson stream of base64 encodings into groups for :func:`store_encodings_in_db`.
+    The encoding ids are assigned in order when storing the encodings.
+
     :param stream: ijson object
     :param count: integer
-    :return: generator
+    :param block_names: Optional list of the block names of each encoding, by default they
+        are all in the default block.
+    :return: generator of (base64 encodings, block names) groups
     """
-    binary_formatter = binary_format(size)
 
     def encoding_iterator(filter_stream):
-        # Assumes encoding id and block info not provided (yet)
         for entity_id, encoding in zip(range(count), filter_stream):
-            yield str(entity_id), binary_formatter.pack(entity_id, deserialize_bytes(encoding)), [DEFAULT_BLOCK_ID]
+            yield encoding, [DEFAULT_BLOCK_ID] if block_names is None else block_names[entity_id]
 
-    return encoding_iterator(stream)
+    return group_encodings(encoding_iterator(stream))
 
 
 def hash_block_name(provided_block_name):
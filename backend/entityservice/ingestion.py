@@ -0,0 +1,195 @@
+"""
+Parallel pipeline storing the encodings of an upload in the database.
+
+An upload goes through three stages, connected by bounded queues:
+
+- the parser stage, run by the calling thread, reads the records of the upload and cuts them into
+  groups. Entity ids are assigned in upload order: the records of a group are numbered from the
+  number of records read before it, whichever thread prepares or writes the group.
+- a pool of worker threads prepares the groups for the database: decoding the encodings into the
+  internal binary format, hashing the block names and computing the popcounts.
+- one or more writer threads, each with its own database connection, load the prepared groups with
+  :func:`entityservice.database.insert_encodings_into_blocks`.
+
+The first exception raised by any stage stops the pipeline, the writers roll back their transaction
+and the exception is re-raised in the calling thread. As the writers commit independently, some
+groups may already be committed by then: :func:`ingest_encodings` deletes the encodings of the data
+provider when the pipeline fails, so that the upload can be retried.
+"""
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from structlog import get_logger
+
+from entityservice.comparison import binary_popcounts
+from entityservice.database import DBConn, delete_dataprovider_encodings, get_block_metadata, \
+    insert_encodings_into_blocks, update_block_popcount_histograms, update_block_ordinals
+from entityservice.settings import Config
+
+logger = get_logger()
+
+_DONE = object()
+
+
+def group_records(records, group_size):
+    """Cut an iterable of records into lists of up to ``group_size`` records."""
+    records = iter(records)
+    while True:
+        group = list(itertools.islice(records, group_size))
+        if not group:
+            return
+        yield group
+
+
+def _acquire(semaphore, failed):
+    """Acquire the semaphore, unless the pipeline fails while waiting for it."""
+    while not semaphore.acquire(timeout=0.1):
+        if failed.is_set():
+            return False
+    return not failed.is_set()
+
+
+def run_pipeline(groups, prepare, write, num_workers, num_writers, max_in_flight, connect=DBConn, group_length=len):
+    """
+    Prepare groups of records with a pool of worker threads, and write them with writer threads.
+
+    :param groups: iterable of groups of records, consumed by the calling thread.
+    :param prepare: function called by the workers with the number of records preceding a group and
+        the group, returning the prepared group.
+    :param write: function called by the writers with their connection and a prepared group.
+    :param max_in_flight: maximum number of groups read but not yet written.
+    :param connect: factory of the context managers of the connections of the writers.
+    :param group_length: function returning the number of records of a group.
+    :return: the number of records.
+    :raises Exception: the first exception raised by a stage, once all threads have stopped.
+    """
+    in_flight = threading.Semaphore(max_in_flight)
+    prepared = queue.Queue()
+    failed = threading.Event()
+    errors = []
+    errors_lock = threading.Lock()
+
+    def fail(e):
+        with errors_lock:
+            errors.append(e)
+        failed.set()
+
+    def prepare_group(first_record, group):
+        try:
+            prepared.put(prepare(first_record, group))
+        except Exception as e:
+            fail(e)
+            in_flight.release()
+
+    def write_groups():
+        try:
+            with connect() as conn:
+                # keep draining the queue after a failure, the parser waits for groups to be written
+                while True:
+                    item = prepared.get()
+                    if item is _DONE:
+                        break
+                    try:
+                        if not failed.is_set():
+                            write(conn, item)
+                    except Exception as e:
+                        fail(e)
+                    finally:
+                        in_flight.release()
+                if failed.is_set():
+                    conn.rollback()
+        except Exception as e:
+            fail(e)
+
+    writers = [threading.Thread(target=write_groups, name=f'ingestion-writer-{i}', daemon=True)
+               for i in range(num_writers)]
+    for writer in writers:
+        writer.start()
+
+    num_records = 0
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='ingestion-worker') as executor:
+            for group in groups:
+                if not _acquire(in_flight, failed):
+                    break
+                executor.submit(prepare_group, num_records, group)
+                num_records += group_length(group)
+    except Exception as e:
+        fail(e)
+    finally:
+        # all groups have been prepared once the executor is shut down
+        for _ in writers:
+            prepared.put(_DONE)
+        for writer in writers:
+            writer.join()
+
+    if errors:
+        raise errors[0]
+    return num_records
+
+
+def ingest_encodings(conn, dp_id, groups, prepare_group, block_lookup=None,
+                     num_workers=None, num_writers=None, max_in_flight=None):
+    """
+    Store the encodings of an upload with the ingestion pipeline, then update the popcount histograms
+    and the ordinals of the encodings within their blocks.
+
+    The transaction of ``conn`` is committed first, as the writers need to see the blocks inserted
+    with it. If the pipeline fails, the blocks are kept but the encodings stored by the writers are
+    deleted, callers mark the upload as failed.
+
+    :param groups: iterable of (encodings, block names) groups of records, in upload order. The block
+        names are a list of the block names of each record, the format of the encodings is up to
+        ``prepare_group``.
+    :param prepare_group: function taking the entity id of the first record of a group and the group,
+        and returning a tuple of the entity ids, the encodings packed by
+        :func:`entityservice.serialization.binary_pack_encodings` and the block names of its records.
+    :param block_lookup: Optional dict mapping the block names of the data provider to their ids, as
+        returned by :func:`entityservice.database.insert_blocking_metadata`. Looked up once if not given.
+    :return: the size of the encodings, None if there are none.
+    :raises ValueError: if the encodings don't all have the same size.
+    """
+    if block_lookup is None:
+        block_lookup = {block_name: block_id for block_name, block_id, _ in get_block_metadata(conn, dp_id)}
+    conn.commit()
+
+    encoding_sizes = []
+    encoding_size_lock = threading.Lock()
+
+    def check_encoding_size(encoding_size):
+        with encoding_size_lock:
+            if not encoding_sizes:
+                encoding_sizes.append(encoding_size)
+            elif encoding_size != encoding_sizes[0]:
+                raise ValueError(f"Encodings of {encoding_size} and {encoding_sizes[0]} bytes in the same upload")
+
+    def prepare(first_entity_id, group):
+        entity_ids, encodings, block_names = prepare_group(first_entity_id, group)
+        encoding_size = encodings.dtype.itemsize - 4
+        check_encoding_size(encoding_size)
+        popcounts = binary_popcounts(encodings, encoding_size)
+        return entity_ids, encodings, block_names, popcounts
+
+    def write(writer_conn, prepared):
+        entity_ids, encodings, block_names, popcounts = prepared
+        insert_encodings_into_blocks(writer_conn, dp_id, block_names=block_names, entity_ids=entity_ids,
+                                     encodings=encodings, popcounts=popcounts, block_lookup=block_lookup)
+
+    num_workers = num_workers or Config.INGESTION_WORKERS
+    num_writers = num_writers or Config.INGESTION_DB_WRITERS
+    max_in_flight = max_in_flight or Config.INGESTION_MAX_GROUPS_IN_FLIGHT
+    try:
+        num_encodings = run_pipeline(groups, prepare, write, num_workers, num_writers, max_in_flight,
+                                     group_length=lambda group: len(group[1]))
+    except Exception:
+        logger.warning("Failed to store the encodings, removing those already committed", dp_id=dp_id)
+        delete_dataprovider_encodings(conn, dp_id)
+        raise
+    logger.info("Stored encodings", dp_id=dp_id, num_encodings=num_encodings,
+                num_workers=num_workers, num_writers=num_writers)
+
+    update_block_popcount_histograms(conn, dp_id)
+    update_block_ordinals(conn, dp_id)
+    return encoding_sizes[0] if encoding_sizes else None
@@ -5,7 +5,11 @@ from pytest import raises
 
 from entityservice.database import insert_dataprovider, insert_encodings_into_blocks, insert_blocking_metadata, \
     get_project, get_encodingblock_ids, get_block_metadata, get_chunk_of_encodings, execute_select_query_in_binary,\
-    get_encodings_of_multiple_blocks, update_run_mark_failure, get_run_status, insert_new_run
+    get_encodings_of_multiple_blocks, update_run_mark_failure, get_run_status, insert_new_run, \
+    update_block_popcount_histograms, update_block_ordinals, get_encodings_of_block_range, \
+    get_block_popcount_histograms, get_block_names, get_multi_block_memberships, \
+    insert_similarity_score_file, update_run_mark_complete, get_reusable_similarity_scores, \
+    get_pending_runs_with_lower_threshold, get_created_runs_and_queue, update_run_set_started
 
 from entityservice.integrationtests.dbtests import _get_conn_and_cursor
 from entityservice.models import Project
@@ -136,6 +140,65 @@ class TestInsertions:
         for i, stored_encoding_id in enumerate(stored_encoding_ids):
             assert stored_encoding_id == i + 10
 
+    def test_fetch_chunk_of_popcount_band(self):
+        project_id, project_auth_token, dp_id, dp_auth_token = self._create_project_and_dp()
+        conn, cur = _get_conn_and_cursor()
+        num_entities = 10_000
+        blocks = [['1'] for _ in range(num_entities)]
+        encodings = [generate_bytes(128) for _ in range(num_entities)]
+        popcounts = [i % 100 for i in range(num_entities)]
+
+        insert_encodings_into_blocks(conn, dp_id,
+                                     block_names=blocks,
+                                     entity_ids=list(range(num_entities)),
+                                     encodings=encodings,
+                                     popcounts=popcounts
+                                     )
+        update_block_popcount_histograms(conn, dp_id)
+        conn.commit()
+
+        [(block_id, histogram)] = list(get_block_popcount_histograms(conn, dp_id))
+        assert histogram == {popcount: 100 for popcount in range(100)}
+
+        stored_encoding_ids = list(get_encodingblock_ids(conn, dp_id, block_id, offset=10, limit=20,
+                                                         popcount_range=(10, 19)))
+        assert len(stored_encoding_ids) == 20
+        for stored_encoding_id in stored_encoding_ids:
+            assert 10 <= popcounts[stored_encoding_id] <= 19
+
+    def test_fetch_block_range(self):
+        project_id, project_auth_token, dp_id, dp_auth_token = self._create_project_and_dp()
+        conn, cur = _get_conn_and_cursor()
+        num_entities = 10_000
+        encoding_size = 128
+        blocks = [['1'] for _ in range(num_entities)]
+        raw_encodings = [generate_bytes(encoding_size) for _ in range(num_entities)]
+        bit_packing_struct = binary_format(encoding_size)
+        encodings = [bit_packing_struct.pack(i, raw_encodings[i]) for i in range(num_entities)]
+        popcounts = [i % 100 for i in range(num_entities)]
+
+        insert_encodings_into_blocks(conn, dp_id,
+                                     block_names=blocks,
+                                     entity_ids=list(range(num_entities)),
+                                     encodings=encodings,
+                                     popcounts=popcounts
+                                     )
+        update_block_popcount_histograms(conn, dp_id)
+        update_block_ordinals(conn, dp_id)
+        conn.commit()
+
+        [(block_id, _)] = list(get_block_popcount_histograms(conn, dp_id))
+        # the encodings of a block are ordered by popcount, then entity id
+        expected_entity_ids = sorted(range(num_entities), key=lambda i: (popcounts[i], i))
+        entity_ids, stored_encodings = get_encodings_of_block_range(conn, block_id, 10, 30, encoding_size)
+        assert entity_ids.tolist() == expected_entity_ids[10:30]
+        assert stored_encodings.shape == (20, encoding_size)
+        assert [bytes(encoding) for encoding in stored_encodings] == [raw_encodings[i] for i in entity_ids]
+
+        # the range of a popcount band is relative to the encodings within the band
+        entity_ids, _ = get_encodings_of_block_range(conn, block_id, 90, 110, encoding_size, popcount_range=(10, 19))
+        assert entity_ids.tolist() == expected_entity_ids[1090:1110]
+
     def test_fetch_multiple_blocks(self):
         num_entities = 1000
         blocks = [[str(i)] for i in range(num_entities)]
@@ -165,6 +228,81 @@ class TestInsertions:
         for enc1, enc2 in zip(encodings, ret_encodings):
             assert enc1 == enc2[2]
 
+    def test_multi_block_memberships(self):
+        project, dp_ids = self._create_project()
+        dp_id = dp_ids[0]
+        conn, cur = _get_conn_and_cursor()
+        block_lookup = insert_blocking_metadata(conn, dp_id, {'a': 2, 'b': 2, 'c': 1})
+        conn.commit()
+
+        insert_encodings_into_blocks(conn, dp_id,
+                                     block_names=[['a', 'b'], ['a'], ['b', 'c']],
+                                     entity_ids=[0, 1, 2],
+                                     encodings=[generate_bytes(128) for _ in range(3)],
+                                     block_lookup=block_lookup, batch_size=2
+                                     )
+        conn.commit()
+
+        block_ids = {block_name: block_id for block_name, block_id, _ in get_block_metadata(conn, dp_id)}
+        assert block_ids == block_lookup
+        assert get_block_names(conn, block_ids.values()) == {block_id: name for name, block_id in block_ids.items()}
+        # blocks get their ordinals once all the encodings are inserted
+        update_block_ordinals(conn, dp_id)
+        conn.commit()
+        memberships = get_multi_block_memberships(conn, [(block_ids['a'], 0, 2, None), (block_ids['b'], 0, 2, None),
+                                                         (block_ids['c'], 0, 1, None)])
+        assert memberships == [{0: frozenset({'a', 'b'})},
+                               {0: frozenset({'a', 'b'}), 2: frozenset({'b', 'c'})},
+                               {2: frozenset({'b', 'c'})}]
+        assert get_multi_block_memberships(conn, []) == []
+
+    def test_reusable_similarity_scores(self):
+        project, dp_ids = self._create_project()
+        conn, cur = _get_conn_and_cursor()
+
+        run_ids = {}
+        for threshold, completed in [(0.6, True), (0.7, True), (0.75, False), (0.9, True)]:
+            run_id = insert_new_run(db=conn, run_id=generate_code(), project_id=project.project_id,
+                                    threshold=threshold, name='integrationTest_run', type='testType')
+            insert_similarity_score_file(conn, run_id, f'similarity-scores/{run_id}.bin')
+            if completed:
+                update_run_mark_complete(conn, run_id)
+            run_ids[threshold] = run_id
+        conn.commit()
+
+        assert get_reusable_similarity_scores(conn, project.project_id, 0.5) is None
+        reusable = get_reusable_similarity_scores(conn, project.project_id, 0.8)
+        assert reusable['run'] == run_ids[0.7]
+        assert reusable['threshold'] == 0.7
+        assert reusable['files'] == [f'similarity-scores/{run_ids[0.7]}.bin']
+        assert get_reusable_similarity_scores(conn, project.project_id, 0.9)['run'] == run_ids[0.9]
+
+    def test_pending_runs_with_lower_threshold(self):
+        project, dp_ids = self._create_project()
+        conn, cur = _get_conn_and_cursor()
+
+        run_ids = [insert_new_run(db=conn, run_id=generate_code(), project_id=project.project_id,
+                                  threshold=threshold, name='integrationTest_run', type='testType')
+                   for threshold in [0.8, 0.7, 0.8, 0.9]]
+        queued_runs = get_created_runs_and_queue(conn, project.project_id)
+        assert sorted(queued_runs) == sorted(zip(run_ids, [0.8, 0.7, 0.8, 0.9]))
+        conn.commit()
+
+        def pending(run_id):
+            return set(get_pending_runs_with_lower_threshold(conn, project.project_id, run_id))
+
+        assert pending(run_ids[1]) == set()
+        assert pending(run_ids[0]) == {run_ids[1]}
+        assert pending(run_ids[2]) == {run_ids[0], run_ids[1]}
+        assert pending(run_ids[3]) == {run_ids[0], run_ids[1], run_ids[2]}
+
+        update_run_set_started(conn, run_ids[1])
+        insert_similarity_score_file(conn, run_ids[1], f'similarity-scores/{run_ids[1]}.bin')
+        update_run_mark_failure(conn, run_ids[0], 'integrational fail')
+        conn.commit()
+        assert pending(run_ids[3]) == {run_ids[2]}
+        assert get_reusable_similarity_scores(conn, project.project_id, 0.9)['run'] == run_ids[1]
+
     def test_error_message(self):
         project, dp_ids = self._create_project()
         conn, cur = _get_conn_and_cursor()
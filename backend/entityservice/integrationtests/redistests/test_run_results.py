@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+from entityservice.cache.run_results import add_result_file, start_merge, finish_merge, abort_merge, \
+    take_all_result_files, finish_aggregation, set_outstanding_packages, mark_package_done
+from entityservice.settings import Config
+
+
+class TestRunResults:
+
+    def test_merge_result_files(self):
+        run_id = 'test_merge_result_files'
+        assert add_result_file(run_id, 1, 10, 'a') == 1
+        assert add_result_file(run_id, 2, 20, 'b') == 2
+        assert add_result_file(run_id, 3, 30, 'c') == 3
+
+        assert start_merge(run_id, 'm1', 4) is None
+        files = start_merge(run_id, 'm1', 2)
+        assert files == [(1, 10, 'a', ['a']), (2, 20, 'b', ['b'])]
+        # files being merged aren't returned
+        assert take_all_result_files(run_id) is None
+
+        assert finish_merge(run_id, 'm1', 3, 30, 'ab', ['a', 'b']) == 2
+        assert take_all_result_files(run_id) == [(3, 30, 'c', ['c']), (3, 30, 'ab', ['a', 'b'])]
+        # a retried aggregation gets the same files
+        assert take_all_result_files(run_id) == [(3, 30, 'c', ['c']), (3, 30, 'ab', ['a', 'b'])]
+        finish_aggregation(run_id)
+        assert take_all_result_files(run_id) == []
+
+    def test_expired_merge(self):
+        run_id = 'test_expired_merge'
+        expired = SimpleNamespace(AGGREGATION_MERGE_LEASE_SECONDS=-1, CACHE_EXPIRY=Config.CACHE_EXPIRY)
+        add_result_file(run_id, 1, 10, 'a')
+        add_result_file(run_id, 2, 20, 'b')
+        assert len(start_merge(run_id, 'm1', 2)) == 2
+        # the files of the merge are put back once its lease has expired
+        assert take_all_result_files(run_id, config=expired) == [(1, 10, 'a', ['a']), (2, 20, 'b', ['b'])]
+        assert finish_merge(run_id, 'm1', 3, 30, 'ab', ['a', 'b']) is None
+
+    def test_result_file_recorded_once(self):
+        run_id = 'test_result_file_recorded_once'
+        assert add_result_file(run_id, 1, 10, 'a') == 1
+        assert add_result_file(run_id, 1, 10, 'a') == 1
+        assert add_result_file(run_id, 2, 20, 'b') == 2
+        assert take_all_result_files(run_id) == [(1, 10, 'a', ['a']), (2, 20, 'b', ['b'])]
+
+    def test_abort_merge(self):
+        run_id = 'test_abort_merge'
+        add_result_file(run_id, 1, 10, 'a')
+        add_result_file(run_id, 2, 20, 'b')
+        assert len(start_merge(run_id, 'm1', 2)) == 2
+        abort_merge(run_id, 'm1')
+        assert take_all_result_files(run_id) == [(1, 10, 'a', ['a']), (2, 20, 'b', ['b'])]
+
+    def test_outstanding_packages(self):
+        run_id = 'test_outstanding_packages'
+        set_outstanding_packages(run_id, 3)
+        assert mark_package_done(run_id, 0) == 2
+        assert mark_package_done(run_id, 2) == 1
+        # a package computed twice is only counted once
+        assert mark_package_done(run_id, 2) is None
+        assert mark_package_done(run_id, 1) == 0
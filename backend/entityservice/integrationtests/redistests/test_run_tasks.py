@@ -0,0 +1,20 @@
+from entityservice.cache.active_runs import is_run_active, set_run_state_active, set_run_state_error
+from entityservice.cache.run_tasks import add_run_task_ids, take_run_task_ids
+
+
+class TestRunTasks:
+
+    def test_take_run_task_ids(self):
+        run_id = 'test_take_run_task_ids'
+        add_run_task_ids(run_id, ['a', 'b'])
+        add_run_task_ids(run_id, ['c'])
+        add_run_task_ids(run_id, [])
+        assert sorted(take_run_task_ids(run_id)) == ['a', 'b', 'c']
+        assert take_run_task_ids(run_id) == []
+
+    def test_failed_run_is_inactive(self):
+        run_id = 'test_failed_run_is_inactive'
+        set_run_state_active(run_id)
+        assert is_run_active(run_id)
+        set_run_state_error(run_id)
+        assert not is_run_active(run_id)
@@ -0,0 +1,20 @@
+from entityservice.cache.connection import connect_to_redis
+from entityservice.cache.task_timings import save_task_timings, get_cost_model, MAX_SAMPLES, FETCH_KEY, \
+    COMPARE_KEY, OVERHEAD_KEY
+
+
+class TestTaskTimings:
+
+    def test_fits_decayed_once(self):
+        r = connect_to_redis()
+        r.delete(FETCH_KEY, COMPARE_KEY, OVERHEAD_KEY)
+        for _ in range(MAX_SAMPLES + 2):
+            save_task_timings(0.1, 1000, [(10_000, 0.2), (20_000, 0.4)], 0.05)
+
+        assert get_cost_model() is not None
+        assert float(r.hget(OVERHEAD_KEY, 'n')) == (MAX_SAMPLES + 2) / 2
+        # two chunks per task
+        assert float(r.hget(COMPARE_KEY, 'n')) == 2 * (MAX_SAMPLES + 2) / 2
+        # below the limit again, the fits are left as they are
+        get_cost_model()
+        assert float(r.hget(OVERHEAD_KEY, 'n')) == (MAX_SAMPLES + 2) / 2
@@ -0,0 +1,101 @@
+"""
+Split blocks into bands of encodings with similar popcounts.
+
+The Dice coefficient of two encodings with popcounts ``pa`` and ``pb`` is at most
+``2 * min(pa, pb) / (pa + pb)``. Given the popcount histogram of a block, we can split
+it into bands of popcounts and skip every pair of bands that can't reach the threshold.
+
+A band is a 3-tuple ``(lowest popcount, highest popcount, number of encodings)``.
+"""
+import math
+
+
+def max_dice_coefficient(band0, band1):
+    """Upper bound of the Dice coefficient between any encodings of two bands."""
+    lo0, hi0 = band0[0], band0[1]
+    lo1, hi1 = band1[0], band1[1]
+    if lo0 <= hi1 and lo1 <= hi0:
+        # overlapping popcount ranges
+        return 1.0
+    smaller, larger = (hi0, lo1) if hi0 < lo1 else (hi1, lo0)
+    return 2 * smaller / (smaller + larger)
+
+
+def split_into_bands(histogram, band_size):
+    """
+    Greedily group consecutive popcounts until each band holds at least ``band_size`` encodings.
+
+    :param histogram: dict mapping popcount to the number of encodings with that popcount.
+    :param band_size: The desired number of encodings per band.
+    :return: list of bands, in increasing order of popcount.
+    """
+    bands = []
+    band_start = None
+    count = 0
+    for popcount in sorted(histogram):
+        if band_start is None:
+            band_start = popcount
+        count += histogram[popcount]
+        if count >= band_size:
+            bands.append((band_start, popcount, count))
+            band_start = None
+            count = 0
+    if count:
+        bands.append((band_start, max(histogram), count))
+    return bands
+
+
+def _block_band(histogram, size):
+    """Return the band covering a whole block, or None if the histogram can't be trusted."""
+    if not histogram or sum(histogram.values()) != size:
+        return None
+    return min(histogram), max(histogram), size
+
+
+def plan_block_comparisons(histogram0, size0, histogram1, size1, threshold, chunk_size_aim):
+    """
+    Work out which parts of two blocks need to be compared.
+
+    Blocks that don't require more than ``chunk_size_aim`` comparisons are compared as a
+    whole, unless their popcounts rule out any similarity above the threshold. Larger blocks
+    are split into popcount bands, sized such that a pair of bands requires about
+    ``chunk_size_aim`` comparisons, and only the pairs of bands that could reach the
+    threshold are returned.
+
+    :param histogram0: popcount histogram of the first block, or None if unknown.
+    :param size0: number of encodings in the first block.
+    :param histogram1: popcount histogram of the second block, or None if unknown.
+    :param size1: number of encodings in the second block.
+    :param threshold: the similarity threshold of the run, or None to disable banding.
+    :param chunk_size_aim: the desired number of comparisons per chunk.
+    :return: list of (band0, band1) pairs to compare. ``(None, None)`` stands for comparing
+        the whole blocks.
+    """
+    block_band0 = _block_band(histogram0, size0)
+    block_band1 = _block_band(histogram1, size1)
+    if threshold is None or threshold <= 0 or block_band0 is None or block_band1 is None:
+        return [(None, None)]
+    if max_dice_coefficient(block_band0, block_band1) < threshold:
+        return []
+    if size0 * size1 <= chunk_size_aim:
+        return [(None, None)]
+
+    # Same sizing strategy as anonlink's split_to_chunks
+    num_bands0 = max(1, round(size0 / math.sqrt(chunk_size_aim)))
+    band_size0 = size0 / num_bands0
+    num_bands1 = max(1, round(size1 * band_size0 / chunk_size_aim))
+    bands0 = split_into_bands(histogram0, band_size0)
+    bands1 = split_into_bands(histogram1, size1 / num_bands1)
+    return [(band0, band1) for band0 in bands0 for band1 in bands1
+            if max_dice_coefficient(band0, band1) >= threshold]
+
+
+def count_planned_comparisons(band_pairs, size0, size1):
+    """Number of comparisons required by the band pairs returned from :func:`plan_block_comparisons`."""
+    total = 0
+    for band0, band1 in band_pairs:
+        if band0 is None:
+            total += size0 * size1
+        else:
+            total += band0[2] * band1[2]
+    return total
@@ -0,0 +1,153 @@
+"""
+Pre-flight estimates of the cost of a run, computed before the run consumes the cluster.
+
+- The number of comparisons is exact, it is computed from the block metadata in the same way as
+  when the comparison tasks are created.
+- The number of candidate pairs is estimated by comparing a random sample of pairs of blocks at the
+  run's threshold. Pairs of blocks are sampled with a probability proportional to their number of
+  comparisons left after the popcount banding, and large blocks are only compared in part. The rate
+  of candidate pairs is measured per remaining comparison, so that it applies to the exact number of
+  comparisons.
+- The duration is estimated from the latest comparison rate of the deployment, recorded in the
+  ``metrics`` table.
+"""
+import itertools
+import math
+import random
+
+from entityservice.comparison import compare_encodings
+from entityservice.database import get_dataprovider_ids, get_block_metadata, get_project_encoding_size, \
+    get_total_comparisons_for_project, get_latest_rate, get_project_column, get_block_popcount_histograms
+from entityservice.encoding_storage import get_encoding_chunk
+from entityservice.popcount_banding import plan_block_comparisons, count_planned_comparisons
+from entityservice.settings import Config
+
+# Number of pairs of blocks compared to estimate the number of candidate pairs.
+NUM_SAMPLED_BLOCK_PAIRS = 20
+
+# Bytes taken by a candidate pair: its similarity and the dataset and record indices of its records.
+CANDIDATE_PAIR_BYTES = 8 + 4 * 4
+
+
+def _get_block_pairs(conn, dp_ids, threshold, chunk_size_aim):
+    """
+    Return the pairs of blocks to compare, as (number of comparisons, chunk of the first block,
+    chunk of the second block) for each pair of data providers sharing a block.
+
+    The number of comparisons leaves out the comparisons ruled out by the popcount histograms of the
+    blocks, as :func:`entityservice.database.get_total_comparisons_for_project` does. Pairs of blocks
+    without any comparison left are not returned.
+    """
+    dp_blocks = {}
+    dp_histograms = {}
+    for dp_index, dp_id in enumerate(dp_ids):
+        dp_blocks[dp_id] = {block_name: {'dataproviderId': dp_id, 'datasetIndex': dp_index,
+                                         'block_id': block_id, 'range': (0, count)}
+                            for block_name, block_id, count in get_block_metadata(conn, dp_id) if count > 0}
+        dp_histograms[dp_id] = dict(get_block_popcount_histograms(conn, dp_id))
+    block_pairs = []
+    for dp1, dp2 in itertools.combinations(dp_ids, 2):
+        for block_name in dp_blocks[dp1].keys() & dp_blocks[dp2].keys():
+            chunk1, chunk2 = dp_blocks[dp1][block_name], dp_blocks[dp2][block_name]
+            size1, size2 = chunk1['range'][1], chunk2['range'][1]
+            band_pairs = plan_block_comparisons(dp_histograms[dp1].get(chunk1['block_id']), size1,
+                                                dp_histograms[dp2].get(chunk2['block_id']), size2,
+                                                threshold, chunk_size_aim)
+            num_comparisons = count_planned_comparisons(band_pairs, size1, size2)
+            if num_comparisons > 0:
+                block_pairs.append((num_comparisons, chunk1, chunk2))
+    return block_pairs
+
+
+def _sample_chunk(chunk, size, rng):
+    """A random range of up to ``size`` encodings of a block."""
+    count = chunk['range'][1]
+    if count <= size:
+        return chunk
+    start = rng.randrange(count - size + 1)
+    return dict(chunk, range=(start, start + size))
+
+
+def estimate_candidate_rate(conn, block_pairs, threshold, encoding_size, sample_comparisons, rng=None):
+    """
+    Estimate the proportion of the comparisons of the given pairs of blocks which yield a candidate pair.
+
+    The sampled ranges of the blocks are compared in full, the comparisons ruled out by the popcounts
+    have no candidate pairs: the rate of each sampled pair of blocks is scaled from all the comparisons
+    of the blocks to the number of comparisons given in ``block_pairs``.
+
+    :param block_pairs: list of (number of comparisons, chunk, chunk), see :func:`_get_block_pairs`.
+    :param sample_comparisons: the maximum number of comparisons to compute.
+    :return: (estimated proportion, number of comparisons computed)
+    """
+    if rng is None:
+        rng = random.Random()
+    if not block_pairs:
+        return 0.0, 0
+    weights = [num_comparisons for num_comparisons, _, _ in block_pairs]
+    samples = rng.choices(block_pairs, weights=weights, k=NUM_SAMPLED_BLOCK_PAIRS)
+    side = max(1, int(math.sqrt(sample_comparisons / NUM_SAMPLED_BLOCK_PAIRS)))
+    rates = []
+    num_compared = 0
+    for num_comparisons, chunk1, chunk2 in samples:
+        all_comparisons = chunk1['range'][1] * chunk2['range'][1]
+        chunk1, chunk2 = _sample_chunk(chunk1, side, rng), _sample_chunk(chunk2, side, rng)
+        encodings1, _ = get_encoding_chunk(conn, chunk1, encoding_size)
+        encodings2, _ = get_encoding_chunk(conn, chunk2, encoding_size)
+        if not encodings1 or not encodings2:
+            continue
+        sims, _, _ = compare_encodings(encodings1, encodings2, threshold,
+                                       k=min(len(encodings1), len(encodings2)))
+        rates.append(len(sims) / (len(encodings1) * len(encodings2)) * all_comparisons / num_comparisons)
+        num_compared += len(encodings1) * len(encodings2)
+    if not rates:
+        return 0.0, 0
+    return sum(rates) / len(rates), num_compared
+
+
+def estimate_run(conn, project_id, threshold, sample_comparisons=None, rng=None):
+    """
+    Estimate the cost of a run of the project with the given threshold.
+
+    The estimated number of candidate pairs is an upper bound if records belong to several blocks,
+    as candidate pairs found in several blocks are counted each time.
+
+    :return: dict with the number of ``comparisons``, the number of ``sampled_comparisons`` computed for the
+        estimate, and the estimated number of ``candidate_pairs``, duration in ``seconds`` (None if the
+        comparison rate of the deployment is unknown), ``peak_memory_bytes`` needed to hold the candidate
+        pairs and the encodings of the chunks compared at once, and the names of the limits of the service
+        the run would exceed (``exceeded_limits``).
+    """
+    if sample_comparisons is None:
+        sample_comparisons = Config.RUN_ESTIMATE_SAMPLE_COMPARISONS
+    dp_ids = get_dataprovider_ids(conn, project_id)
+    encoding_size = get_project_encoding_size(conn, project_id)
+    result_type = get_project_column(conn, project_id, 'result_type')
+    chunk_size_aim = Config.CHUNK_SIZE_AIM
+    comparisons = get_total_comparisons_for_project(conn, project_id, threshold=threshold,
+                                                    chunk_size_aim=chunk_size_aim)
+
+    block_pairs = _get_block_pairs(conn, dp_ids, threshold, chunk_size_aim)
+    rate, sampled_comparisons = estimate_candidate_rate(conn, block_pairs, threshold, encoding_size,
+                                                        sample_comparisons, rng=rng)
+    candidate_pairs = int(rate * comparisons)
+    # Each comparison task holds the encodings of two chunks of about sqrt(chunk_size_aim) encodings.
+    chunk_memory_bytes = 2 * int(math.sqrt(chunk_size_aim)) * encoding_size * Config.CELERYD_CONCURRENCY
+
+    comparison_rate = get_latest_rate(conn, default=None)
+    seconds = comparisons / comparison_rate if comparison_rate else None
+
+    exceeded_limits = []
+    if candidate_pairs > Config.SIMILARITY_SCORES_MAX_CANDIDATE_PAIRS:
+        exceeded_limits.append('SIMILARITY_SCORES_MAX_CANDIDATE_PAIRS')
+    if result_type != 'similarity_scores' and candidate_pairs > Config.SOLVER_MAX_CANDIDATE_PAIRS:
+        exceeded_limits.append('SOLVER_MAX_CANDIDATE_PAIRS')
+
+    return {
+        'comparisons': comparisons,
+        'sampled_comparisons': sampled_comparisons,
+        'candidate_pairs': candidate_pairs,
+        'seconds': seconds,
+        'peak_memory_bytes': candidate_pairs * CANDIDATE_PAIR_BYTES + chunk_memory_bytes,
+        'exceeded_limits': exceeded_limits,
+    }
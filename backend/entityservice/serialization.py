@@ -1,22 +1,30 @@
 
+import contextlib
 import typing
 import urllib3
 
 import base64
+import binascii
 import struct
 
 import anonlink
+import numpy as np
 from flask import Response
 from structlog import get_logger
 
 from entityservice.object_store import connect_to_object_store
 from entityservice.settings import Config as config
-from entityservice.utils import chunks, safe_fail_request
+from entityservice.utils import chunks, safe_fail_request, iterable_to_stream, unique_values_iter
 import concurrent.futures
 
 
 logger = get_logger()
 
+# Header of the candidate pairs files of anonlink.serialization: version, then the sizes of
+# the similarity, dataset index and record index of each entry.
+_CANDIDATE_PAIRS_HEADER = struct.Struct('<BBBB')
+_SIMILARITY_FORMATS = {2: '<e', 4: '<f', 8: '<d'}
+
 
 def bytes_to_list(python_object):
     if isinstance(python_object, bytes):
@@ -34,6 +42,22 @@ def deserialize_bytes(bytes_data):
     return base64.b64decode(bytes_data)
 
 
+def deserialize_bytes_batch(b64_encodings):
+    """
+    Decode a batch of base64 encoded encodings of the same size into one array.
+
+    :param b64_encodings: list of base64 strings.
+    :return: ``(n, encoding_size)`` uint8 array of the decoded encodings.
+    :raises ValueError: if the encodings don't all have the same size.
+    """
+    decoded = list(map(binascii.a2b_base64, b64_encodings))
+    encoding_sizes = set(map(len, decoded))
+    if len(encoding_sizes) > 1:
+        raise ValueError("Encodings don't all have the same size")
+    encoding_size = encoding_sizes.pop() if encoding_sizes else 0
+    return np.frombuffer(b''.join(decoded), dtype=np.uint8).reshape(len(decoded), encoding_size)
+
+
 def binary_format(encoding_size):
     """
     Return a Struct instance with the binary format of the encodings.
@@ -54,6 +78,27 @@ def binary_format(encoding_size):
     return bit_packing_struct
 
 
+def binary_format_dtype(encoding_size):
+    """
+    Return the numpy structured dtype of encodings in the binary format, see :func:`binary_format`.
+    """
+    return np.dtype([('entity_id', '>u4'), ('encoding', 'u1', (encoding_size,))])
+
+
+def binary_pack_encodings(entity_ids, encodings):
+    """
+    Pack encodings into the binary format, writing them with their entity ids into one array.
+
+    :param entity_ids: sequence of the entity ids.
+    :param encodings: ``(n, encoding_size)`` uint8 array of the encodings.
+    :return: array of :func:`binary_format_dtype`, whose buffer holds the packed encodings back to back.
+    """
+    packed = np.empty(len(encodings), dtype=binary_format_dtype(encodings.shape[1]))
+    packed['entity_id'] = entity_ids
+    packed['encoding'] = encodings
+    return packed
+
+
 def binary_pack_filters(filters, encoding_size):
     """Efficient packing of bloomfilters.
 
@@ -145,15 +190,112 @@ def get_similarity_scores(filename):
     logger.info("Starting download stream of similarity scores.", filename=filename, filesize=details.size)
 
     try:
-        candidate_pair_binary_stream = mc.get_object(config.MINIO_BUCKET, filename)
+        with contextlib.ExitStack() as responses:
+            candidate_pair_binary_stream = _open_object(responses, mc, config.MINIO_BUCKET, filename)
+            response = Response(generate_scores(candidate_pair_binary_stream), mimetype='application/json')
+            response.call_on_close(responses.pop_all().close)
 
-        return Response(generate_scores(candidate_pair_binary_stream), mimetype='application/json')
+        return response
 
     except urllib3.exceptions.ResponseError:
         logger.warning("Attempt to read the similarity scores file failed with an error response.", filename=filename)
         safe_fail_request(500, "Failed to retrieve similarity scores")
 
 
+def get_sharded_similarity_scores(filenames):
+    """
+    Return a response that will stream the similarity scores of a sharded result,
+    merged back into a single sorted list.
+
+    :param filenames: names of the shards, from the manifest of the result.
+    :return: the similarity scores in a streaming JSON response.
+    """
+    mc = connect_to_object_store()
+    logger.info("Starting download stream of sharded similarity scores.", num_shards=len(filenames))
+
+    try:
+        # the shards opened so far are closed if opening the next one fails
+        with contextlib.ExitStack() as responses:
+            shard_streams = [_open_object(responses, mc, config.MINIO_BUCKET, filename) for filename in filenames]
+            merged_iter, _ = anonlink.serialization.merge_streams_iter(shard_streams)
+            candidate_pair_binary_stream = iterable_to_stream(unique_values_iter(merged_iter))
+            response = Response(generate_scores(candidate_pair_binary_stream), mimetype='application/json')
+            response.call_on_close(responses.pop_all().close)
+
+        return response
+
+    except urllib3.exceptions.ResponseError:
+        logger.warning("Attempt to read the similarity scores shards failed with an error response.")
+        safe_fail_request(500, "Failed to retrieve similarity scores")
+
+
+def _open_object(exit_stack, mc, bucket, filename):
+    """Open an object of the object store, to be closed and its connection released with the exit stack."""
+    response = mc.get_object(bucket, filename)
+    exit_stack.callback(response.release_conn)
+    exit_stack.callback(response.close)
+    return response
+
+
+def _read_object_range(mc, bucket, filename, offset, length):
+    response = mc.get_object(bucket, filename, offset=offset, length=length)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def summarize_candidate_pairs_file(mc, bucket, filename):
+    """
+    Describe a candidate pairs file in the object store, only reading its first and last similarity scores.
+
+    :return: dict with the ``file`` name, its ``size`` in bytes, the number of candidate pairs (``count``)
+        and the ``similarity_range`` [min, max] of their scores (None if there are no candidate pairs).
+    """
+    size = mc.stat_object(bucket, filename).size
+    header = _read_object_range(mc, bucket, filename, 0, _CANDIDATE_PAIRS_HEADER.size)
+    _, sim_size, dset_i_size, rec_i_size = _CANDIDATE_PAIRS_HEADER.unpack(header)
+    entry_size = sim_size + 2 * dset_i_size + 2 * rec_i_size
+    count = (size - _CANDIDATE_PAIRS_HEADER.size) // entry_size
+    similarity_range = None
+    if count:
+        # entries are sorted by decreasing similarity
+        sim_struct = struct.Struct(_SIMILARITY_FORMATS[sim_size])
+        first_offset = _CANDIDATE_PAIRS_HEADER.size
+        last_offset = first_offset + (count - 1) * entry_size
+        max_sim, = sim_struct.unpack(_read_object_range(mc, bucket, filename, first_offset, sim_size))
+        min_sim, = sim_struct.unpack(_read_object_range(mc, bucket, filename, last_offset, sim_size))
+        similarity_range = [min_sim, max_sim]
+    return {'file': filename, 'size': size, 'count': count, 'similarity_range': similarity_range}
+
+
+def find_candidate_pairs_above_threshold(mc, bucket, filename, threshold):
+    """
+    Find the candidate pairs of a file in the object store with a similarity of at least ``threshold``.
+
+    As entries are sorted by decreasing similarity, these are a prefix of the file, found with
+    a binary search reading a single similarity score at each step.
+
+    :return: (number of candidate pairs, length in bytes of the file prefix holding them).
+    """
+    size = mc.stat_object(bucket, filename).size
+    header = _read_object_range(mc, bucket, filename, 0, _CANDIDATE_PAIRS_HEADER.size)
+    _, sim_size, dset_i_size, rec_i_size = _CANDIDATE_PAIRS_HEADER.unpack(header)
+    entry_size = sim_size + 2 * dset_i_size + 2 * rec_i_size
+    sim_struct = struct.Struct(_SIMILARITY_FORMATS[sim_size])
+    low, high = 0, (size - _CANDIDATE_PAIRS_HEADER.size) // entry_size
+    while low < high:
+        middle = (low + high) // 2
+        offset = _CANDIDATE_PAIRS_HEADER.size + middle * entry_size
+        sim, = sim_struct.unpack(_read_object_range(mc, bucket, filename, offset, sim_size))
+        if sim >= threshold:
+            low = middle + 1
+        else:
+            high = middle
+    return low, _CANDIDATE_PAIRS_HEADER.size + low * entry_size
+
+
 def get_chunk_from_object_store(chunk_info, encoding_size=128):
     mc = connect_to_object_store()
     bit_packed_element_size = binary_format(encoding_size).size
@@ -4,6 +4,7 @@ Config shared between the application backend and the celery workers.
 import datetime
 import os
 import ast
+import tempfile
 
 
 def _parse_if_string(obj_as_string):
@@ -86,6 +87,8 @@ class Config(object):
         'entityservice.tasks.comparing.create_comparison_jobs': {'queue': 'celery'},
         'entityservice.tasks.comparing.compute_filter_similarity': {'queue': 'compute'},
         'entityservice.tasks.comparing.aggregate_comparisons': {'queue': 'highmemory'},
+        'entityservice.tasks.comparing.merge_comparison_results': {'queue': 'highmemory'},
+        'entityservice.tasks.comparing.reuse_similarity_scores': {'queue': 'highmemory'},
         'entityservice.tasks.solver.solver_task': {'queue': 'highmemory'},
         'entityservice.tasks.permutation.save_and_permute': {'queue': 'highmemory'},
         'entityservice.tasks.encoding_uploading.pull_external_data': {'queue': 'highmemory'},
@@ -93,6 +96,21 @@ class Config(object):
     }
     CELERY_ROUTES = _parse_if_string(os.getenv("CELERY_ROUTES", default_routes))
 
+    # How the completion of the comparison tasks of a run is tracked. One of:
+    # - "chord": a celery chord runs the aggregation once all the comparison tasks are done.
+    # - "redis": each comparison task records its completion in redis, and the last one schedules the
+    #   aggregation. Tasks are sent in batches, which suits runs with tens of thousands of packages.
+    COMPLETION_TRACKING = os.getenv('COMPLETION_TRACKING', 'chord').lower()
+
+    # Route comparison tasks sharing a chunk of encodings to the same worker, through each worker's
+    # direct queue. Workers and the scheduler need to agree on this setting.
+    LOCALITY_AWARE_ROUTING = os.getenv('LOCALITY_AWARE_ROUTING', 'false').lower() == 'true'
+
+    # While a run is active, check every this many seconds whether the workers its comparison tasks were
+    # routed to are still alive. The tasks waiting in the direct queue of a stopped worker are moved to
+    # the shared queue.
+    LOCALITY_ROUTING_CHECK_SECONDS = int(os.getenv('LOCALITY_ROUTING_CHECK_SECONDS', '60'))
+
     CELERYD_PREFETCH_MULTIPLIER = int(os.getenv('CELERYD_PREFETCH_MULTIPLIER', '1'))
     CELERYD_MAX_TASKS_PER_CHILD = int(os.getenv('CELERYD_MAX_TASKS_PER_CHILD', '2048'))
     # number of concurrent worker processes/threads, executing tasks
@@ -102,6 +120,58 @@ class Config(object):
     # Number of comparisons per chunk (on average).
     CHUNK_SIZE_AIM = int(os.getenv('CHUNK_SIZE_AIM', '300_000_000'))
 
+    # Desired duration of a comparison task in seconds. Once enough comparison tasks have reported their
+    # timings, work packages are sized to take that long instead of using CHUNK_SIZE_AIM. 0 disables this.
+    TASK_DURATION_AIM = float(os.getenv('TASK_DURATION_AIM', '30'))
+
+    # Start a speculative copy of a comparison task if it runs for more than this factor times its
+    # estimated duration. The first copy to finish wins. 0 disables speculative execution.
+    SPECULATIVE_EXECUTION_FACTOR = float(os.getenv('SPECULATIVE_EXECUTION_FACTOR', '0'))
+
+    # Number of chunks a comparison task holds in memory at once. While a chunk is compared, the
+    # following ones are fetched from the database and the results of the previous ones are written out.
+    COMPARISON_PIPELINE_DEPTH = max(1, int(os.getenv('COMPARISON_PIPELINE_DEPTH', '2')))
+
+    # Implementation used to compare encodings. One of:
+    # - "anonlink": anonlink's accelerated Dice coefficient, falling back to "numpy" if it can't be used.
+    # - "numpy": vectorized Dice coefficient skipping pairs ruled out by their popcounts.
+    # - "auto": pick the implementation expected to be faster for each chunk.
+    COMPARISON_KERNEL = os.getenv('COMPARISON_KERNEL', 'auto').lower()
+
+    # Number of threads a comparison task may use to compare a large chunk, split into tiles of rows.
+    # Running fewer worker processes (CELERYD_CONCURRENCY) with more threads each keeps a single copy of
+    # the encodings in memory.
+    COMPARISON_THREADS_PER_TASK = max(1, int(os.getenv('COMPARISON_THREADS_PER_TASK', '1')))
+
+    # Create the similarity scores of a new run by filtering those of a completed run of the same project
+    # with a lower or equal threshold, instead of comparing all the entities again. Also lets runs of a
+    # project with different thresholds wait for each other to share a comparison pass. Turning this on
+    # changes which objects a run reads: its similarity scores come from another run's result files.
+    REUSE_SIMILARITY_SCORES = os.getenv('REUSE_SIMILARITY_SCORES', 'false').lower() == 'true'
+
+    # Maximum number of seconds a run waits for the similarity scores of runs of the same project with lower
+    # thresholds, before comparing the entities itself.
+    COALESCED_RUN_MAX_WAIT_SECONDS = int(os.getenv('COALESCED_RUN_MAX_WAIT_SECONDS', '7200'))
+
+    # Maximum number of result files of comparison tasks merged at once during aggregation.
+    # Each of them is streamed from the object store concurrently. Once that many result files are
+    # waiting, they are merged while the comparisons of the run are still running.
+    AGGREGATION_MAX_FAN_IN = int(os.getenv('AGGREGATION_MAX_FAN_IN', '64'))
+
+    # Seconds a merge of waiting result files may take. The files of a merge still unfinished after
+    # that, e.g. because its worker died, are put back to be merged again.
+    AGGREGATION_MERGE_LEASE_SECONDS = int(os.getenv('AGGREGATION_MERGE_LEASE_SECONDS', '1800'))
+
+    # Keep the similarity scores of "similarity_scores" projects as up to AGGREGATION_MAX_FAN_IN sorted
+    # shards described by a manifest, instead of merging them into a single file.
+    SIMILARITY_SCORES_SHARDED = os.getenv('SIMILARITY_SCORES_SHARDED', 'false').lower() == 'true'
+
+    # Node local cache of chunks of encodings, shared by the compute workers of a host.
+    # Set BLOCK_CACHE_MAX_BYTES to 0 to disable.
+    BLOCK_CACHE_DIR = os.getenv('BLOCK_CACHE_DIR', os.path.join(
+        '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'entityservice-block-cache'))
+    BLOCK_CACHE_MAX_BYTES = int(os.getenv('BLOCK_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
     # If there are more than 1M CLKS, don't cache them in redis
     MAX_CACHE_SIZE = int(os.getenv('MAX_CACHE_SIZE', '1000000'))
 
@@ -111,6 +181,24 @@ class Config(object):
     SOLVER_MAX_CANDIDATE_PAIRS = int(os.getenv('SOLVER_MAX_CANDIDATE_PAIRS', '100_000_000'))
     SIMILARITY_SCORES_MAX_CANDIDATE_PAIRS = int(os.getenv('SIMILARITY_SCORES_MAX_CANDIDATE_PAIRS', '500_000_000'))
 
+    # Maximum number of comparisons computed on a sample of the blocks to estimate the number of
+    # candidate pairs of a run before it starts.
+    RUN_ESTIMATE_SAMPLE_COMPARISONS = int(os.getenv('RUN_ESTIMATE_SAMPLE_COMPARISONS', '2_000_000'))
+    # Same for the estimates requested through the REST API, computed while the request waits.
+    RUN_ESTIMATE_HTTP_SAMPLE_COMPARISONS = int(os.getenv('RUN_ESTIMATE_HTTP_SAMPLE_COMPARISONS', '100_000'))
+    # Fail runs estimated to exceed the above limits before computing any comparison.
+    REJECT_RUNS_OVER_LIMITS = os.getenv('REJECT_RUNS_OVER_LIMITS', 'false').lower() == 'true'
+
+    # Uploads are stored by a pipeline of threads: INGESTION_WORKERS threads decode the encodings and hash
+    # their block names, and INGESTION_DB_WRITERS threads load them into the database, each with its own
+    # connection. Keep INGESTION_DB_WRITERS below CELERY_DB_MAX_CONNECTIONS and FLASK_DB_MAX_CONNECTIONS.
+    INGESTION_WORKERS = max(1, int(os.getenv('INGESTION_WORKERS', '2')))
+    INGESTION_DB_WRITERS = max(1, int(os.getenv('INGESTION_DB_WRITERS', '2')))
+    # Number of encodings in each group of records going through the pipeline, and maximum number of
+    # groups read from an upload but not yet stored.
+    INGESTION_GROUP_SIZE = int(os.getenv('INGESTION_GROUP_SIZE', '10_000'))
+    INGESTION_MAX_GROUPS_IN_FLIGHT = int(os.getenv('INGESTION_MAX_GROUPS_IN_FLIGHT', '8'))
+
     _CACHE_EXPIRY_SECONDS = int(os.getenv('CACHE_EXPIRY_SECONDS', datetime.timedelta(days=10).total_seconds()))
     CACHE_EXPIRY = datetime.timedelta(seconds=_CACHE_EXPIRY_SECONDS)
 
@@ -119,6 +207,8 @@ class Config(object):
     RAW_FILENAME_FMT = "quarantine/{}.txt"
     BIN_FILENAME_FMT = "raw-clks/{}.bin"
     SIMILARITY_SCORES_FILENAME_FMT = "similarity-scores/{}.bin"
+    # Common prefix of the similarity scores files of a run
+    SIMILARITY_SCORES_RUN_PREFIX_FMT = "similarity-scores/{}"
 
     # Encoding size (in bytes)
     MIN_ENCODING_SIZE = int(os.getenv('MIN_ENCODING_SIZE', '1'))
@@ -0,0 +1,25 @@
+from entityservice.async_worker import celery, logger
+from entityservice.cache.run_tasks import take_run_task_ids
+from entityservice.cache.work_packages import remove_work_packages
+
+# Number of task ids sent in one revoke broadcast.
+REVOKE_BATCH_SIZE = 10_000
+
+
+def revoke_run_tasks(run_id):
+    """
+    Revoke the comparison tasks of a run which haven't started yet, so they don't take up a worker,
+    and remove the work packages of the run kept in redis.
+
+    The task ids are broadcast in batches of ``REVOKE_BATCH_SIZE``. Workers only remember the last
+    50000 revoked ids (celery's ``REVOKES_MAX``), so revoking is best effort for the largest runs:
+    the check of ``is_run_active`` in ``assert_valid_run``, at the start of every comparison task,
+    is the backstop for the tasks still reaching a worker. Tasks already running stop on their own
+    once the run isn't marked as active anymore.
+    """
+    task_ids = take_run_task_ids(run_id)
+    if task_ids:
+        logger.info(f"Revoking {len(task_ids)} outstanding tasks", run_id=run_id)
+        for batch_start in range(0, len(task_ids), REVOKE_BATCH_SIZE):
+            celery.control.revoke(task_ids[batch_start:batch_start + REVOKE_BATCH_SIZE])
+    remove_work_packages(run_id)
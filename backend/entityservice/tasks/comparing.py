@@ -1,9 +1,15 @@
 import array
+import hashlib
 import heapq
 import itertools
+import math
 import operator
+import tempfile
+import time
 
-from copy import deepcopy
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 from minio.deleteobjects import DeleteObject
 from minio.error import MinioException
@@ -11,27 +17,74 @@ from tenacity import retry, wait_random_exponential, retry_if_exception_type, st
 
 import anonlink
 import minio
+import numpy as np
 from celery import chord
+from celery.contrib.migrate import move
+from celery.utils import worker_direct
 
 
 from entityservice.async_worker import celery, logger
+from entityservice.cache.active_runs import is_run_active, set_run_state_error
+from entityservice.cache.block_cache import LocalBlockCache
 from entityservice.cache.encodings import remove_from_cache
-from entityservice.cache.progress import get_candidate_count_for_run, save_current_progress
+from entityservice.cache.progress import get_candidate_count_for_run, save_current_progress, \
+    save_total_number_of_comparisons_for_run
+from entityservice.cache.task_timings import get_cost_model, save_task_timings
+from entityservice.cache.package_results import claim_package_progress, claim_package_result, \
+    get_package_result
+from entityservice.cache.run_results import add_result_file, start_merge, finish_merge, abort_merge, \
+    take_all_result_files, finish_aggregation, set_outstanding_packages, mark_package_done
+from entityservice.cache.run_tasks import add_run_task_ids
+from entityservice.cache.work_packages import save_work_package, load_work_package, remove_work_packages
+from entityservice.comparison import compare_encodings
 from entityservice.encoding_storage import get_encoding_chunk, get_encoding_chunks
 from entityservice.errors import InactiveRun
 from entityservice.database import (
     check_project_exists, check_run_exists, DBConn, get_dataprovider_ids,
     get_project_column, get_project_dataset_sizes,
     get_project_encoding_size, get_run, insert_similarity_score_file,
-    update_run_mark_failure, get_block_metadata)
+    update_run_mark_failure, get_block_metadata, get_block_popcount_histograms, get_block_names,
+    get_multi_block_memberships, dataprovider_has_overlapping_blocks, get_reusable_similarity_scores,
+    get_pending_runs_with_lower_threshold)
 from entityservice.models.run import progress_run_stage as progress_stage
 from entityservice.object_store import connect_to_object_store
+from entityservice.run_estimates import estimate_run
+from entityservice.popcount_banding import plan_block_comparisons, split_into_bands, max_dice_coefficient
+from entityservice.serialization import summarize_candidate_pairs_file, find_candidate_pairs_above_threshold
 from entityservice.settings import Config
 from entityservice.tasks.base_task import TracedTask, celery_bug_fix, run_failed_handler
 from entityservice.tasks.solver import solver_task
 from entityservice.tasks import mark_run_complete
 from entityservice.tasks.assert_valid_run import assert_valid_run
-from entityservice.utils import generate_code, iterable_to_stream
+from entityservice.tasks.cancellation import revoke_run_tasks
+from entityservice.utils import generate_code, iterable_to_stream, unique_values_iter
+from entityservice.work_packages import encode_package, decode_package, pack_package, unpack_package, \
+    is_single_block_package
+
+
+# Nominal cost of handling a chunk, expressed in comparisons, used to estimate package costs without a cost model.
+CHUNK_OVERHEAD_IN_COMPARISONS = 100_000
+
+# Number of pairs of blocks fetched from the database at once, when a package consists of whole blocks.
+FETCH_UNIT_NUM_BLOCK_PAIRS = 1000
+
+# How many times the aggregation waits 5 seconds for the merges of result files in progress.
+MERGE_WAIT_RETRIES = 720
+
+# A run waits for the similarity scores of runs of the same project with lower thresholds to reuse them,
+# polling after COALESCED_RUN_WAIT_SECONDS, then backing off exponentially up to COALESCED_RUN_MAX_WAIT_INTERVAL
+# between polls, for up to Config.COALESCED_RUN_MAX_WAIT_SECONDS before comparing the entities itself.
+COALESCED_RUN_WAIT_SECONDS = 10
+COALESCED_RUN_MAX_WAIT_INTERVAL = 300
+
+# Minimum number of seconds between two checks by a comparison task that its run is still active.
+CANCELLATION_CHECK_SECONDS = 1.0
+
+# Number of comparison tasks sent at once when their completion is tracked in redis.
+SCHEDULING_BATCH_SIZE = 1000
+
+# Encoded work packages larger than this are kept in redis instead of the task messages.
+WORK_PACKAGE_INLINE_MAX_BYTES = 16 * 1024
 
 
 def check_run_active(conn, project_id, run_id):
@@ -42,21 +95,75 @@ def check_run_active(conn, project_id, run_id):
 
 
 @celery.task(base=TracedTask, ignore_result=True, args_as_tags=('project_id', 'run_id'))
-def create_comparison_jobs(project_id, run_id, parent_span=None):
+def create_comparison_jobs(project_id, run_id, parent_span=None, reuse_scores=True, waiting_since=None):
     """Schedule all the entity comparisons as sub tasks for a run.
 
     At a high level this task:
     - checks if the project and run have been deleted and if so aborts.
+    - reuses the similarity scores of a run with a lower or equal threshold if there is one,
+      instead of comparing the entities again. If such a run is still computing its similarity
+      scores, this task waits for them.
+    - if enabled, fails the run if it is estimated to exceed the limits on candidate pairs.
     - retrieves metadata: the number and size of the datasets, the encoding size,
       and the number and size of blocks.
     - splits the work into independent "packages" and schedules them to run in celery
     - schedules the follow up task to run after all the comparisons have been computed.
+
+    :param waiting_since: When this task started waiting for the similarity scores of other runs.
     """
     log = logger.bind(pid=project_id, run_id=run_id)
     current_span = create_comparison_jobs.span
     with DBConn() as conn:
         check_run_active(conn, project_id, run_id)
 
+        threshold = get_run(conn, run_id)['threshold']
+        if reuse_scores and Config.REUSE_SIMILARITY_SCORES:
+            pending_runs = get_pending_runs_with_lower_threshold(conn, project_id, run_id)
+            reusable_scores = get_reusable_similarity_scores(conn, project_id, threshold)
+        else:
+            pending_runs = []
+            reusable_scores = None
+
+    if pending_runs:
+        if waiting_since is None:
+            waiting_since = time.time()
+        if time.time() - waiting_since < Config.COALESCED_RUN_MAX_WAIT_SECONDS:
+            log.debug(f"Waiting for the similarity scores of {len(pending_runs)} runs with lower thresholds")
+            countdown = min(COALESCED_RUN_WAIT_SECONDS * 2 ** create_comparison_jobs.request.retries,
+                            COALESCED_RUN_MAX_WAIT_INTERVAL)
+            raise create_comparison_jobs.retry(
+                kwargs=dict(create_comparison_jobs.request.kwargs or {}, waiting_since=waiting_since),
+                countdown=countdown, max_retries=None)
+        log.warning("Stopped waiting for the similarity scores of runs with lower thresholds")
+
+    if reusable_scores is not None:
+        log.info(f"Reusing the similarity scores of run {reusable_scores['run']} "
+                 f"with threshold {reusable_scores['threshold']}")
+        current_span.log_kv({"event": "reusing similarity scores", 'source_run_id': reusable_scores['run']})
+        save_total_number_of_comparisons_for_run(run_id, 0)
+        reuse_similarity_scores.apply_async(
+            kwargs={'project_id': project_id, 'run_id': run_id,
+                    'source_files': reusable_scores['files'],
+                    'parent_span': create_comparison_jobs.get_serialized_span()},
+            link_error=run_failed_handler.s(run_id=run_id)
+        )
+        return
+
+    if Config.REJECT_RUNS_OVER_LIMITS:
+        with DBConn() as conn:
+            estimate = estimate_run(conn, project_id, threshold)
+        log.info("Estimated the cost of the run", **estimate)
+        if estimate['exceeded_limits']:
+            exceeded_limits = ', '.join(f"{limit} ({getattr(Config, limit)})" for limit in estimate['exceeded_limits'])
+            log.warning(f"This run is estimated to exceed the limits {exceeded_limits}. Setting state to 'error'")
+            with DBConn() as conn:
+                update_run_mark_failure(conn, run_id,
+                                        f"This run is estimated to create {estimate['candidate_pairs']} candidate "
+                                        f"pairs, more than the limits on candidate pairs {exceeded_limits}.")
+            set_run_state_error(run_id)
+            return
+
+    with DBConn() as conn:
         dp_ids = get_dataprovider_ids(conn, project_id)
         number_of_datasets = len(dp_ids)
         assert number_of_datasets >= 2, "Expected at least 2 data providers"
@@ -71,27 +178,55 @@ def create_comparison_jobs(project_id, run_id, parent_span=None):
 
         # We pass the encoding_size and threshold to the comparison tasks to minimize their db lookups
         encoding_size = get_project_encoding_size(conn, project_id)
-        threshold = get_run(conn, run_id)['threshold']
 
-    log.debug("creating work packages for computation tasks")
-    packages = _create_work_packages(common_blocks, dp_block_sizes, dp_ids, log, block_lookups=dp_lookups)
+        dp_block_histograms = {dp_id: dict(get_block_popcount_histograms(conn, dp_id)) for dp_id in dp_ids}
+        # Only if records belong to several blocks can the same candidate pair be found more than once
+        deduplicate = any(dataprovider_has_overlapping_blocks(conn, dp_id) for dp_id in dp_ids)
 
-    log.info(f"Chunking into {len(packages)} computation tasks")
+    log.debug("creating work packages for computation tasks")
+    chunk_size_aim, cost_model = _get_package_sizing(log)
+    packages = _create_work_packages(common_blocks, dp_block_sizes, dp_ids, log, block_lookups=dp_lookups,
+                                     chunk_size_aim=chunk_size_aim, threshold=threshold,
+                                     block_histograms=dp_block_histograms, cost_model=cost_model)
+    total_comparisons = _count_comparisons_in_packages(packages)
+    save_total_number_of_comparisons_for_run(run_id, total_comparisons)
+
+    # Longest processing time first, so the largest packages don't end up setting the run's tail latency.
+    package_costs = [_estimate_package_cost(package, cost_model) for package in packages]
+    order = sorted(range(len(packages)), key=lambda i: package_costs[i], reverse=True)
+    packages = [packages[i] for i in order]
+    package_costs = [package_costs[i] for i in order]
+    speculate = cost_model is not None and Config.SPECULATIVE_EXECUTION_FACTOR > 0
+
+    log.info(f"Chunking into {len(packages)} computation tasks", total_comparisons=total_comparisons)
     current_span.log_kv({"event": "chunking", 'num_chunks': len(packages), 'dataset-sizes': dataset_sizes})
     span_serialized = create_comparison_jobs.get_serialized_span()
 
+    if Config.COMPLETION_TRACKING == 'redis':
+        _schedule_tracked_comparison_tasks(packages, package_costs, project_id, run_id, threshold, encoding_size,
+                                           deduplicate, speculate, span_serialized, log)
+        return
+
     # Prepare the Celery Chord that will compute all the similarity scores:
     scoring_tasks = [compute_filter_similarity.si(
-        package,
+        _package_payload(run_id, package_id, package),
         project_id,
         run_id,
         threshold,
         encoding_size,
-        span_serialized
-    ) for package in packages]
+        span_serialized,
+        package_id=package_id if speculate else None,
+        estimated_seconds=package_cost if speculate else None,
+        deduplicate=deduplicate
+    ) for package_id, (package, package_cost) in enumerate(zip(packages, package_costs))]
+    if Config.LOCALITY_AWARE_ROUTING:
+        workers = _route_by_locality(scoring_tasks, packages, log)
+        _watch_routed_workers(project_id, run_id, workers, span_serialized)
 
     if len(scoring_tasks) == 1:
         scoring_tasks.append(celery_bug_fix.si())
+    # Record the task ids before scheduling, so the tasks can be revoked if the run is cancelled
+    add_run_task_ids(run_id, [scoring_task.freeze().id for scoring_task in scoring_tasks])
 
     callback_task = aggregate_comparisons.s(project_id=project_id, run_id=run_id, parent_span=span_serialized).on_error(
         run_failed_handler.s(run_id=run_id))
@@ -99,14 +234,119 @@ def create_comparison_jobs(project_id, run_id, parent_span=None):
     future = chord(scoring_tasks)(callback_task)
 
 
-def _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=Config.CHUNK_SIZE_AIM):
+def _schedule_tracked_comparison_tasks(packages, package_costs, project_id, run_id, threshold, encoding_size,
+                                       deduplicate, speculate, parent_span, log):
+    """
+    Schedule the comparison tasks of a run without a chord.
+
+    Each task records its completion in redis, and the task completing the last package schedules the
+    aggregation. Tasks are scheduled in batches of ``SCHEDULING_BATCH_SIZE``.
+    """
+    if not packages:
+        log.info("No comparisons to compute, scheduling the aggregation")
+        _schedule_aggregation(project_id, run_id, parent_span)
+        return
+    set_outstanding_packages(run_id, len(packages))
+    workers = _get_locality_workers(log) if Config.LOCALITY_AWARE_ROUTING else []
+    _watch_routed_workers(project_id, run_id, workers, parent_span)
+    log.info(f"Scheduling comparison tasks in batches of {SCHEDULING_BATCH_SIZE}")
+    for batch_start in range(0, len(packages), SCHEDULING_BATCH_SIZE):
+        batch = range(batch_start, min(batch_start + SCHEDULING_BATCH_SIZE, len(packages)))
+        scoring_tasks = [compute_filter_similarity.si(
+            _package_payload(run_id, package_id, packages[package_id]),
+            project_id,
+            run_id,
+            threshold,
+            encoding_size,
+            parent_span,
+            package_id=package_id,
+            estimated_seconds=package_costs[package_id] if speculate else None,
+            deduplicate=deduplicate,
+            track_completion=True
+        ).set(ignore_result=True).on_error(run_failed_handler.s(run_id=run_id)) for package_id in batch]
+        if workers:
+            _route_by_locality(scoring_tasks, [packages[package_id] for package_id in batch], log, workers=workers)
+        add_run_task_ids(run_id, [scoring_task.freeze().id for scoring_task in scoring_tasks])
+        for scoring_task in scoring_tasks:
+            scoring_task.apply_async()
+
+
+def _package_payload(run_id, package_id, package):
+    """
+    The work package argument of a comparison task: the encoded package, or a reference to it
+    if it is too large to be sent in the task message.
+    """
+    encoded_package = encode_package(package)
+    if len(encoded_package) > WORK_PACKAGE_INLINE_MAX_BYTES:
+        save_work_package(run_id, package_id, encoded_package)
+        return {'stored': package_id}
+    return {'encoded': encoded_package}
+
+
+def _load_package(run_id, package):
+    """Return the packed work package given to a comparison task, see :mod:`entityservice.work_packages`."""
+    if isinstance(package, list):
+        # not encoded, as sent by earlier versions
+        return pack_package(package)
+    if 'stored' in package:
+        encoded_package = load_work_package(run_id, package['stored'])
+        if encoded_package is None:
+            raise InactiveRun("Work package not found, the comparisons of the run are over.")
+    else:
+        encoded_package = package['encoded']
+    return decode_package(encoded_package)
+
+
+def _schedule_aggregation(project_id, run_id, parent_span):
+    aggregate_comparisons.apply_async(
+        args=([],),
+        kwargs={'project_id': project_id, 'run_id': run_id, 'parent_span': parent_span},
+        link_error=run_failed_handler.s(run_id=run_id))
+
+
+def _get_package_sizing(log):
+    """
+    Return the chunk size aim and the cost model to use for sizing the work packages.
+
+    If enough comparison tasks have reported their timings, the chunk size aim is derived from
+    ``Config.TASK_DURATION_AIM``, within a factor of 100 below and 10 above ``Config.CHUNK_SIZE_AIM``.
+    Otherwise ``Config.CHUNK_SIZE_AIM`` is used, without a cost model.
+    """
+    if Config.TASK_DURATION_AIM <= 0:
+        return Config.CHUNK_SIZE_AIM, None
+    try:
+        cost_model = get_cost_model()
+    except Exception as e:
+        log.warning("Couldn't load the cost model of comparison tasks", error=str(e))
+        return Config.CHUNK_SIZE_AIM, None
+    if cost_model is None:
+        log.debug("Not enough task timings to calibrate the chunk size")
+        return Config.CHUNK_SIZE_AIM, None
+    chunk_size_aim = cost_model.chunk_size_aim(Config.TASK_DURATION_AIM)
+    if chunk_size_aim is None:
+        return Config.CHUNK_SIZE_AIM, None
+    chunk_size_aim = min(max(chunk_size_aim, Config.CHUNK_SIZE_AIM // 100), Config.CHUNK_SIZE_AIM * 10)
+    log.info(f"Calibrated chunk size aim: {chunk_size_aim} comparisons")
+    return chunk_size_aim, cost_model
+
+
+def _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=Config.CHUNK_SIZE_AIM,
+                          threshold=None, block_histograms=None, cost_model=None,
+                          task_duration_aim=Config.TASK_DURATION_AIM):
     """Create packages of chunks of comparisons using blocking information.
 
     If a block is too large, that is, if the required comparisons is larger than the chunk size aim, then we split
     the block into several chunks. If blocks are smaller, than multiple blocks are bundled into one package.
+    Without a cost model, bundles are limited to the chunk size aim comparisons. With a cost model, bundles are
+    limited to an estimated duration of ``task_duration_aim`` seconds, accounting for the overhead of each block.
 
-    :todo Consider passing all dataproviders to anonlink's `split_to_chunks` for a given
-          large block instead of pairwise.
+    If the popcount histograms of the blocks are known, large blocks are first split into bands of encodings with
+    similar popcounts, and pairs of bands (or whole small blocks) which can't reach the threshold are skipped.
+    See :func:`entityservice.popcount_banding.plan_block_comparisons`.
+
+    Blocks shared by more than two data providers are handled for all providers at once, so that each task fetches
+    each provider's part of the block only once. Small blocks go into a single package with all their pairs of
+    providers, and large blocks are split as described in :func:`_split_multi_party_block`.
 
     :param blocks:
         dict mapping block identifier to a list of all combinations of
@@ -118,6 +358,11 @@ def _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, ch
     :param dp_ids: list of data provider ids
     :param log: A logger instance
     :param chunk_size_aim: The desired number of comparisons per chunk.
+    :param threshold: The similarity threshold of the run.
+    :param block_histograms: Optional map from dataprovider id to a dict mapping block id to the
+        popcount histogram of the block.
+    :param cost_model: Optional :class:`entityservice.cost_model.CostModel` used to size the bundles of small blocks.
+    :param task_duration_aim: The desired duration of a task in seconds, only used with a cost model.
 
     :returns
 
@@ -126,50 +371,313 @@ def _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, ch
         - datasetIndex - The dataprovider index [0, 1 ...]
         - block_id - The block of encodings this chunk is for
         - range - The range of encodings within the block that make up this chunk.
+        - popcounts - Optional (lowest, highest) popcount of the encodings of the block in this chunk.
     """
+    if block_histograms is None:
+        block_histograms = {}
+    if cost_model is None:
+        package_capacity = chunk_size_aim
+    else:
+        package_capacity = task_duration_aim - cost_model.task_overhead - cost_model.fetch_latency
+        # A cost model with a large fixed cost per task would otherwise put every small block in its own package
+        if package_capacity < task_duration_aim / 2:
+            log.info("Fixed costs of a task exceed half the task duration aim, clamping the package capacity",
+                     task_overhead=cost_model.task_overhead, fetch_latency=cost_model.fetch_latency,
+                     task_duration_aim=task_duration_aim)
+            package_capacity = task_duration_aim / 2
     packages = []
     MAX_CHUNKS_PER_PACKAGE = 100000
     cur_package = []
-    cur_comparisons = 0
-
-    for block_name, (dp1, dp2) in blocks:
-        size1 = dp_block_sizes[dp1][block_name]
-        size2 = dp_block_sizes[dp2][block_name]
-        num_comparisons = size1 * size2
+    cur_cost = 0
+
+    for block_name, block_dps in _group_providers_by_block(blocks, dp_ids).items():
+        # The popcounts can rule out whole pairs of providers in this block
+        pair_plans = {}
+        for dp1, dp2 in itertools.combinations(block_dps, 2):
+            band_pairs = plan_block_comparisons(
+                block_histograms.get(dp1, {}).get(block_lookups[dp1][block_name]), dp_block_sizes[dp1][block_name],
+                block_histograms.get(dp2, {}).get(block_lookups[dp2][block_name]), dp_block_sizes[dp2][block_name],
+                threshold, chunk_size_aim)
+            if band_pairs:
+                pair_plans[(dp1, dp2)] = band_pairs
+        if not pair_plans:
+            log.debug("Skipping block as the popcounts of its encodings rule out any matches")
+            continue
+        num_comparisons = sum(dp_block_sizes[dp1][block_name] * dp_block_sizes[dp2][block_name]
+                              for dp1, dp2 in pair_plans)
         if num_comparisons > chunk_size_aim:
             if len(cur_package) > 0:
                 packages.append(cur_package)
                 cur_package = []
-                cur_comparisons = 0
+                cur_cost = 0
             log.debug("Block is too large for single task. Working out how to chunk it up")
-            for chunk_info in anonlink.concurrency.split_to_chunks(chunk_size_aim,
-                                                                   dataset_sizes=(size1, size2)):
-                # chunk_info's from anonlink already have datasetIndex of 0 or 1 and a range
-                # We need to correct the datasetIndex and add the database datasetId and add block_id.
-                add_dp_id_to_chunk_info(chunk_info, dp_ids, dp1, dp2)
-                left, right = chunk_info
-                left['block_id'] = block_lookups[dp1][block_name]
-                right['block_id'] = block_lookups[dp2][block_name]
-                packages.append([chunk_info])
+            if len(block_dps) > 2:
+                packages.extend(_split_multi_party_block(block_name, block_dps, pair_plans, dp_block_sizes, dp_ids,
+                                                         block_lookups, block_histograms, threshold, num_comparisons,
+                                                         chunk_size_aim))
+                continue
+            [((dp1, dp2), band_pairs)] = pair_plans.items()
+            size1 = dp_block_sizes[dp1][block_name]
+            size2 = dp_block_sizes[dp2][block_name]
+            for band1, band2 in band_pairs:
+                band_sizes = (size1, size2) if band1 is None else (band1[2], band2[2])
+                for chunk_info in anonlink.concurrency.split_to_chunks(chunk_size_aim, dataset_sizes=band_sizes):
+                    # chunk_info's from anonlink already have datasetIndex of 0 or 1 and a range
+                    # We need to correct the datasetIndex and add the database datasetId and add block_id.
+                    add_dp_id_to_chunk_info(chunk_info, dp_ids, dp1, dp2)
+                    left, right = chunk_info
+                    left['block_id'] = block_lookups[dp1][block_name]
+                    right['block_id'] = block_lookups[dp2][block_name]
+                    if band1 is not None:
+                        # the range is relative to the encodings within the popcount band
+                        left['popcounts'] = band1[:2]
+                        right['popcounts'] = band2[:2]
+                    packages.append([chunk_info])
         else:
-            chunk_left = {"range": (0, size1), "block_id": block_lookups[dp1][block_name]}
-            chunk_right = {"range": (0, size2), "block_id": block_lookups[dp2][block_name]}
-            chunk_info = (chunk_left, chunk_right)
-            add_dp_id_to_chunk_info(chunk_info, dp_ids, dp1, dp2)
+            # All pairs of providers of a small block stay in the same package
+            block_chunks = []
+            block_cost = 0
+            for dp1, dp2 in pair_plans:
+                size1 = dp_block_sizes[dp1][block_name]
+                size2 = dp_block_sizes[dp2][block_name]
+                chunk_left = {"range": (0, size1), "block_id": block_lookups[dp1][block_name]}
+                chunk_right = {"range": (0, size2), "block_id": block_lookups[dp2][block_name]}
+                chunk_info = (chunk_left, chunk_right)
+                add_dp_id_to_chunk_info(chunk_info, dp_ids, dp1, dp2)
+                block_chunks.append(chunk_info)
+                block_cost += size1 * size2 if cost_model is None else cost_model.estimate_chunk(size1, size2)
             # if there is still enough capacity in the current work package, then append, otherwise new package
-            if cur_comparisons + num_comparisons <= chunk_size_aim and len(cur_package) < MAX_CHUNKS_PER_PACKAGE:
-                cur_package.append(chunk_info)
-                cur_comparisons += num_comparisons
+            if cur_cost + block_cost <= package_capacity and len(cur_package) + len(block_chunks) <= MAX_CHUNKS_PER_PACKAGE:
+                cur_package.extend(block_chunks)
+                cur_cost += block_cost
             else:
-                packages.append(cur_package)
-                cur_package = [chunk_info]
-                cur_comparisons = num_comparisons
+                if len(cur_package) > 0:
+                    packages.append(cur_package)
+                cur_package = block_chunks
+                cur_cost = block_cost
     # the last package might not have been added to the packages yet.
     if len(cur_package) > 0:
         packages.append(cur_package)
     return packages
 
 
+def _group_providers_by_block(blocks, dp_ids):
+    """
+    Return a dict mapping block name to the list of data providers sharing the block, in the order of dp_ids.
+
+    :param blocks: iterable of (block name, (dp1, dp2)) as created by :func:`_get_common_blocks`
+    """
+    block_providers = {}
+    for block_name, dps in blocks:
+        block_providers.setdefault(block_name, set()).update(dps)
+    return {block_name: [dp_id for dp_id in dp_ids if dp_id in dps] for block_name, dps in block_providers.items()}
+
+
+def _provider_slices(size, histogram, num_slices, threshold):
+    """
+    Split a provider's part of a block into about ``num_slices`` slices.
+
+    If the popcount histogram is usable, slices are popcount bands so that slices which can't
+    reach the threshold can be skipped. Otherwise slices are ranges of encodings.
+
+    :return: list of dicts with the ``range`` and optional ``popcounts`` of each slice.
+    """
+    if threshold and histogram and sum(histogram.values()) == size:
+        return [{'range': (0, count), 'popcounts': (lo, hi)}
+                for lo, hi, count in split_into_bands(histogram, size / num_slices)]
+    boundaries = [round(size * i / num_slices) for i in range(num_slices + 1)]
+    return [{'range': (start, stop)} for start, stop in zip(boundaries, boundaries[1:]) if stop > start]
+
+
+def _split_multi_party_block(block_name, block_dps, pair_plans, dp_block_sizes, dp_ids, block_lookups,
+                             block_histograms, threshold, num_comparisons, chunk_size_aim):
+    """
+    Split a large block shared by more than two data providers across all providers at once.
+
+    Each provider's part of the block is cut into ``k`` slices. The package ``(a, b)``, for
+    ``a <= b``, compares slice ``a`` of every provider with slice ``b`` of every other provider
+    (and slice ``b`` with slice ``a``). Together these packages cover every pair of slices of
+    every pair of providers exactly once, and each package only fetches two slices per provider.
+    ``k`` is chosen such that a package requires about ``chunk_size_aim`` comparisons.
+    """
+    num_slices = max(1, math.ceil(math.sqrt(2 * num_comparisons / chunk_size_aim)))
+    slices = {}
+    for dp_id in block_dps:
+        block_id = block_lookups[dp_id][block_name]
+        slices[dp_id] = _provider_slices(dp_block_sizes[dp_id][block_name],
+                                         block_histograms.get(dp_id, {}).get(block_id), num_slices, threshold)
+        for provider_slice in slices[dp_id]:
+            provider_slice['block_id'] = block_id
+
+    def slice_pair(dp1, slice1, dp2, slice2):
+        if 'popcounts' in slice1 and 'popcounts' in slice2:
+            bands = ((*slice1['popcounts'], 0), (*slice2['popcounts'], 0))
+            if max_dice_coefficient(*bands) < threshold:
+                return None
+        chunk_info = (dict(slice1), dict(slice2))
+        add_dp_id_to_chunk_info(chunk_info, dp_ids, dp1, dp2)
+        return chunk_info
+
+    num_slots = max(len(dp_slices) for dp_slices in slices.values())
+    packages = []
+    for a in range(num_slots):
+        for b in range(a, num_slots):
+            package = []
+            for dp1, dp2 in pair_plans:
+                slice_indices = [(a, b)] if a == b else [(a, b), (b, a)]
+                for index1, index2 in slice_indices:
+                    if index1 < len(slices[dp1]) and index2 < len(slices[dp2]):
+                        chunk_info = slice_pair(dp1, slices[dp1][index1], dp2, slices[dp2][index2])
+                        if chunk_info is not None:
+                            package.append(chunk_info)
+            if package:
+                packages.append(package)
+    return packages
+
+
+def _locality_key(package):
+    """
+    Return the key of the chunk of encodings a package should be co-located with, or None.
+
+    Packages of a large block share the left chunk of their first pair of chunks with other
+    packages. All packages sharing that chunk are sent to the same worker, so that worker only
+    has to fetch it once. Packages bundling several small blocks don't share encodings with
+    other packages.
+    """
+    if len(package) > 1 and not is_single_block_package(pack_package(package)):
+        return None
+    chunk_left, _ = package[0]
+    return _chunk_key(chunk_left)
+
+
+def _chunk_key(chunk_info):
+    """Identifies the encodings of a chunk."""
+    return (chunk_info['dataproviderId'], chunk_info['block_id'],
+            tuple(chunk_info['range']), tuple(chunk_info.get('popcounts', ())))
+
+
+def _rendezvous_hash(key, workers):
+    """Pick the worker with the highest hash of (key, worker). Returns None if there are no workers."""
+    def score(worker):
+        return hashlib.blake2b(f'{key}/{worker}'.encode(), digest_size=8).digest()
+    return max(workers, key=score, default=None)
+
+
+def _get_live_workers(queue_name, timeout=1.0):
+    """Return the hostnames of the workers currently consuming from the given queue."""
+    try:
+        active_queues = celery.control.inspect(timeout=timeout).active_queues() or {}
+    except Exception as e:
+        logger.warning("Couldn't inspect the celery workers", error=str(e))
+        return []
+    return sorted(hostname for hostname, queues in active_queues.items()
+                  if any(queue['name'] == queue_name for queue in queues))
+
+
+def _get_compute_queue_name():
+    """Name of the shared queue of the comparison tasks."""
+    task_route = Config.CELERY_ROUTES.get('entityservice.tasks.comparing.compute_filter_similarity', {})
+    return task_route.get('queue', 'celery')
+
+
+def _get_locality_workers(log):
+    """Return the live workers of the compute queue, which comparison tasks can be routed to."""
+    workers = _get_live_workers(_get_compute_queue_name())
+    if not workers:
+        log.info("No live compute workers found, using the shared queue")
+    return workers
+
+
+def _route_by_locality(scoring_tasks, packages, log, workers=None):
+    """
+    Route the scoring tasks of packages sharing a chunk of encodings to the same worker.
+
+    The worker is chosen by rendezvous hashing over the live workers of the compute queue, so that
+    a worker disappearing only moves its own share of the chunks. If no worker can be found, the
+    tasks stay on the shared queue.
+
+    :param workers: The live workers of the compute queue, looked up if not given.
+    :return: The workers the tasks may have been routed to.
+    """
+    if workers is None:
+        workers = _get_locality_workers(log)
+    if not workers:
+        return []
+    num_routed = 0
+    for task, package in zip(scoring_tasks, packages):
+        key = _locality_key(package)
+        if key is not None:
+            task.set(queue=worker_direct(_rendezvous_hash(key, workers)))
+            num_routed += 1
+    log.info(f"Routed {num_routed} of {len(scoring_tasks)} comparison tasks to {len(workers)} workers by locality")
+    return workers
+
+
+def _watch_routed_workers(project_id, run_id, workers, parent_span):
+    """Schedule the checks moving the tasks routed to workers which stop during the run to the shared queue."""
+    if workers:
+        requeue_tasks_of_stopped_workers.apply_async((project_id, run_id, workers, parent_span),
+                                                     countdown=Config.LOCALITY_ROUTING_CHECK_SECONDS)
+
+
+@celery.task(
+    base=TracedTask,
+    ignore_result=True,
+    args_as_tags=('project_id', 'run_id'))
+def requeue_tasks_of_stopped_workers(project_id, run_id, workers, parent_span=None):
+    """
+    Move the comparison tasks waiting in the direct queues of stopped workers to the shared queue.
+
+    Comparison tasks routed by locality wait in the direct queue of their worker, which nobody else
+    consumes. This check runs every ``Config.LOCALITY_ROUTING_CHECK_SECONDS`` while the run is active,
+    stopped workers are checked every time as the broker may give back the tasks they had received.
+
+    :param workers: The workers comparison tasks of the run were routed to.
+    """
+    log = logger.bind(pid=project_id, run_id=run_id)
+    if not is_run_active(run_id):
+        log.debug("Run is no longer active, stopping the checks of the routed workers")
+        return
+    queue_name = _get_compute_queue_name()
+    live_workers = _get_live_workers(queue_name)
+    if not live_workers:
+        # Either the workers can't be inspected, or none is left to consume the shared queue
+        log.info("No live compute workers found, checking again later")
+    else:
+        compute_queue = celery.amqp.queues[queue_name]
+        for worker in workers:
+            if worker not in live_workers:
+                moved = move(lambda body, message: compute_queue, app=celery, source=[worker_direct(worker)])
+                if moved.filtered:
+                    log.warning(f"Worker {worker} stopped, moved {moved.filtered} of its comparison tasks "
+                                f"to the shared queue")
+    _watch_routed_workers(project_id, run_id, workers, requeue_tasks_of_stopped_workers.get_serialized_span())
+
+
+def _estimate_package_cost(package, cost_model=None):
+    """
+    Estimate the cost of a package. In seconds if a cost model is given, otherwise in number
+    of comparisons plus a nominal overhead per chunk.
+    """
+    if cost_model is not None:
+        return cost_model.estimate_package(package)
+    cost = 0
+    for chunk_left, chunk_right in package:
+        size_left = chunk_left['range'][1] - chunk_left['range'][0]
+        size_right = chunk_right['range'][1] - chunk_right['range'][0]
+        cost += size_left * size_right + CHUNK_OVERHEAD_IN_COMPARISONS
+    return cost
+
+
+def _count_comparisons_in_packages(packages):
+    """Return the total number of comparisons required to compute all the packages."""
+    total = 0
+    for package in packages:
+        for chunk_left, chunk_right in package:
+            total += (chunk_left['range'][1] - chunk_left['range'][0]) * (chunk_right['range'][1] - chunk_right['range'][0])
+    return total
+
+
 def _get_common_blocks(dp_block_sizes, dp_ids):
     """Return all pairs of non-empty blocks across dataproviders.
 
@@ -269,22 +777,63 @@ def add_block_id_to_chunk_info(chunk_info, block_id):
     retry_jitter=True,
     retry_kwargs={'max_retries': 20}
 )
-def compute_filter_similarity(package, project_id, run_id, threshold, encoding_size, parent_span=None):
+def compute_filter_similarity(package, project_id, run_id, threshold, encoding_size, parent_span=None,
+                              package_id=None, estimated_seconds=None, speculative=False, deduplicate=False,
+                              track_completion=False):
     """Compute filter similarity between a chunk of filters in dataprovider 1,
     and a chunk of filters in dataprovider 2.
 
-    :param dict chunk_info:
-        A chunk returned by ``anonlink.concurrency.split_to_chunks``.
+    If a package id and an estimated duration are given, a speculative copy of this task is
+    scheduled to start once the task has been running for ``Config.SPECULATIVE_EXECUTION_FACTOR``
+    times its estimate. The first copy to finish wins, the other one stops before its next unit of
+    work and returns the result of the winner, or discards its own results if it finished too.
+
+    :param dict package:
+        The work package, as returned by ``_package_payload``.
     :param project_id:
     :param run_id:
     :param threshold:
     :param encoding_size: The size in bytes of each encoded entry
     :param parent_span: A serialized opentracing span context.
+    :param package_id: Identifier of the package within the run, used to track speculative copies.
+    :param estimated_seconds: The estimated duration of this task.
+    :param speculative: Whether this is a speculative copy of the task.
+    :param deduplicate: Whether records can belong to several blocks. If so, candidate pairs are only
+        kept in the first block (by name) shared by both records.
+    :param track_completion: Whether the run is tracked in redis instead of a chord. If so, the task
+        completing the last package of the run schedules the aggregation.
     :returns A 3-tuple: (num_results, result size in bytes, results_filename_in_object_store, )
+        Speculative copies return None.
     """
     log = logger.bind(pid=project_id, run_id=run_id)
-    log.debug("args", package_len=len(package), project_id=project_id, run_id=run_id, threshold=threshold, encoding_size=encoding_size, parent_span=parent_span)
+    log.debug("args", project_id=project_id, run_id=run_id, threshold=threshold, encoding_size=encoding_size, parent_span=parent_span)
+    if package_id is not None:
+        log = log.bind(package_id=package_id, speculative=speculative)
+        if speculative:
+            if get_package_result(run_id, package_id) is not None:
+                log.debug("Package already computed, skipping speculative copy")
+                return None
+        elif estimated_seconds is not None and compute_filter_similarity.request.retries == 0:
+            speculative_copy = compute_filter_similarity.apply_async(
+                args=(package, project_id, run_id, threshold, encoding_size, parent_span),
+                kwargs={'package_id': package_id, 'speculative': True, 'deduplicate': deduplicate,
+                        'track_completion': track_completion},
+                countdown=Config.SPECULATIVE_EXECUTION_FACTOR * estimated_seconds)
+            add_run_task_ids(run_id, [speculative_copy.id])
+
+    def computed_by_other_copy():
+        """Whether another copy of this task already computed the package."""
+        return package_id is not None and get_package_result(run_id, package_id) is not None
+
+    def other_copy_result():
+        """Record and return the result of the copy of this task which computed the package."""
+        winner = get_package_result(run_id, package_id)
+        _record_package_result(project_id, run_id, package_id, winner, track_completion,
+                               compute_filter_similarity.get_serialized_span())
+        return None if speculative else winner
+
     try:
+        task_start = time.perf_counter()
         task_span = compute_filter_similarity.span
 
         def new_child_span(name, parent_scope=None):
@@ -292,140 +841,490 @@ def compute_filter_similarity(package, project_id, run_id, threshold, encoding_s
                 parent_scope = compute_filter_similarity
             return compute_filter_similarity.tracer.start_active_span(name, child_of=parent_scope.span)
 
-        log.debug(f"Computing similarities for {len(package)} chunks of filters")
         log.debug("Checking that the resource exists (in case of run being canceled/deleted)")
         assert_valid_run(project_id, run_id, log)
-
-        def reindex_using_encoding_ids(recordarray, encoding_id_list):
-            # Map results from "index in chunk" to encoding id.
-            return array.array('I', [encoding_id_list[i] for i in recordarray])
+        packed_package = _load_package(run_id, package)
+        log.debug(f"Computing similarities for {len(packed_package)} chunks of filters")
 
         num_results = 0
         num_comparisons = 0
-        sim_results = []
-        package_with_encoding_data = deepcopy(package)
-        with DBConn() as conn:
-            if len(package) > 1:  # multiple full blocks in one package
-                with new_child_span(f'fetching-encodings of package of size {len(package)}'):
-                    package_with_encoding_data = get_encoding_chunks(conn, package_with_encoding_data, encoding_size=encoding_size)
-            else:  # this chunk is all part of one block
-                with new_child_span(f'fetching-encodings of package with 1 chunk'):
-                    chunk_info_dp1, chunk_info_dp2 = package_with_encoding_data[0]
-                    chunk_with_ids_dp1, chunk_dp1_size = get_encoding_chunk(conn, chunk_info_dp1, encoding_size)
-                    entity_ids_dp1, chunk_dp1 = zip(*chunk_with_ids_dp1)
-                    chunk_info_dp1['encodings'] = chunk_dp1
-                    chunk_info_dp1['entity_ids'] = entity_ids_dp1
-                    chunk_with_ids_dp2, chunk_dp2_size = get_encoding_chunk(conn, chunk_info_dp2, encoding_size)
-                    entity_ids_dp2, chunk_dp2 = zip(*chunk_with_ids_dp2)
-                    chunk_info_dp2['encodings'] = chunk_dp2
-                    chunk_info_dp2['entity_ids'] = entity_ids_dp2
-        log.debug('All encodings for package are fetched and deserialized')
-        log.debug("Calculating filter similarities for work package")
-
-        with new_child_span('comparing-encodings') as parent_scope:
-            for chunk_number, (chunk_dp1, chunk_dp2) in enumerate(package_with_encoding_data):
-                with new_child_span(f'comparing chunk {chunk_number}', parent_scope=parent_scope) as scope:
-                    enc_dp1 = chunk_dp1['encodings']
-                    enc_dp1_size = len(enc_dp1)
-                    enc_dp2 = chunk_dp2['encodings']
-                    enc_dp2_size = len(enc_dp2)
-                    assert enc_dp1_size > 0, "Zero sized chunk in dp1"
-                    assert enc_dp2_size > 0, "Zero sized chunk in dp2"
-                    scope.span.set_tag('num_encodings_1', enc_dp1_size)
-                    scope.span.set_tag('num_encodings_2', enc_dp2_size)
-
-                    log.debug("Calling anonlink with encodings", num_encodings_1=enc_dp1_size, num_encodings_2=enc_dp2_size)
-
-                    try:
-                        sims, (rec_is0, rec_is1) = anonlink.similarities.dice_coefficient_accelerated(
-                            datasets=(enc_dp1, enc_dp2),
-                            threshold=threshold,
-                            k=min(enc_dp1_size, enc_dp2_size))
-                    except NotImplementedError as e:
-                        log.warning(f"Encodings couldn't be compared using anonlink. {e}")
-                        return
-                    rec_is0 = reindex_using_encoding_ids(rec_is0, chunk_dp1['entity_ids'])
-                    rec_is1 = reindex_using_encoding_ids(rec_is1, chunk_dp2['entity_ids'])
-                    num_results += len(sims)
-                    num_comparisons += enc_dp1_size * enc_dp2_size
-                    sim_results.append((sims, (rec_is0, rec_is1), chunk_dp1['datasetIndex'], chunk_dp2['datasetIndex']))
-                    log.debug(f'comparison is done. {num_comparisons} comparisons got {num_results} pairs above the threshold')
-
-        # progress reporting
-        log.debug('Encoding similarities calculated')
-
-        with new_child_span('update-comparison-progress') as scope:
-            # Update the number of comparisons completed
-            save_current_progress(num_comparisons, num_results, run_id)
-            scope.span.log_kv({'comparisons': num_comparisons, 'num_similar': num_results})
-            log.debug("Comparisons: {}, Links above threshold: {}".format(num_comparisons, num_results))
-
-        with new_child_span('check-within-candidate-limits') as scope:
-            global_candidates_for_run = get_candidate_count_for_run(run_id)
-            scope.span.log_kv({'global candidate count for run': global_candidates_for_run})
-
-        if global_candidates_for_run is not None and global_candidates_for_run > Config.SIMILARITY_SCORES_MAX_CANDIDATE_PAIRS:
-            log.warning(f"This run has created more than the global limit of candidate pairs. Setting state to 'error'")
-            with DBConn() as conn:
-                update_run_mark_failure(conn, run_id,
-                                        'This run has created more than the global limit of candidate pairs.')
-            return
+        num_pruned = 0
+        chunk_timings = []
+        fetch_seconds = 0.0
+        num_duplicates = 0
+        fetcher = _ChunkFetcher(encoding_size, LocalBlockCache(project_id), is_single_block_package(packed_package),
+                                deduplicate=deduplicate)
+        fetch_units = _split_into_fetch_units(packed_package, fetcher.single_block)
+        depth = Config.COMPARISON_PIPELINE_DEPTH
+        # Results of the compared chunks, serialized into temporary files by a background thread.
+        spills = deque()
+        spilled = []
+        try:
+            log.debug("Calculating filter similarities for work package", fetch_units=len(fetch_units), depth=depth)
+            with new_child_span('comparing-encodings') as parent_scope, \
+                    closing(_prefetch(fetcher.fetch, fetch_units, depth)) as units, \
+                    ThreadPoolExecutor(max_workers=1) as spill_executor:
+                chunk_number = 0
+                fetch_start = last_cancellation_check = time.perf_counter()
+                for unit in units:
+                    # Time spent waiting for the encodings, most of the fetching overlaps with comparing.
+                    fetch_seconds += time.perf_counter() - fetch_start
+                    # stop as soon as the other copy of this task has computed the package
+                    if computed_by_other_copy():
+                        log.info("Package has been computed by another copy of this task")
+                        return other_copy_result()
+                    unit_results = []
+                    for chunk_dp1, chunk_dp2 in unit:
+                        if time.perf_counter() - last_cancellation_check >= CANCELLATION_CHECK_SECONDS:
+                            if not is_run_active(run_id):
+                                raise InactiveRun("Run was cancelled while computing")
+                            last_cancellation_check = time.perf_counter()
+                        with new_child_span(f'comparing chunk {chunk_number}', parent_scope=parent_scope) as scope:
+                            enc_dp1 = chunk_dp1['encodings']
+                            enc_dp1_size = len(enc_dp1)
+                            enc_dp2 = chunk_dp2['encodings']
+                            enc_dp2_size = len(enc_dp2)
+                            assert enc_dp1_size > 0, "Zero sized chunk in dp1"
+                            assert enc_dp2_size > 0, "Zero sized chunk in dp2"
+                            scope.span.set_tag('num_encodings_1', enc_dp1_size)
+                            scope.span.set_tag('num_encodings_2', enc_dp2_size)
+
+                            log.debug("Calling anonlink with encodings", num_encodings_1=enc_dp1_size, num_encodings_2=enc_dp2_size)
+
+                            compare_start = time.perf_counter()
+                            sims, (rec_is0, rec_is1), comparison_stats = compare_encodings(
+                                enc_dp1, enc_dp2,
+                                threshold=threshold,
+                                k=min(enc_dp1_size, enc_dp2_size),
+                                log=log)
+                            scope.span.set_tag('kernel', comparison_stats['kernel'])
+                            scope.span.set_tag('pruned_comparisons', comparison_stats['pruned'])
+                            scope.span.set_tag('tiles', comparison_stats['tiles'])
+                            num_pruned += comparison_stats['pruned']
+                            # Map results from "index in chunk" to entity id.
+                            rec_is0 = enc_dp1.take_entity_ids(rec_is0)
+                            rec_is1 = enc_dp2.take_entity_ids(rec_is1)
+                            if deduplicate:
+                                sims, rec_is0, rec_is1, chunk_duplicates = _keep_canonical_pairs(
+                                    sims, rec_is0, rec_is1, chunk_dp1, chunk_dp2)
+                                scope.span.set_tag('duplicate_pairs', chunk_duplicates)
+                                num_duplicates += chunk_duplicates
+                            chunk_timings.append((enc_dp1_size * enc_dp2_size, time.perf_counter() - compare_start))
+                            num_results += len(sims)
+                            num_comparisons += enc_dp1_size * enc_dp2_size
+                            unit_results.append((sims, (rec_is0, rec_is1), chunk_dp1['datasetIndex'], chunk_dp2['datasetIndex']))
+                            log.debug(f'comparison is done. {num_comparisons} comparisons got {num_results} pairs above the threshold')
+                        chunk_number += 1
+                    del unit
+                    spills.append(spill_executor.submit(_spill_comparison_results, unit_results))
+                    del unit_results
+                    # Don't let the serialization fall behind by more than the pipeline depth.
+                    while len(spills) > depth:
+                        spilled.append(spills.popleft().result())
+                    fetch_start = time.perf_counter()
+                while spills:
+                    spilled.append(spills.popleft().result())
+                parent_scope.span.set_tag('block_cache_hits', fetcher.block_cache.hits)
+                parent_scope.span.set_tag('block_cache_misses', fetcher.block_cache.misses)
+
+            # progress reporting
+            log.debug('Encoding similarities calculated')
+
+            with new_child_span('update-comparison-progress') as scope:
+                # Update the number of comparisons completed, only once per package
+                if package_id is None or claim_package_progress(run_id, package_id):
+                    save_current_progress(num_comparisons, num_results, run_id)
+                scope.span.log_kv({'comparisons': num_comparisons, 'num_similar': num_results})
+                log.debug("Comparisons: {}, Links above threshold: {}".format(num_comparisons, num_results))
+
+            with new_child_span('check-within-candidate-limits') as scope:
+                global_candidates_for_run = get_candidate_count_for_run(run_id)
+                scope.span.log_kv({'global candidate count for run': global_candidates_for_run})
+
+            if global_candidates_for_run is not None and global_candidates_for_run > Config.SIMILARITY_SCORES_MAX_CANDIDATE_PAIRS:
+                log.warning(f"This run has created more than the global limit of candidate pairs. Setting state to 'error'")
+                with DBConn() as conn:
+                    update_run_mark_failure(conn, run_id,
+                                            'This run has created more than the global limit of candidate pairs.')
+                set_run_state_error(run_id)
+                revoke_run_tasks(run_id)
+                return
+
+            if computed_by_other_copy():
+                log.info("Package has been computed by another copy of this task")
+                return other_copy_result()
+
+            # Save results file into minio
+            with new_child_span('save-comparison-results-to-minio'):
+                spilled_files = [spill for spill in spilled if spill is not None]
+                if not spilled_files:
+                    _record_task_timings(task_start, fetch_seconds, fetcher.num_encodings, chunk_timings, log)
+                    result = (0, None, None)
+                    winner = _claim_package_result(run_id, package_id, result, log)
+                    _record_package_result(project_id, run_id, package_id, winner, track_completion,
+                                           compute_filter_similarity.get_serialized_span())
+                    return None if speculative and winner != result else winner
+
+                task_span.log_kv({"edges": num_results, "pruned_comparisons": num_pruned,
+                                  "duplicate_pairs": num_duplicates,
+                                  "block_cache_hits": fetcher.block_cache.hits,
+                                  "block_cache_misses": fetcher.block_cache.misses})
+
+                result_filename = _result_filename(run_id)
+                log.info("Writing {} intermediate results to file: {}".format(num_results, result_filename))
+
+                merged_file_size = _save_comparison_results_to_object_store(spilled_files, result_filename, log)
+        finally:
+            # Remove the temporary files, including those of an interrupted pipeline.
+            spilled.extend(spill.result() for spill in spills if spill.done() and spill.exception() is None)
+            for spill in spilled:
+                if spill is not None:
+                    spill[0].close()
+
+        _record_task_timings(task_start, fetch_seconds, fetcher.num_encodings, chunk_timings, log)
+        result = (num_results, merged_file_size, result_filename)
+        winner = _claim_package_result(run_id, package_id, result, log)
+        _record_package_result(project_id, run_id, package_id, winner, track_completion,
+                               compute_filter_similarity.get_serialized_span())
+        return None if speculative and winner != result else winner
+    except Exception as e:
+        if not isinstance(e, (InactiveRun,)):
+            log.info("Caught exception, retrying in 5 seconds", exc_info=e)
+            compute_filter_similarity.retry(countdown=5)
 
-        # Save results file into minio
-        with new_child_span('save-comparison-results-to-minio'):
-            file_iters = []
-            file_sizes = []
-            for sims, (rec_is0, rec_is1), dp1_ds_idx, dp2_ds_idx in sim_results:
-                num_sims = len(sims)
-
-                if num_sims:
-                    # Make index arrays for serialization
-                    index_1 = array.array('I', (dp1_ds_idx,)) * num_sims
-                    index_2 = array.array('I', (dp2_ds_idx,)) * num_sims
-                    chunk_results = sims, (index_1, index_2), (rec_is0, rec_is1),
-                    bytes_iter, file_size = anonlink.serialization.dump_candidate_pairs_iter(chunk_results)
-                    file_iters.append(iterable_to_stream(bytes_iter))
-                    file_sizes.append(file_size)
-
-            if len(file_iters) > 1:
-                # we need to merge them first into one ordered thingy
-                merged_file_iter, merged_file_size = anonlink.serialization.merge_streams_iter(
-                    file_iters,
-                    sizes=file_sizes)
-                merged_file_iter = iterable_to_stream(merged_file_iter)
-            elif len(file_iters) == 1:
-                merged_file_iter = file_iters[0]
-                merged_file_size = file_sizes[0]
-            else:
-                return 0, None, None
 
-            task_span.log_kv({"edges": num_results})
+def _claim_package_result(run_id, package_id, result, log):
+    """
+    Return the result of a comparison task, or of the other copy of the task if it finished first.
+    The results file of the copy finishing last is deleted.
+    """
+    if package_id is None:
+        return result
+    winner = claim_package_result(run_id, package_id, result)
+    if winner == result:
+        return result
+    log.info("Another copy of this task finished first, discarding results")
+    _, _, filename = result
+    if filename is not None:
+        try:
+            connect_to_object_store().remove_object(Config.MINIO_BUCKET, filename)
+        except MinioException:
+            log.warning(f"Couldn't remove the discarded results file {filename}")
+    return winner
+
+
+def _record_package_result(project_id, run_id, package_id, result, track_completion, parent_span):
+    """
+    Record the result of a package for the incremental aggregation and, if the completion of the
+    run is tracked in redis, record the package as done.
+
+    Both copies of a speculatively executed task record the winning result, in case the winner
+    failed before recording it. Result files and packages are only recorded once.
+    """
+    _, _, filename = result
+    if filename is not None:
+        _add_result_for_aggregation(project_id, run_id, result, parent_span)
+    if track_completion:
+        _record_package_done(project_id, run_id, package_id, parent_span)
+
 
-            result_filename = Config.SIMILARITY_SCORES_FILENAME_FMT.format(generate_code(12))
-            log.info("Writing {} intermediate results to file: {}".format(num_results, result_filename))
+def _add_result_for_aggregation(project_id, run_id, result, parent_span):
+    """Record a result file for the incremental aggregation, and start a merge if enough files are waiting."""
+    num, filesize, filename = result
+    num_waiting = add_result_file(run_id, num, filesize, filename)
+    if num_waiting >= max(2, Config.AGGREGATION_MAX_FAN_IN):
+        merge_comparison_results.delay(project_id, run_id, parent_span)
 
-            _save_comparison_results_to_object_store(merged_file_iter, merged_file_size, result_filename, log)
 
-        return num_results, merged_file_size, result_filename
+def _record_package_done(project_id, run_id, package_id, parent_span):
+    """Record that a package has been computed, and schedule the aggregation after the last one."""
+    remaining = mark_package_done(run_id, package_id)
+    if remaining == 0:
+        logger.info("All comparison tasks are done, scheduling the aggregation", pid=project_id, run_id=run_id)
+        _schedule_aggregation(project_id, run_id, parent_span)
+
+
+def _record_task_timings(task_start, fetch_seconds, num_encodings, chunk_timings, log):
+    """Feed the timings of a comparison task to the cost model used to size the work packages."""
+    compare_seconds = sum(seconds for _, seconds in chunk_timings)
+    overhead_seconds = max(time.perf_counter() - task_start - fetch_seconds - compare_seconds, 0.0)
+    try:
+        save_task_timings(fetch_seconds, num_encodings, chunk_timings, overhead_seconds)
     except Exception as e:
-        if not isinstance(e, (InactiveRun,)):
-            log.info("Caught exception, retrying in 5 seconds", exc_info=e)
-            compute_filter_similarity.retry(countdown=5)
+        log.warning("Couldn't save the timings of the comparison task", error=str(e))
+
+
+def _split_into_fetch_units(package, single_block):
+    """
+    Split a package into the units of work passing through the pipeline of a comparison task.
+
+    The chunks of a single block package are fetched one pair at a time. Packages of whole blocks
+    are fetched in batches of ``FETCH_UNIT_NUM_BLOCK_PAIRS`` pairs of blocks.
+    """
+    unit_size = 1 if single_block else FETCH_UNIT_NUM_BLOCK_PAIRS
+    return [package[i:i + unit_size] for i in range(0, len(package), unit_size)]
+
+
+class _ChunkFetcher:
+    """
+    Fetches the encodings of the fetch units of a package.
+
+    The chunks of a single block package, and the block memberships of their records, are kept for the
+    whole package, as its chunk pairs share a few slices of the block between them. Not thread safe, only
+    one unit is fetched at a time.
+    """
+
+    def __init__(self, encoding_size, block_cache, single_block, deduplicate=False):
+        self.encoding_size = encoding_size
+        self.block_cache = block_cache
+        self.single_block = single_block
+        self.deduplicate = deduplicate
+        self.num_encodings = 0
+        self._chunks = {}
+        self._memberships = {}
+        self._block_names = {}
+
+    def fetch(self, unit):
+        """
+        Return the chunk pairs of a unit of a packed work package, enriched with the :class:`EncodingBlock` of
+        their 'encodings'. If deduplicating, also with their 'block_name' and the 'block_memberships' of their records.
+        """
+        unit = unpack_package(unit)
+        with DBConn() as conn:
+            if not self.single_block:
+                unit = get_encoding_chunks(conn, unit, encoding_size=self.encoding_size)
+                distinct_chunks = {_chunk_key(chunk_info): chunk_info for chunk_pair in unit for chunk_info in chunk_pair}
+                self.num_encodings += sum(len(chunk_info['encodings']) for chunk_info in distinct_chunks.values())
+                if self.deduplicate:
+                    _add_block_memberships(conn, unit, block_names=self._block_names)
+                return unit
+            for chunk_pair in unit:
+                for chunk_info in chunk_pair:
+                    key = _chunk_key(chunk_info)
+                    if key not in self._chunks:
+                        self._chunks[key], num_encodings = get_encoding_chunk(
+                            conn, chunk_info, self.encoding_size, cache=self.block_cache)
+                        self.num_encodings += num_encodings
+                    chunk_info['encodings'] = self._chunks[key]
+            if self.deduplicate:
+                _add_block_memberships(conn, unit, memberships=self._memberships, block_names=self._block_names)
+        return unit
+
+
+def _add_block_memberships(conn, unit, memberships=None, block_names=None):
+    """
+    Add the name and rank of their block and the blocks of their records belonging to more than one block
+    to the chunks of a fetch unit, see :func:`_keep_canonical_pairs`.
+
+    The memberships of the records of all the chunks are looked up by block range in a single query.
+
+    :param memberships: Optional dict of the memberships of the records of chunks already looked up, by
+        :func:`_chunk_key`. Updated with those of the chunks of the unit.
+    :param block_names: Optional dict of the block names already looked up, by block id. Updated with
+        those of the chunks of the unit.
+    """
+    if memberships is None:
+        memberships = {}
+    if block_names is None:
+        block_names = {}
+    chunks = {_chunk_key(chunk_info): chunk_info for chunk_pair in unit for chunk_info in chunk_pair}
+    missing_chunks = [key for key in chunks if key not in memberships]
+    block_ranges = [(chunks[key]['block_id'], *chunks[key]['range'], chunks[key].get('popcounts'))
+                    for key in missing_chunks]
+    memberships.update(zip(missing_chunks, get_multi_block_memberships(conn, block_ranges)))
+    missing_block_ids = {chunk_info['block_id'] for chunk_info in chunks.values()} - block_names.keys()
+    if missing_block_ids:
+        block_names.update(get_block_names(conn, missing_block_ids))
+
+    unit_memberships = defaultdict(dict)
+    for key, chunk_info in chunks.items():
+        unit_memberships[chunk_info['dataproviderId']].update(memberships[key])
+    # Blocks are compared by name, number them in order of their names
+    all_names = {block_names[chunk_info['block_id']] for chunk_info in chunks.values()}.union(
+        *(blocks for dp_memberships in unit_memberships.values() for blocks in dp_memberships.values()))
+    block_ranks = {name: rank for rank, name in enumerate(sorted(all_names))}
+    membership_tables = {dp_id: _membership_table(dp_memberships, block_ranks)
+                         for dp_id, dp_memberships in unit_memberships.items()}
+    for chunk_pair in unit:
+        for chunk_info in chunk_pair:
+            chunk_info['block_name'] = block_names[chunk_info['block_id']]
+            chunk_info['block_rank'] = block_ranks[chunk_info['block_name']]
+            chunk_info['block_memberships'] = membership_tables[chunk_info['dataproviderId']]
+
+
+def _membership_table(memberships, block_ranks):
+    """
+    Arrange the block memberships of records into arrays.
+
+    :param memberships: dict mapping entity ids to the names of their blocks.
+    :param block_ranks: dict mapping block names to their rank in name order.
+    :return: a 4-tuple of arrays: the sorted entity ids, the offset and number of the blocks of each
+        record, and the concatenated ranks of their blocks.
+    """
+    entity_ids = np.array(sorted(memberships), dtype=np.uint32)
+    counts = np.array([len(memberships[entity_id]) for entity_id in entity_ids.tolist()], dtype=np.int64)
+    ranks = np.array([block_ranks[name] for entity_id in entity_ids.tolist() for name in memberships[entity_id]],
+                     dtype=np.int64)
+    return entity_ids, np.cumsum(counts) - counts, counts, ranks
+
+
+def _membership_rows(table, entity_ids):
+    """Index of each record in a membership table, -1 for the records belonging to a single block."""
+    table_ids = table[0]
+    rows = np.minimum(np.searchsorted(table_ids, entity_ids), len(table_ids) - 1)
+    return np.where(table_ids[rows] == entity_ids, rows, -1)
+
+
+def _lower_block_keys(table, rows, pair_indices, block_rank):
+    """
+    One key per candidate pair and block of its record ranked lower than ``block_rank``:
+    ``pair index * block_rank + block rank``.
+    """
+    _, offsets, counts, ranks = table
+    pair_counts = counts[rows]
+    # position of each block within the blocks of its record
+    within = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    blocks = ranks[np.repeat(offsets[rows], pair_counts) + within]
+    pairs = np.repeat(pair_indices, pair_counts)
+    lower = blocks < block_rank
+    return pairs[lower] * block_rank + blocks[lower]
+
+
+def _keep_canonical_pairs(sims, rec_is0, rec_is1, chunk_dp1, chunk_dp2):
+    """
+    Drop the candidate pairs which are also found in another block.
+
+    A candidate pair is found in every block shared by both its records, it is only kept in its
+    canonical block: the shared block with the lowest name. Records without block memberships
+    only belong to the compared block.
+
+    Pairs are matched all at once: each pair is expanded into one key per block of each of its records
+    ranked lower than the compared block, and pairs with a key on both sides are dropped.
+
+    :return: the kept similarities and record ids, and the number of dropped pairs.
+    """
+    table0 = chunk_dp1['block_memberships']
+    table1 = chunk_dp2['block_memberships']
+    block_rank = chunk_dp1['block_rank']
+    if not len(table0[0]) or not len(table1[0]) or not len(sims) or block_rank == 0:
+        return sims, rec_is0, rec_is1, 0
+    # only pairs of records both belonging to several blocks can be found in another block
+    rows0 = _membership_rows(table0, np.frombuffer(rec_is0, dtype=np.uint32))
+    pair_indices = np.flatnonzero(rows0 >= 0)
+    rows1 = _membership_rows(table1, np.frombuffer(rec_is1, dtype=np.uint32)[pair_indices])
+    pair_indices, rows0, rows1 = pair_indices[rows1 >= 0], rows0[pair_indices[rows1 >= 0]], rows1[rows1 >= 0]
+    shared = np.intersect1d(_lower_block_keys(table0, rows0, pair_indices, block_rank),
+                            _lower_block_keys(table1, rows1, pair_indices, block_rank),
+                            assume_unique=True)
+    if not len(shared):
+        return sims, rec_is0, rec_is1, 0
+    keep = np.ones(len(sims), dtype=bool)
+    keep[shared // block_rank] = False
+    return (array.array('d', np.frombuffer(sims, dtype=np.float64)[keep].tobytes()),
+            array.array('I', np.frombuffer(rec_is0, dtype=np.uint32)[keep].tobytes()),
+            array.array('I', np.frombuffer(rec_is1, dtype=np.uint32)[keep].tobytes()),
+            len(sims) - int(keep.sum()))
+
+
+def _prefetch(fetch, units, depth):
+    """
+    Yield ``fetch(unit)`` for each unit, in order.
+
+    The units are fetched by a background thread, up to ``depth`` units (including the one
+    being yielded) are held at once.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = deque()
+        try:
+            for unit in units:
+                futures.append(executor.submit(fetch, unit))
+                if len(futures) >= depth:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _spill_comparison_results(chunk_results):
+    """
+    Serialize the candidate pairs of compared chunks into one sorted temporary file.
+
+    :param chunk_results: list of (sims, (rec_is0, rec_is1), dp1_dataset_index, dp2_dataset_index)
+    :return: The file, positioned at its start, and its size in bytes. None if there are no candidate pairs.
+    """
+    file_iters = []
+    file_sizes = []
+    for sims, (rec_is0, rec_is1), dp1_ds_idx, dp2_ds_idx in chunk_results:
+        num_sims = len(sims)
+
+        if num_sims:
+            # Make index arrays for serialization
+            index_1 = array.array('I', (dp1_ds_idx,)) * num_sims
+            index_2 = array.array('I', (dp2_ds_idx,)) * num_sims
+            candidate_pairs = sims, (index_1, index_2), (rec_is0, rec_is1),
+            bytes_iter, file_size = anonlink.serialization.dump_candidate_pairs_iter(candidate_pairs)
+            file_iters.append(bytes_iter)
+            file_sizes.append(file_size)
+
+    if not file_iters:
+        return None
+    if len(file_iters) > 1:
+        merged_file_iter, merged_file_size = anonlink.serialization.merge_streams_iter(
+            [iterable_to_stream(file_iter) for file_iter in file_iters],
+            sizes=file_sizes)
+    else:
+        merged_file_iter, merged_file_size = file_iters[0], file_sizes[0]
+
+    spill_file = tempfile.TemporaryFile()
+    try:
+        for data in merged_file_iter:
+            spill_file.write(data)
+        spill_file.seek(0)
+    except Exception:
+        spill_file.close()
+        raise
+    return spill_file, merged_file_size
 
 
 @retry(wait=wait_random_exponential(multiplier=1, max=60),
        retry=(retry_if_exception_type(minio.S3Error) | retry_if_exception_type(ConnectionError) | retry_if_exception_type(TimeoutError)),
        stop=stop_after_delay(120))
-def _save_comparison_results_to_object_store(file_iter, file_size, file_name, log):
+def _save_comparison_results_to_object_store(spill_files, file_name, log):
+    """
+    Upload the candidate pairs of the spilled files, merged into one sorted file.
+
+    The spill files are rewound on each attempt, so a retried upload sends the whole file again.
+
+    :param spill_files: list of (file, size in bytes) as returned by :func:`_spill_comparison_results`.
+    :return: the size in bytes of the uploaded file.
+    """
+    for spill_file, _ in spill_files:
+        spill_file.seek(0)
+    if len(spill_files) > 1:
+        # we need to merge them first into one ordered thingy
+        file_iter, file_size = anonlink.serialization.merge_streams_iter(
+            [spill_file for spill_file, _ in spill_files],
+            sizes=[spill_size for _, spill_size in spill_files])
+        file_iter = iterable_to_stream(file_iter)
+    else:
+        file_iter, file_size = spill_files[0]
     mc = connect_to_object_store()
     try:
         mc.put_object(Config.MINIO_BUCKET, file_name, file_iter, file_size)
     except minio.S3Error as err:
         log.warning("Failed to store result in minio", exc_info=err)
         raise
+    return file_size
+
+
+def _result_filename(run_id):
+    """Name of a new similarity scores file of a run. All the files of a run share a common prefix."""
+    return Config.SIMILARITY_SCORES_FILENAME_FMT.format(f'{run_id}/{generate_code(12)}')
 
 
-def _put_placeholder_empty_file(mc, log):
+def _put_placeholder_empty_file(mc, log, run_id):
     sims = array.array('d')
     dset_is0 = array.array('I')
     dset_is1 = array.array('I')
@@ -434,8 +1333,7 @@ def _put_placeholder_empty_file(mc, log):
     candidate_pairs = sims, (dset_is0, dset_is1), (rec_is0, rec_is1)
     empty_file_iter, empty_file_size \
         = anonlink.serialization.dump_candidate_pairs_iter(candidate_pairs)
-    empty_file_name = Config.SIMILARITY_SCORES_FILENAME_FMT.format(
-            generate_code(12))
+    empty_file_name = _result_filename(run_id)
     empty_file_stream = iterable_to_stream(empty_file_iter)
     try:
         mc.put_object(Config.MINIO_BUCKET, empty_file_name,
@@ -446,41 +1344,147 @@ def _put_placeholder_empty_file(mc, log):
     return 0, empty_file_size, empty_file_name
 
 
-def _merge_files(mc, log, file0, file1):
-    num0, filesize0, filename0 = file0
-    num1, filesize1, filename1 = file1
-    total_num = num0 + num1
-    file0_stream = mc.get_object(Config.MINIO_BUCKET, filename0)
-    file1_stream = mc.get_object(Config.MINIO_BUCKET, filename1)
-    merged_file_iter, merged_file_size \
-        = anonlink.serialization.merge_streams_iter(
-            (file0_stream, file1_stream), sizes=(filesize0, filesize1))
-    merged_file_name = Config.SIMILARITY_SCORES_FILENAME_FMT.format(
-            generate_code(12))
-    merged_file_stream = iterable_to_stream(_unique_values_iter(merged_file_iter))
+def _merge_files(mc, log, run_id, files):
+    """
+    Merge result files into a new one in a single pass. The merged files are kept, callers remove
+    them with :func:`_remove_result_files` once the merged file is recorded.
+
+    Duplicate candidate pairs are removed, so the returned number of candidate pairs and file
+    size are upper bounds.
+
+    :param files: list of (number of candidate pairs, file size, file name) of the files to merge.
+    :return: (number of candidate pairs, file size, file name) of the merged file.
+    """
+    total_num = sum(num for num, _, _ in files)
+    file_streams = []
     try:
-        # as we don't know the file size because we removed duplicates, we just do a multipart upload of 100MB junks.
-        mc.put_object(Config.MINIO_BUCKET, merged_file_name,
-                      merged_file_stream, length=-1, part_size=100*1024*1024)
-    except MinioException:
-        log.warning("Failed to store merged result in minio.")
-        raise
-    delete_objects = [DeleteObject(f) for f in (filename0, filename1)]
+        for _, _, filename in files:
+            file_streams.append(mc.get_object(Config.MINIO_BUCKET, filename))
+        merged_file_iter, merged_file_size \
+            = anonlink.serialization.merge_streams_iter(
+                file_streams, sizes=[filesize for _, filesize, _ in files])
+        merged_file_name = _result_filename(run_id)
+        merged_file_stream = iterable_to_stream(unique_values_iter(merged_file_iter))
+        try:
+            # as we don't know the file size because we removed duplicates, we just do a multipart upload of 100MB junks.
+            mc.put_object(Config.MINIO_BUCKET, merged_file_name,
+                          merged_file_stream, length=-1, part_size=100*1024*1024)
+        except MinioException:
+            log.warning("Failed to store merged result in minio.")
+            raise
+    finally:
+        for file_stream in file_streams:
+            file_stream.close()
+            file_stream.release_conn()
+    return total_num, merged_file_size, merged_file_name
+
+
+def _remove_result_files(mc, log, filenames):
+    """Delete result files from the object store, failures are only logged."""
+    delete_objects = [DeleteObject(filename) for filename in filenames]
     for del_err in mc.remove_objects(Config.MINIO_BUCKET, delete_objects):
         log.warning(f"Failed to delete result file "
                     f"{del_err.object_name}. {del_err}")
-    return total_num, merged_file_size, merged_file_name
 
 
-def _unique_values_iter(iterable):
-    """ yields only the unique values of a **sorted** iterable """
-    it = iter(iterable)
-    previous = next(it)
-    yield previous
-    for item in it:
-        if item != previous:
-            previous = item
-            yield item
+def _filter_result_file(mc, log, run_id, filename, threshold):
+    """
+    Copy the candidate pairs of a result file with a similarity of at least ``threshold``
+    into a new result file of the run. Only this prefix of the file is streamed.
+
+    :return: (number of candidate pairs, file size, file name) of the new file, or None if
+        no candidate pair is left.
+    """
+    num, filesize = find_candidate_pairs_above_threshold(mc, Config.MINIO_BUCKET, filename, threshold)
+    if not num:
+        return None
+    filtered_file_name = _result_filename(run_id)
+    file_stream = mc.get_object(Config.MINIO_BUCKET, filename, offset=0, length=filesize)
+    try:
+        mc.put_object(Config.MINIO_BUCKET, filtered_file_name, file_stream, filesize)
+    except MinioException:
+        log.warning("Failed to store filtered result in minio.")
+        raise
+    finally:
+        file_stream.close()
+        file_stream.release_conn()
+    return num, filesize, filtered_file_name
+
+
+def _num_files_to_merge(num_files, fan_in):
+    """
+    Number of the smallest files to merge next, such that all later merges have the full fan in.
+    This minimises the number of times candidate pairs are rewritten.
+    """
+    if num_files <= fan_in:
+        return num_files
+    return (num_files - 2) % (fan_in - 1) + 2
+
+
+def _create_shards_manifest(mc, filenames):
+    """
+    Describe the shards of a sharded similarity scores result: their names, sizes, number of
+    candidate pairs and ranges of similarity scores. Shards are listed by decreasing highest similarity.
+    """
+    shards = [summarize_candidate_pairs_file(mc, Config.MINIO_BUCKET, filename) for filename in filenames]
+    shards.sort(key=lambda shard: -shard['similarity_range'][1] if shard['similarity_range'] else 0)
+    return {
+        'shards': shards,
+        'count': sum(shard['count'] for shard in shards),
+        'size': sum(shard['size'] for shard in shards),
+    }
+
+
+def _reconcile_result_files(chord_files, recorded_files, log):
+    """
+    Return the files to aggregate: the files recorded for the incremental aggregation, and the
+    results of comparison tasks which are missing from them.
+
+    :param chord_files: list of (num, filesize, filename) returned by the comparison tasks.
+    :param recorded_files: list of (num, filesize, filename, sources) waiting to be aggregated.
+    """
+    recorded_sources = {source for *_, sources in recorded_files for source in sources}
+    missing_files = [result_file for result_file in chord_files if result_file[2] not in recorded_sources]
+    if missing_files:
+        log.warning(f"{len(missing_files)} result files weren't recorded for the incremental aggregation")
+    return [tuple(recorded_file[:3]) for recorded_file in recorded_files] + missing_files
+
+
+@celery.task(
+    base=TracedTask,
+    ignore_result=True,
+    args_as_tags=('project_id', 'run_id'))
+def merge_comparison_results(project_id, run_id, parent_span=None):
+    """
+    Merge result files of comparison tasks while the run is still computing.
+
+    Takes ``Config.AGGREGATION_MAX_FAN_IN`` waiting result files, if that many are waiting, and
+    puts the merged file back for the next merges or the final aggregation.
+    """
+    log = logger.bind(pid=project_id, run_id=run_id)
+    fan_in = max(2, Config.AGGREGATION_MAX_FAN_IN)
+    merge_id = generate_code(12)
+    files = start_merge(run_id, merge_id, fan_in)
+    if files is None:
+        log.debug("Not enough result files waiting to be merged")
+        return
+    log.info(f"Merging {len(files)} result files")
+    mc = connect_to_object_store()
+    try:
+        merged_file = _merge_files(mc, log, run_id, [result_file[:3] for result_file in files])
+    except Exception:
+        log.warning("Failed to merge result files, leaving them for later merges")
+        abort_merge(run_id, merge_id)
+        raise
+    sources = [source for *_, file_sources in files for source in file_sources]
+    num_waiting = finish_merge(run_id, merge_id, *merged_file, sources)
+    if num_waiting is None:
+        log.warning("The merge took longer than its lease, its files have been put back to be merged again")
+        _remove_result_files(mc, log, [merged_file[2]])
+        return
+    _remove_result_files(mc, log, [filename for _, _, filename, _ in files])
+    if num_waiting >= fan_in:
+        merge_comparison_results.delay(project_id, run_id, merge_comparison_results.get_serialized_span())
 
 
 @celery.task(
@@ -495,11 +1499,17 @@ def aggregate_comparisons(similarity_result_files, project_id, run_id, parent_sp
         raise TypeError("Inappropriate argument type - missing results files.")
 
     files = []
+    seen_filenames = set()
     for res in similarity_result_files:
         if res is None:
             log.warning("Missing results during aggregation. Stopping processing.")
             raise TypeError("Inappropriate argument type - results missing at aggregation step.")
         num, filesize, filename = res
+        if filename is not None and filename in seen_filenames:
+            # The results of a package computed twice, we only keep one copy
+            log.debug(f"Discarding duplicate results file {filename}")
+            continue
+        seen_filenames.add(filename)
         if num:
             assert filesize is not None
             assert filename is not None
@@ -507,30 +1517,67 @@ def aggregate_comparisons(similarity_result_files, project_id, run_id, parent_sp
         else:
             assert filesize is None
             assert filename is None
-    heapq.heapify(files)
+
+    recorded_files = take_all_result_files(run_id)
+    if recorded_files is None:
+        log.info("Waiting for the merges of result files in progress")
+        raise aggregate_comparisons.retry(countdown=5, max_retries=MERGE_WAIT_RETRIES)
+    remove_work_packages(run_id)
+    files = _reconcile_result_files(files, recorded_files, log)
 
     log.debug(f"Aggregating result chunks from {len(files)} files, "
               f"total size: {sum(map(operator.itemgetter(1), files))}")
+    _save_similarity_scores(project_id, run_id, files, aggregate_comparisons.get_serialized_span(), log)
+    finish_aggregation(run_id)
+
+
+def _save_similarity_scores(project_id, run_id, files, parent_span, log):
+    """
+    Store the similarity scores of a run from its result files, and schedule the next step of
+    the run: the solver, or its completion for "similarity_scores" projects.
+
+    The merged result files are only deleted once the similarity scores are saved, so that a
+    retry can start again from the same files.
+
+    :param files: list of (number of candidate pairs, file size, file name) of the result files.
+    """
+    files = list(files)
+    heapq.heapify(files)
+
+    with DBConn() as db:
+        result_type = get_project_column(db, project_id, 'result_type')
+    sharded = result_type == "similarity_scores" and Config.SIMILARITY_SCORES_SHARDED
 
     mc = connect_to_object_store()
-    while len(files) > 1:
-        file0 = heapq.heappop(files)
-        file1 = heapq.heappop(files)
-        merged_file = _merge_files(mc, log, file0, file1)
-        heapq.heappush(files, merged_file)
+    fan_in = max(2, Config.AGGREGATION_MAX_FAN_IN)
+    # Sharded results only need to be merged down to fan in files
+    max_files = fan_in if sharded else 1
+    merged_filenames = []
+    while len(files) > max_files:
+        num_inputs = _num_files_to_merge(len(files) - max_files + 1, fan_in)
+        log.debug(f"Merging {num_inputs} out of {len(files)} result files")
+        input_files = [heapq.heappop(files) for _ in range(num_inputs)]
+        heapq.heappush(files, _merge_files(mc, log, run_id, input_files))
+        merged_filenames.extend(filename for _, _, filename in input_files)
 
     if not files:
         # No results. Let's chuck in an empty file.
-        empty_file = _put_placeholder_empty_file(mc, log)
+        empty_file = _put_placeholder_empty_file(mc, log, run_id)
         files.append(empty_file)
 
-    (merged_num, merged_filesize, merged_filename), = files
-    log.info(f"Similarity score results in {merged_filename} in bucket "
-             f"{Config.MINIO_BUCKET} may take up up to {merged_filesize} bytes.")
+    if sharded:
+        merged_filename = Config.SIMILARITY_SCORES_RUN_PREFIX_FMT.format(run_id)
+        manifest = _create_shards_manifest(mc, [filename for _, _, filename in files])
+        log.info(f"Similarity score results in {len(files)} shards under {merged_filename} in bucket "
+                 f"{Config.MINIO_BUCKET}, taking up {manifest['size']} bytes.")
+    else:
+        (merged_num, merged_filesize, merged_filename), = files
+        manifest = None
+        log.info(f"Similarity score results in {merged_filename} in bucket "
+                 f"{Config.MINIO_BUCKET} may take up up to {merged_filesize} bytes.")
 
     with DBConn() as db:
-        result_type = get_project_column(db, project_id, 'result_type')
-        result_id = insert_similarity_score_file(db, run_id, merged_filename)
+        result_id = insert_similarity_score_file(db, run_id, merged_filename, manifest)
         log.debug(f"Saved path to similarity scores file to db with id "
                   f"{result_id}")
 
@@ -543,6 +1590,8 @@ def aggregate_comparisons(similarity_result_files, project_id, run_id, parent_sp
             progress_stage(db, run_id)
             dataset_sizes = get_project_dataset_sizes(db, project_id)
 
+    _remove_result_files(mc, log, merged_filenames)
+
     # DB now committed, we can fire off tasks that depend on the new db state
     if result_type == "similarity_scores":
         log.debug("Removing clk filters from redis cache")
@@ -551,8 +1600,47 @@ def aggregate_comparisons(similarity_result_files, project_id, run_id, parent_sp
 
         # Complete the run
         log.info("Marking run as complete")
-        mark_run_complete.delay(run_id, aggregate_comparisons.get_serialized_span())
+        mark_run_complete.delay(run_id, parent_span)
     else:
         solver_task.delay(
-            merged_filename, project_id, run_id, dataset_sizes,
-            aggregate_comparisons.get_serialized_span())
+            merged_filename, project_id, run_id, dataset_sizes, parent_span)
+
+
+@celery.task(
+    base=TracedTask,
+    ignore_result=True,
+    autoretry_for=(MinioException,),
+    retry_backoff=True,
+    args_as_tags=('project_id', 'run_id'))
+def reuse_similarity_scores(project_id, run_id, source_files, parent_span=None):
+    """
+    Create the similarity scores of a run from those of a completed run of the same project with
+    a lower or equal threshold, keeping the candidate pairs above the threshold of the run.
+
+    Falls back to comparing the entities if the similarity scores to reuse have been deleted.
+
+    :param source_files: the object store files holding the similarity scores to reuse.
+    """
+    log = logger.bind(pid=project_id, run_id=run_id)
+    with DBConn() as conn:
+        check_run_active(conn, project_id, run_id)
+        threshold = get_run(conn, run_id)['threshold']
+
+    mc = connect_to_object_store()
+    files = []
+    try:
+        for filename in source_files:
+            filtered_file = _filter_result_file(mc, log, run_id, filename, threshold)
+            if filtered_file is not None:
+                files.append(filtered_file)
+    except minio.S3Error as err:
+        if err.code != 'NoSuchKey':
+            raise
+        log.warning("The similarity scores to reuse have been deleted, comparing the entities instead")
+        _remove_result_files(mc, log, [filename for _, _, filename in files])
+        create_comparison_jobs.delay(project_id, run_id, reuse_similarity_scores.get_serialized_span(),
+                                     reuse_scores=False)
+        return
+
+    log.info(f"Kept {sum(num for num, _, _ in files)} candidate pairs above the threshold {threshold}")
+    _save_similarity_scores(project_id, run_id, files, reuse_similarity_scores.get_serialized_span(), log)
@@ -1,16 +1,15 @@
+import functools
 import json
 import ijson
 from requests.structures import CaseInsensitiveDict
 
 from entityservice.database import *
-from entityservice.encoding_storage import hash_block_name, stream_json_clksnblocks, \
-    convert_encodings_from_base64_to_binary, \
+from entityservice.encoding_storage import hash_block_name, stream_json_clksnblocks, prepare_encodings, \
     store_encodings_in_db, upload_clk_data_binary, include_encoding_id_in_binary_stream, \
     include_encoding_id_in_json_stream
 from entityservice.error_checking import check_dataproviders_encoding, handle_invalid_encoding_data, \
     InvalidEncodingError
 from entityservice.object_store import connect_to_object_store, stat_and_stream_object, delete_object_store_files
-from entityservice.serialization import binary_format, deserialize_bytes
 from entityservice.settings import Config
 from entityservice.async_worker import celery
 from entityservice.tasks.base_task import TracedTask
@@ -82,42 +81,27 @@ def pull_external_data(project_id, dp_id,
             update_encoding_metadata_set_encoding_size(conn, dp_id, size)
         with opentracing.tracer.start_span('create-block-entries-in-db', child_of=parent_span):
             log.debug("Adding blocks to db")
-            insert_blocking_metadata(conn, dp_id, block_sizes)
-
-        def ijson_encoding_iterator(encoding_stream):
-            binary_formatter = binary_format(size)
-            for encoding_id, encoding in zip(range(count), encoding_stream):
-                yield (
-                    str(encoding_id),
-                    binary_formatter.pack(encoding_id, deserialize_bytes(encoding)),
-                    encoding_to_block_map[str(encoding_id)]
-                    )
-
-        def encoding_iterator(encoding_stream):
-            binary_formatter = binary_format(size)
-            for encoding_id in range(count):
-                yield (
-                    str(encoding_id),
-                    binary_formatter.pack(encoding_id, encoding_stream.read(size)),
-                    encoding_to_block_map[str(encoding_id)]
-                    )
+            block_lookup = insert_blocking_metadata(conn, dp_id, block_sizes)
 
+        # The entity ids are assigned in order while storing the encodings
+        block_names = [encoding_to_block_map[str(encoding_id)] for encoding_id in range(count)]
         if object_name.endswith('.json'):
             log.info("Have json file of encodings")
             encodings_stream = ijson.items(io.BytesIO(encodings_stream.data), 'clks.item')
-            encoding_generator = ijson_encoding_iterator(encodings_stream)
+            encoding_generator = include_encoding_id_in_json_stream(encodings_stream, size, count, block_names)
         else:
             log.info("Have binary file of encodings")
-            encoding_generator = encoding_iterator(encodings_stream)
+            encoding_generator = include_encoding_id_in_binary_stream(encodings_stream, size, count, block_names)
 
         with opentracing.tracer.start_span('upload-encodings-to-db', child_of=parent_span):
             log.debug("Adding encodings and associated blocks to db")
             try:
-                store_encodings_in_db(conn, dp_id, encoding_generator, size)
+                store_encodings_in_db(conn, dp_id, encoding_generator, block_lookup=block_lookup,
+                                      prepare_group=functools.partial(prepare_encodings, encoding_size=size))
             except Exception as e:
                 log.warning("Failed while adding encodings and associated blocks to db", exc_info=e)
-
-                update_dataprovider_uploaded_state(conn, project_id, dp_id, 'error')
+                with DBConn() as error_conn:
+                    update_dataprovider_uploaded_state(error_conn, project_id, dp_id, 'error')
                 raise e
 
         with opentracing.tracer.start_span('update-encoding-metadata', child_of=parent_span):
@@ -194,10 +178,20 @@ def handle_raw_upload(project_id, dp_id, receipt_token, parent_span=None):
         # stream encodings with block ids from uploaded file
         # convert each encoding to our internal binary format
         # output into database for each block (temp or direct to minio?)
-        encoding_size, pipeline = convert_encodings_from_base64_to_binary(stream_json_clksnblocks(raw_data))
-        log.info(f"Starting pipeline to store {encoding_size}B sized encodings in database")
-        with DBConn() as db:
-            store_encodings_in_db(db, dp_id, pipeline, encoding_size)
+        # the encodings are decoded and the block names hashed by the workers of the ingestion pipeline
+        log.info("Starting pipeline to store encodings in database")
+        try:
+            with DBConn() as db:
+                encoding_size = store_encodings_in_db(
+                    db, dp_id, stream_json_clksnblocks(raw_data),
+                    prepare_group=functools.partial(prepare_encodings, hash_blocks=True))
+            if encoding_size is None:
+                raise ValueError("No encodings were uploaded")
+        except Exception as e:
+            log.warning("Failed while adding encodings and associated blocks to db", exc_info=e)
+            with DBConn() as conn:
+                update_dataprovider_uploaded_state(conn, project_id, dp_id, 'error')
+            raise
 
     log.info(f"Converted uploaded encodings of size {fmt_bytes(encoding_size)} into internal binary format. Number of blocks: {block_count}")
 
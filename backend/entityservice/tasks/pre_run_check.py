@@ -39,7 +39,8 @@ def check_for_executable_runs(project_id, parent_span=None):
 
     # commit db changes before scheduling following tasks
     log.debug("Creating tasks for {} created runs for project {}".format(len(new_runs), project_id))
-    for qr in new_runs:
+    # Lowest threshold first, the other runs derive their similarity scores from it
+    for qr in sorted(new_runs, key=lambda qr: qr[1]):
         run_id = qr[0]
         log.info('Queueing run for computation', run_id=run_id)
         prerun_check.delay(project_id, run_id, check_for_executable_runs.get_serialized_span())
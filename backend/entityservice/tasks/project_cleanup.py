@@ -3,10 +3,12 @@ from minio.error import MinioException
 
 import entityservice.database as db
 from entityservice.cache.active_runs import set_run_state_deleted
+from entityservice.cache.block_cache import LocalBlockCache
 from entityservice.database import DBConn
 from entityservice.object_store import connect_to_object_store, delete_object_store_folder
 from entityservice.async_worker import celery, logger
 from entityservice.tasks.base_task import TracedTask
+from entityservice.tasks.cancellation import revoke_run_tasks
 from entityservice.settings import Config
 
 
@@ -25,11 +27,14 @@ def remove_project(project_id, parent_span=None):
         log.debug("Setting run status as 'deleted'")
         for run in run_objects:
             set_run_state_deleted(run_id=run['run_id'])
+            revoke_run_tasks(run['run_id'])
         log.debug("Deleting project resourced from database")
         db.delete_project_data(conn, project_id)
         log.debug("Getting object store files associated with project from database")
         object_store_files = db.get_all_objects_for_project(conn, project_id)
 
+    log.debug("Removing cached encodings of the project from this host")
+    LocalBlockCache(project_id).clear()
     delete_minio_objects.delay(object_store_files, project_id, parent_span)
     log.info("Project resources removed")
 
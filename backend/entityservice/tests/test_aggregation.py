@@ -0,0 +1,155 @@
+import array
+import io
+from types import SimpleNamespace
+
+import anonlink
+import pytest
+from structlog import get_logger
+
+from entityservice.tasks.comparing import _merge_files, _num_files_to_merge, _reconcile_result_files, \
+    _create_shards_manifest, _filter_result_file, _remove_result_files
+
+log = get_logger()
+
+
+class _ObjectStream(io.BytesIO):
+
+    def release_conn(self):
+        pass
+
+
+class FakeObjectStore:
+
+    def __init__(self):
+        self.objects = {}
+        self.reads = 0
+
+    def get_object(self, bucket, name, offset=0, length=0):
+        self.reads += 1
+        data = self.objects[name][offset:]
+        return _ObjectStream(data[:length] if length else data)
+
+    def stat_object(self, bucket, name):
+        return SimpleNamespace(size=len(self.objects[name]))
+
+    def put_object(self, bucket, name, stream, length, part_size=None):
+        self.objects[name] = stream.read()
+
+    def remove_objects(self, bucket, delete_objects):
+        for delete_object in delete_objects:
+            # minio 7.2 exposes the name of a DeleteObject, older versions keep it private
+            del self.objects[getattr(delete_object, 'name', None) or delete_object._name]
+        return []
+
+
+def _store_candidates(mc, name, sims, rec_is0, rec_is1):
+    candidate_pairs = (array.array('d', sims),
+                       (array.array('I', [0] * len(sims)), array.array('I', [1] * len(sims))),
+                       (array.array('I', rec_is0), array.array('I', rec_is1)))
+    file_iter, file_size = anonlink.serialization.dump_candidate_pairs_iter(candidate_pairs)
+    mc.objects[name] = b''.join(file_iter)
+    return len(sims), file_size, name
+
+
+class TestMergeFiles:
+
+    def test_k_way_merge_removes_duplicates(self):
+        mc = FakeObjectStore()
+        files = [
+            _store_candidates(mc, 'a', [0.9, 0.5], [1, 2], [1, 2]),
+            _store_candidates(mc, 'b', [0.8, 0.5], [3, 2], [3, 2]),
+            _store_candidates(mc, 'c', [0.95], [4], [4]),
+        ]
+        num, _, merged_name = _merge_files(mc, log, 'run', files)
+        assert merged_name.startswith('similarity-scores/run/')
+        assert num == 5
+        # the merged files are only removed by the caller
+        assert sorted(mc.objects) == sorted(['a', 'b', 'c', merged_name])
+        assert mc.reads == 3
+        _remove_result_files(mc, log, ['a', 'b', 'c'])
+        assert list(mc.objects) == [merged_name]
+        sims, _, (rec_is0, rec_is1) = anonlink.serialization.load_candidate_pairs(io.BytesIO(mc.objects[merged_name]))
+        assert list(sims) == [0.95, 0.9, 0.8, 0.5]
+        assert list(rec_is0) == [4, 1, 3, 2]
+        assert list(rec_is1) == [4, 1, 3, 2]
+
+
+class TestFanIn:
+
+    @pytest.mark.parametrize('num_files, fan_in, expected', [
+        (5, 64, 5),
+        (64, 64, 64),
+        (65, 64, 2),
+        (130, 64, 4),
+        (10, 2, 2),
+    ])
+    def test_num_files_to_merge(self, num_files, fan_in, expected):
+        assert _num_files_to_merge(num_files, fan_in) == expected
+
+    @pytest.mark.parametrize('num_files, fan_in', [(7, 3), (100, 8), (1000, 64)])
+    def test_later_merges_are_full(self, num_files, fan_in):
+        merges = []
+        while num_files > 1:
+            num_inputs = _num_files_to_merge(num_files, fan_in)
+            merges.append(num_inputs)
+            num_files -= num_inputs - 1
+        assert all(num_inputs == fan_in for num_inputs in merges[1:])
+
+
+class TestReconcileResultFiles:
+
+    def test_recorded_files_replace_their_sources(self):
+        chord_files = [(1, 10, 'a'), (2, 20, 'b'), (3, 30, 'c'), (4, 40, 'd')]
+        recorded_files = [(3, 30, 'ab', ['a', 'b']), (3, 30, 'c', ['c'])]
+        files = _reconcile_result_files(chord_files, recorded_files, log)
+        assert sorted(files) == [(3, 30, 'ab'), (3, 30, 'c'), (4, 40, 'd')]
+
+    def test_nothing_recorded(self):
+        chord_files = [(1, 10, 'a'), (2, 20, 'b')]
+        assert _reconcile_result_files(chord_files, [], log) == chord_files
+
+
+class TestShardsManifest:
+
+    def test_manifest(self):
+        mc = FakeObjectStore()
+        _store_candidates(mc, 'a', [0.9, 0.5], [1, 2], [1, 2])
+        _store_candidates(mc, 'b', [0.95, 0.8, 0.6], [3, 4, 5], [3, 4, 5])
+        _store_candidates(mc, 'c', [], [], [])
+        manifest = _create_shards_manifest(mc, ['a', 'b', 'c'])
+        assert [shard['file'] for shard in manifest['shards']] == ['b', 'a', 'c']
+        b, a, c = manifest['shards']
+        assert b['count'] == 3 and b['similarity_range'] == [0.6, 0.95]
+        assert a['count'] == 2 and a['similarity_range'] == [0.5, 0.9]
+        assert c['count'] == 0 and c['similarity_range'] is None
+        assert a['size'] == len(mc.objects['a'])
+        assert manifest['count'] == 5
+        assert manifest['size'] == sum(len(data) for data in mc.objects.values())
+
+
+class TestFilterResultFile:
+
+    @pytest.mark.parametrize('threshold, expected_sims', [
+        (0.5, [0.95, 0.8, 0.6, 0.6, 0.5]),
+        (0.6, [0.95, 0.8, 0.6, 0.6]),
+        (0.7, [0.95, 0.8]),
+        (0.95, [0.95]),
+    ])
+    def test_keeps_candidate_pairs_above_threshold(self, threshold, expected_sims):
+        mc = FakeObjectStore()
+        _store_candidates(mc, 'a', [0.95, 0.8, 0.6, 0.6, 0.5], [1, 2, 3, 4, 5], [1, 2, 3, 4, 5])
+        num, filesize, filtered_name = _filter_result_file(mc, log, 'run', 'a', threshold)
+        assert filtered_name.startswith('similarity-scores/run/')
+        assert num == len(expected_sims)
+        assert filesize == len(mc.objects[filtered_name])
+        sims, _, (rec_is0, _) = anonlink.serialization.load_candidate_pairs(io.BytesIO(mc.objects[filtered_name]))
+        assert list(sims) == expected_sims
+        assert list(rec_is0) == [1, 2, 3, 4, 5][:len(expected_sims)]
+        assert 'a' in mc.objects
+
+    @pytest.mark.parametrize('sims', [[0.8, 0.7], []])
+    def test_nothing_above_threshold(self, sims):
+        mc = FakeObjectStore()
+        _store_candidates(mc, 'a', sims, range(len(sims)), range(len(sims)))
+        assert _filter_result_file(mc, log, 'run', 'a', 0.9) is None
+        assert list(mc.objects) == ['a']
@@ -0,0 +1,103 @@
+import io
+import struct
+
+import numpy as np
+import pytest
+
+from entityservice.database.util import BinaryCopyEncodingsSink, BinaryCopyRowsSource, binary_copy_rows, \
+    BINARY_COPY_HEADER, BINARY_COPY_TRAILER
+from entityservice.database.util import binary_format as parse_binary_copy
+from entityservice.serialization import binary_format
+from entityservice.tests.util import generate_bytes
+
+
+def binary_copy_output(values):
+    """The output of a binary COPY query selecting a single bytea column."""
+    rows = b''.join(struct.pack('!hi', 1, len(value)) + value for value in values)
+    return BINARY_COPY_HEADER + b'\x00\x00\x00\x00' + rows + BINARY_COPY_TRAILER
+
+
+def feed(sink, data, piece_size):
+    for i in range(0, len(data), piece_size):
+        sink.write(data[i:i + piece_size])
+    return sink.result()
+
+
+class TestBinaryCopyEncodingsSink:
+
+    @pytest.mark.parametrize('piece_size', [1, 7, 133, 1 << 20])
+    @pytest.mark.parametrize('expected_rows', [0, 10, 1000])
+    def test_parse(self, piece_size, expected_rows):
+        encoding_size = 16
+        raw_encodings = [generate_bytes(encoding_size) for _ in range(100)]
+        entity_ids = [3 * i + 2 ** 31 for i in range(100)]
+        values = [binary_format(encoding_size).pack(i, e) for i, e in zip(entity_ids, raw_encodings)]
+        sink = BinaryCopyEncodingsSink(encoding_size, expected_rows=expected_rows, buffer_bytes=64)
+
+        parsed_ids, parsed_encodings = feed(sink, binary_copy_output(values), piece_size)
+
+        assert parsed_ids.dtype == np.uint32
+        assert parsed_ids.tolist() == entity_ids
+        assert parsed_encodings.shape == (100, encoding_size)
+        assert parsed_encodings.flags.c_contiguous
+        assert [bytes(encoding) for encoding in parsed_encodings] == raw_encodings
+
+    def test_empty(self):
+        parsed_ids, parsed_encodings = feed(BinaryCopyEncodingsSink(8), binary_copy_output([]), 3)
+        assert len(parsed_ids) == 0
+        assert parsed_encodings.shape == (0, 8)
+
+    def test_wrong_encoding_size(self):
+        sink = BinaryCopyEncodingsSink(8)
+        with pytest.raises(ValueError):
+            feed(sink, binary_copy_output([generate_bytes(16)] * 3), 5)
+
+    def test_truncated_output(self):
+        data = binary_copy_output([binary_format(8).pack(1, generate_bytes(8))] * 3)
+        with pytest.raises(AssertionError):
+            feed(BinaryCopyEncodingsSink(8), data[:-5], 5)
+
+
+def read_all(source, size):
+    data = b''
+    while True:
+        piece = source.read(size)
+        if not piece:
+            return data
+        data += piece
+
+
+class TestBinaryCopyRowsSource:
+
+    @pytest.mark.parametrize('read_size', [1, 5, 100, -1])
+    def test_rows(self, read_size):
+        encodings = [generate_bytes(8) for _ in range(5)]
+        batches = [
+            binary_copy_rows([('>i8', [1, 2 ** 40, 3]), ('S8', np.frombuffer(b''.join(encodings[:3]), dtype='S8')),
+                              ('>i4', 7)]),
+            binary_copy_rows([('>i8', [4, 5]), ('S8', np.frombuffer(b''.join(encodings[3:]), dtype='S8')),
+                              ('>i4', 7)]),
+        ]
+
+        data = read_all(BinaryCopyRowsSource(iter(batches)), read_size)
+
+        assert data.startswith(BINARY_COPY_HEADER) and data.endswith(BINARY_COPY_TRAILER)
+        rows = list(parse_binary_copy(io.BytesIO(data)))
+        assert [int.from_bytes(row[0], 'big') for row in rows] == [1, 2 ** 40, 3, 4, 5]
+        assert [row[1] for row in rows] == encodings
+        assert all(row[2] == struct.pack('!i', 7) for row in rows)
+
+    def test_no_rows(self):
+        data = read_all(BinaryCopyRowsSource(iter([])), 3)
+        assert list(parse_binary_copy(io.BytesIO(data))) == []
+
+    def test_encodings_roundtrip(self):
+        encoding_size = 16
+        raw_encodings = [generate_bytes(encoding_size) for _ in range(10)]
+        values = np.frombuffer(b''.join(binary_format(encoding_size).pack(i, e) for i, e in enumerate(raw_encodings)),
+                               dtype=f'S{encoding_size + 4}')
+        data = read_all(BinaryCopyRowsSource(iter([binary_copy_rows([(values.dtype, values)])])), 1000)
+
+        parsed_ids, parsed_encodings = feed(BinaryCopyEncodingsSink(encoding_size), data, 1000)
+        assert parsed_ids.tolist() == list(range(10))
+        assert [bytes(encoding) for encoding in parsed_encodings] == raw_encodings
@@ -0,0 +1,92 @@
+import os
+import time
+
+from entityservice.cache.block_cache import LocalBlockCache
+from entityservice.encoding_block import EncodingBlock
+from entityservice.tests.util import generate_bytes
+
+
+def make_chunk_info(block_id=1, chunk_range=(0, 10), popcounts=None):
+    chunk_info = {'dataproviderId': 7, 'block_id': block_id, 'range': chunk_range, 'datasetIndex': 0}
+    if popcounts is not None:
+        chunk_info['popcounts'] = popcounts
+    return chunk_info
+
+
+def make_chunk_data(n, encoding_size=16):
+    return EncodingBlock.from_pairs([(i * 3, generate_bytes(encoding_size)) for i in range(n)], encoding_size)
+
+
+class TestLocalBlockCache:
+
+    def test_roundtrip(self, tmp_path):
+        cache = LocalBlockCache('project', directory=str(tmp_path), max_bytes=1024 * 1024)
+        chunk_info = make_chunk_info()
+        chunk_data = make_chunk_data(10)
+        assert cache.get(chunk_info, 16) is None
+        cache.put(chunk_info, chunk_data)
+        assert cache.get(chunk_info, 16) == chunk_data
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_shared_between_instances(self, tmp_path):
+        chunk_data = make_chunk_data(10)
+        LocalBlockCache('project', directory=str(tmp_path), max_bytes=1024 * 1024).put(make_chunk_info(), chunk_data)
+        cache = LocalBlockCache('project', directory=str(tmp_path), max_bytes=1024 * 1024)
+        assert cache.get(make_chunk_info(), 16) == chunk_data
+        # different range or popcount band are different entries
+        assert cache.get(make_chunk_info(chunk_range=(10, 20)), 16) is None
+        assert cache.get(make_chunk_info(popcounts=(3, 5)), 16) is None
+
+    def test_lru_eviction(self, tmp_path):
+        chunk_data = make_chunk_data(10)
+        entry_size = 10 * (16 + 4)
+        cache = LocalBlockCache('project', directory=str(tmp_path), max_bytes=2 * entry_size)
+        cache.put(make_chunk_info(block_id=1), chunk_data)
+        cache.put(make_chunk_info(block_id=2), chunk_data)
+        # make block 1 the most recently used
+        old = time.time() - 100
+        os.utime(cache._path(make_chunk_info(block_id=2)), (old, old))
+        assert cache.get(make_chunk_info(block_id=1), 16) is not None
+        cache.put(make_chunk_info(block_id=3), chunk_data)
+
+        assert cache.get(make_chunk_info(block_id=1), 16) is not None
+        assert cache.get(make_chunk_info(block_id=2), 16) is None
+        assert cache.get(make_chunk_info(block_id=3), 16) is not None
+
+    def test_entries_only_listed_over_budget(self, tmp_path, monkeypatch):
+        entry_size = 10 * (16 + 4)
+        cache = LocalBlockCache('project', directory=str(tmp_path), max_bytes=3 * entry_size)
+        cache.put(make_chunk_info(block_id=1), make_chunk_data(10))
+        scans = []
+        monkeypatch.setattr(cache, '_evict', lambda: scans.append(1) or 0)
+        cache.put(make_chunk_info(block_id=2), make_chunk_data(10))
+        cache.put(make_chunk_info(block_id=3), make_chunk_data(10))
+        assert scans == []
+        cache.put(make_chunk_info(block_id=4), make_chunk_data(10))
+        assert scans == [1]
+
+    def test_total_shared_between_instances(self, tmp_path):
+        entry_size = 10 * (16 + 4)
+        LocalBlockCache('project', directory=str(tmp_path), max_bytes=2 * entry_size).put(
+            make_chunk_info(block_id=1), make_chunk_data(10))
+        other_cache = LocalBlockCache('other', directory=str(tmp_path), max_bytes=2 * entry_size)
+        other_cache.put(make_chunk_info(block_id=2), make_chunk_data(10))
+        other_cache.put(make_chunk_info(block_id=3), make_chunk_data(10))
+        remaining = [len(os.listdir(str(tmp_path / project))) for project in ('project', 'other')]
+        assert sum(remaining) == 2
+
+    def test_clear(self, tmp_path):
+        cache = LocalBlockCache('project', directory=str(tmp_path), max_bytes=1024 * 1024)
+        other_cache = LocalBlockCache('other', directory=str(tmp_path), max_bytes=1024 * 1024)
+        cache.put(make_chunk_info(), make_chunk_data(10))
+        other_cache.put(make_chunk_info(), make_chunk_data(10))
+        cache.clear()
+        assert cache.get(make_chunk_info(), 16) is None
+        assert other_cache.get(make_chunk_info(), 16) is not None
+
+    def test_disabled(self, tmp_path):
+        cache = LocalBlockCache('project', directory=str(tmp_path), max_bytes=0)
+        cache.put(make_chunk_info(), make_chunk_data(10))
+        assert cache.get(make_chunk_info(), 16) is None
+        assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,16 @@
+from entityservice.tasks import cancellation
+
+
+def test_revokes_sent_in_batches(monkeypatch):
+    revoked = []
+    removed = []
+    monkeypatch.setattr(cancellation, 'REVOKE_BATCH_SIZE', 4)
+    monkeypatch.setattr(cancellation, 'take_run_task_ids', lambda run_id: [str(i) for i in range(10)])
+    monkeypatch.setattr(cancellation, 'remove_work_packages', removed.append)
+    monkeypatch.setattr(cancellation.celery.control, 'revoke', revoked.append)
+
+    cancellation.revoke_run_tasks('run')
+
+    assert [len(batch) for batch in revoked] == [4, 4, 2]
+    assert [task_id for batch in revoked for task_id in batch] == [str(i) for i in range(10)]
+    assert removed == ['run']
@@ -1,6 +1,16 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+from celery.canvas import Signature
 from structlog import get_logger
 
-from entityservice.tasks.comparing import _get_common_blocks, _create_work_packages
+from entityservice.cost_model import CostModel
+from entityservice.tasks import comparing
+from entityservice.tasks.comparing import _get_common_blocks, _create_work_packages, _count_comparisons_in_packages, \
+    _locality_key, _rendezvous_hash, _estimate_package_cost, _claim_package_result, _record_package_result, \
+    _schedule_tracked_comparison_tasks, _load_package
+from entityservice.work_packages import unpack_package
 log = get_logger()
 
 
@@ -58,17 +68,306 @@ class TestChunkingBlocks:
         blocks = _get_common_blocks(dp_block_sizes, dp_ids)
         chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=100)
         # Case I: all blocks need to be chunked
-        # Block 1 should create 100 chunks between dp combinations: 1:2, 1:3, and 2:3 for 300 chunks
+        # Block 1 is shared by the 3 dps, it is split into 25 slices per dp, comparing all dp combinations in
+        # each of the 25 * 26 / 2 packages.
         # Block 2 should create 100 chunks between 2:3
-        assert len(chunks) == 300 + 100
+        assert len(chunks) == 325 + 100
+        assert _count_comparisons_in_packages(chunks) == 3 * 100 * 100 + 100 * 100
 
-        # Case II: each block fits into exactly one work package
+        # Case II: the 3 party block is split in 3 slices per dp, the other block fits into one work package
         blocks = _get_common_blocks(dp_block_sizes, dp_ids)
         chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=10000)
-        assert len(chunks) == 4
+        assert len(chunks) == 6 + 1
 
         # Case III: all blocks fit into one work package
         blocks = _get_common_blocks(dp_block_sizes, dp_ids)
         chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=40000)
         assert len(chunks) == 1
 
+
+    def test_2p_popcount_banded_block(self):
+        dp_ids = [1, 2]
+        dp_block_sizes = {1: {'1': 100}, 2: {'1': 100}}
+        block_lookups = {1: {'1': 1}, 2: {'1': 2}}
+        # half the encodings are sparse, the other half dense
+        histogram = {10: 50, 500: 50}
+        block_histograms = {1: {1: histogram}, 2: {2: histogram}}
+
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=2500,
+                                       threshold=0.8, block_histograms=block_histograms)
+        # sparse encodings are only compared with sparse ones, dense with dense.
+        assert _count_comparisons_in_packages(chunks) == 2 * 50 * 50
+        for package in chunks:
+            for chunk_left, chunk_right in package:
+                assert chunk_left['popcounts'] == chunk_right['popcounts']
+                lower, upper = chunk_left['range']
+                assert upper <= 50
+
+        # Without a threshold the whole block is compared
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=2500,
+                                       block_histograms=block_histograms)
+        assert _count_comparisons_in_packages(chunks) == 100 * 100
+
+    def test_2p_skip_incompatible_small_block(self):
+        dp_ids = [1, 2]
+        dp_block_sizes = {1: {'1': 10, '2': 10}, 2: {'1': 10, '2': 10}}
+        block_lookups = {1: {'1': 1, '2': 2}, 2: {'1': 3, '2': 4}}
+        block_histograms = {
+            1: {1: {10: 10}, 2: {10: 10}},
+            2: {3: {500: 10}, 4: {11: 10}},
+        }
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=10000,
+                                       threshold=0.8, block_histograms=block_histograms)
+        assert len(chunks) == 1
+        [(chunk_left, chunk_right)] = chunks[0]
+        assert chunk_left['block_id'] == 2
+        assert chunk_right['block_id'] == 4
+        assert 'popcounts' not in chunk_left
+
+    def test_bundling_with_cost_model(self):
+        dp_ids = [1, 2]
+        dp_block_sizes = {1: {str(i): 10 for i in range(100)}, 2: {str(i): 10 for i in range(100)}}
+        block_lookups = {1: {str(i): i for i in range(100)}, 2: {str(i): 100 + i for i in range(100)}}
+        # each block pair takes 1 second, mostly overhead
+        cost_model = CostModel(task_overhead=2, fetch_latency=0, fetch_per_encoding=0, chunk_overhead=0.99,
+                               compare_per_comparison=0.0001)
+
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=10000,
+                                       cost_model=cost_model, task_duration_aim=12)
+        assert len(chunks) == 10
+        assert all(len(package) == 10 for package in chunks)
+
+        # Without the cost model all blocks fit in one package
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=10000)
+        assert len(chunks) == 1
+
+    def test_package_capacity_clamped(self):
+        dp_ids = [1, 2]
+        dp_block_sizes = {1: {str(i): 10 for i in range(100)}, 2: {str(i): 10 for i in range(100)}}
+        block_lookups = {1: {str(i): i for i in range(100)}, 2: {str(i): 100 + i for i in range(100)}}
+        # the fixed costs of a task exceed the task duration aim
+        cost_model = CostModel(task_overhead=15, fetch_latency=0, fetch_per_encoding=0, chunk_overhead=0.99,
+                               compare_per_comparison=0.0001)
+
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        chunks = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=10000,
+                                       cost_model=cost_model, task_duration_aim=12)
+        # packages still bundle half a task duration aim of blocks
+        assert len(chunks) == 17
+        assert all(len(package) <= 6 for package in chunks)
+
+    def test_3p_small_block_in_one_package(self):
+        dp_ids = [1, 2, 3]
+        dp_block_sizes = {1: {'1': 10}, 2: {'1': 10}, 3: {'1': 10}}
+        block_lookups = {1: {'1': 1}, 2: {'1': 2}, 3: {'1': 3}}
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        [package] = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=1000)
+        assert {(left['dataproviderId'], right['dataproviderId']) for left, right in package} == {(1, 2), (1, 3), (2, 3)}
+
+    @pytest.mark.parametrize('use_histograms', [False, True])
+    def test_multi_party_split_covers_all_pairs(self, use_histograms):
+        dp_ids = [1, 2, 3, 4]
+        sizes = {1: 60, 2: 45, 3: 50, 4: 7}
+        dp_block_sizes = {dp_id: {'1': size} for dp_id, size in sizes.items()}
+        block_lookups = {dp_id: {'1': 10 + dp_id} for dp_id in dp_ids}
+        # all encodings of a dp have popcounts 100..100 + size, so all bands are compatible at this threshold
+        popcounts = {dp_id: [100 + i for i in range(size)] for dp_id, size in sizes.items()}
+        block_histograms = None
+        if use_histograms:
+            block_histograms = {dp_id: {10 + dp_id: {p: 1 for p in popcounts[dp_id]}} for dp_id in dp_ids}
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        packages = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=500,
+                                         threshold=0.5, block_histograms=block_histograms)
+        assert len(packages) > 1
+
+        def encodings(chunk):
+            dp_records = list(range(sizes[chunk['dataproviderId']]))
+            if 'popcounts' in chunk:
+                lo, hi = chunk['popcounts']
+                dp_records = [r for r in dp_records if lo <= popcounts[chunk['dataproviderId']][r] <= hi]
+            start, stop = chunk['range']
+            return [(chunk['dataproviderId'], r) for r in dp_records[start:stop]]
+
+        compared = []
+        for package in packages:
+            fetched = set()
+            for left, right in package:
+                fetched.add((left['dataproviderId'], left['block_id'], tuple(left['range']), tuple(left.get('popcounts', ()))))
+                fetched.add((right['dataproviderId'], right['block_id'], tuple(right['range']), tuple(right.get('popcounts', ()))))
+                compared.extend(itertools.product(encodings(left), encodings(right)))
+            # at most two slices per dp
+            assert len(fetched) <= 2 * len(dp_ids)
+        expected = [pair for dp1, dp2 in itertools.combinations(dp_ids, 2)
+                    for pair in itertools.product([(dp1, r) for r in range(sizes[dp1])], [(dp2, r) for r in range(sizes[dp2])])]
+        assert sorted(compared) == sorted(expected)
+
+
+class TestLocalityRouting:
+
+    def test_packages_sharing_left_chunk_have_same_key(self):
+        dp_ids = [1, 2]
+        dp_block_sizes = {1: {'1': 100}, 2: {'1': 100}}
+        block_lookups = {1: {'1': 1}, 2: {'1': 2}}
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        packages = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=100)
+        keys = {}
+        for package in packages:
+            keys.setdefault(_locality_key(package), []).append(package)
+        assert len(keys) == 10
+        for key, key_packages in keys.items():
+            assert len({tuple(package[0][0]['range']) for package in key_packages}) == 1
+
+    def test_bundled_packages_have_no_key(self):
+        dp_ids = [1, 2]
+        dp_block_sizes = {1: {'1': 10, '2': 10}, 2: {'1': 10, '2': 10}}
+        block_lookups = {1: {'1': 1, '2': 2}, 2: {'1': 3, '2': 4}}
+        blocks = _get_common_blocks(dp_block_sizes, dp_ids)
+        [package] = _create_work_packages(blocks, dp_block_sizes, dp_ids, log, block_lookups, chunk_size_aim=1000)
+        assert _locality_key(package) is None
+
+    def test_rendezvous_hash(self):
+        workers = ['celery@worker-{}'.format(i) for i in range(5)]
+        keys = [(1, 2, (i, i + 10), ()) for i in range(1000)]
+        assignment = {key: _rendezvous_hash(key, workers) for key in keys}
+        # all workers get a share of the keys
+        assert set(assignment.values()) == set(workers)
+        # removing a worker only moves the keys assigned to it
+        remaining_workers = workers[1:]
+        for key, worker in assignment.items():
+            if worker != workers[0]:
+                assert _rendezvous_hash(key, remaining_workers) == worker
+        assert _rendezvous_hash(keys[0], []) is None
+
+
+class TestPackageCosts:
+
+    def test_estimate_package_cost(self):
+        small = [({'range': (0, 10)}, {'range': (0, 10)})]
+        large = [({'range': (0, 1000)}, {'range': (0, 1000)})]
+        many_small = small * 100
+        assert _estimate_package_cost(large) > _estimate_package_cost(small)
+        assert _estimate_package_cost(many_small) > 100 * 10 * 10
+        cost_model = CostModel(task_overhead=1, fetch_latency=0, fetch_per_encoding=0, chunk_overhead=0,
+                               compare_per_comparison=1e-6)
+        assert _estimate_package_cost(large, cost_model) == 2
+
+
+class TestSpeculativeResults:
+
+    def test_untracked_package(self):
+        assert _claim_package_result('run', None, (1, 2, 'file'), log) == (1, 2, 'file')
+
+    def test_first_copy_wins(self, monkeypatch):
+        claims = {}
+        removed = []
+
+        class FakeObjectStore:
+            def remove_object(self, bucket, filename):
+                removed.append(filename)
+
+        def fake_claim(run_id, package_id, result):
+            return claims.setdefault((run_id, package_id), result)
+
+        monkeypatch.setattr(comparing, 'claim_package_result', fake_claim)
+        monkeypatch.setattr(comparing, 'connect_to_object_store', FakeObjectStore)
+
+        # the speculative copy finishes first
+        assert _claim_package_result('run', 3, (1, 2, 'file-a'), log) == (1, 2, 'file-a')
+        # the original gets the result of the speculative copy, and removes its own file
+        assert _claim_package_result('run', 3, (1, 2, 'file-b'), log) == (1, 2, 'file-a')
+        assert removed == ['file-b']
+        assert _claim_package_result('run', 4, (0, None, None), log) == (0, None, None)
+        assert _claim_package_result('run', 4, (5, 6, 'file-c'), log) == (0, None, None)
+        assert removed == ['file-b', 'file-c']
+
+    def test_winning_result_recorded_once(self, monkeypatch):
+        recorded_files = []
+        done_packages = []
+
+        def fake_add_result_file(run_id, num, filesize, filename):
+            if filename not in recorded_files:
+                recorded_files.append(filename)
+            return len(recorded_files)
+
+        def fake_mark_package_done(run_id, package_id):
+            if package_id in done_packages:
+                return None
+            done_packages.append(package_id)
+            return 1
+
+        monkeypatch.setattr(comparing, 'add_result_file', fake_add_result_file)
+        monkeypatch.setattr(comparing, 'mark_package_done', fake_mark_package_done)
+
+        # both copies record the winning result, e.g. if the winner failed after claiming the package
+        for _ in range(2):
+            _record_package_result('project', 'run', 3, (1, 2, 'file-a'), True, None)
+        _record_package_result('project', 'run', 4, (0, None, None), True, None)
+        assert recorded_files == ['file-a']
+        assert done_packages == [3, 4]
+
+
+class TestTrackedScheduling:
+
+    def test_scheduled_in_batches(self, monkeypatch):
+        sent_tasks = []
+        outstanding = {}
+        recorded_ids = []
+        monkeypatch.setattr(comparing, 'SCHEDULING_BATCH_SIZE', 2)
+        monkeypatch.setattr(comparing, 'set_outstanding_packages',
+                            lambda run_id, num: outstanding.__setitem__(run_id, num))
+        monkeypatch.setattr(comparing, 'add_run_task_ids', lambda run_id, task_ids: recorded_ids.extend(task_ids))
+        monkeypatch.setattr(Signature, 'apply_async', lambda signature: sent_tasks.append(signature))
+
+        packages = [[({'dataproviderId': 1, 'datasetIndex': 0, 'block_id': i, 'range': (0, i)},
+                      {'dataproviderId': 2, 'datasetIndex': 1, 'block_id': i, 'range': (0, i)})] for i in range(1, 6)]
+        _schedule_tracked_comparison_tasks(packages, [1] * 5, 'project', 'run', 0.8, 128,
+                                           deduplicate=False, speculate=False, parent_span=None, log=log)
+        assert outstanding == {'run': 5}
+        assert [signature.kwargs['package_id'] for signature in sent_tasks] == [0, 1, 2, 3, 4]
+        assert all(signature.kwargs['track_completion'] for signature in sent_tasks)
+        assert all(signature.kwargs['estimated_seconds'] is None for signature in sent_tasks)
+        assert [unpack_package(_load_package('run', signature.args[0])) for signature in sent_tasks] == packages
+        assert recorded_ids == [signature.id for signature in sent_tasks]
+
+    def test_no_packages(self, monkeypatch):
+        scheduled = []
+        monkeypatch.setattr(comparing, '_schedule_aggregation', lambda *args: scheduled.append(args))
+        _schedule_tracked_comparison_tasks([], [], 'project', 'run', 0.8, 128,
+                                           deduplicate=False, speculate=False, parent_span=None, log=log)
+        assert scheduled == [('project', 'run', None)]
+
+
+class TestRequeueTasksOfStoppedWorkers:
+
+    def test_tasks_of_stopped_workers_moved(self, monkeypatch):
+        moved_queues = []
+        watched = []
+
+        def fake_move(predicate, app, source):
+            moved_queues.extend(queue.name for queue in source)
+            return SimpleNamespace(filtered=2)
+
+        task = comparing.requeue_tasks_of_stopped_workers
+        monkeypatch.setattr(comparing, 'is_run_active', lambda run_id: True)
+        monkeypatch.setattr(comparing, '_get_live_workers', lambda queue_name: ['celery@a', 'celery@c'])
+        monkeypatch.setattr(comparing, 'move', fake_move)
+        monkeypatch.setattr(comparing, '_watch_routed_workers',
+                            lambda project_id, run_id, workers, parent_span: watched.append(workers))
+        monkeypatch.setattr(task, 'get_serialized_span', lambda: None)
+
+        task.run('project', 'run', ['celery@a', 'celery@b'])
+        assert moved_queues == ['celery@b.dq2']
+        # stopped workers keep being checked, their tasks may be given back by the broker
+        assert watched == [['celery@a', 'celery@b']]
+
+    def test_checks_stop_with_the_run(self, monkeypatch):
+        watched = []
+        monkeypatch.setattr(comparing, 'is_run_active', lambda run_id: False)
+        monkeypatch.setattr(comparing, '_watch_routed_workers', lambda *args: watched.append(args))
+        comparing.requeue_tasks_of_stopped_workers.run('project', 'run', ['celery@a'])
+        assert watched == []
@@ -0,0 +1,129 @@
+import random
+
+import numpy as np
+import pytest
+from anonlink.similarities import dice_coefficient_python
+
+from entityservice.comparison import dice_coefficient_numpy, compare_encodings, pack_encodings, popcounts, \
+    count_candidate_comparisons, _row_tiles
+from entityservice.tests.util import generate_bytes
+
+
+def generate_encodings(n, encoding_size=128):
+    """Random encodings with a wide spread of popcounts."""
+    encodings = []
+    for _ in range(n):
+        density = random.uniform(0.1, 0.6)
+        bits = np.random.random_sample(encoding_size * 8) < density
+        encodings.append(np.packbits(bits).tobytes())
+    return encodings
+
+
+def assert_same_candidates(expected, actual):
+    expected_sims, (expected_is0, expected_is1) = expected
+    actual_sims, (actual_is0, actual_is1) = actual
+    assert list(expected_sims) == list(actual_sims)
+    assert list(expected_is0) == list(actual_is0)
+    assert list(expected_is1) == list(actual_is1)
+
+
+class TestPacking:
+
+    def test_pack_encodings(self):
+        encodings = [generate_bytes(16) for _ in range(5)]
+        packed = pack_encodings(encodings)
+        assert packed.shape == (5, 2)
+        assert packed.dtype == np.uint64
+        assert packed[3].tobytes() == encodings[3]
+
+    def test_pack_encodings_pads_to_words(self):
+        encodings = [b'\xff' * 3, b'\x01\x00\x00']
+        packed = pack_encodings(encodings)
+        assert packed.shape == (2, 1)
+        assert list(popcounts(packed)) == [24, 1]
+
+    def test_pack_inconsistent_sizes(self):
+        with pytest.raises(ValueError):
+            pack_encodings([b'\x00' * 8, b'\x00' * 9])
+
+
+class TestDiceCoefficientNumpy:
+
+    @pytest.mark.parametrize('threshold', [0.0, 0.3, 0.5, 0.8, 1.0])
+    def test_matches_anonlink(self, threshold):
+        encodings0 = generate_encodings(150)
+        encodings1 = generate_encodings(200)
+        expected = dice_coefficient_python((encodings0, encodings1), threshold)
+        sims, indices, _ = dice_coefficient_numpy((encodings0, encodings1), threshold, tile_bytes=8 * 1024)
+        assert_same_candidates(expected, (sims, indices))
+
+    @pytest.mark.parametrize('k', [1, 3])
+    def test_top_k(self, k):
+        encodings0 = generate_encodings(50)
+        encodings1 = generate_encodings(60)
+        expected = dice_coefficient_python((encodings0, encodings1), 0.3, k=k)
+        sims, indices, _ = dice_coefficient_numpy((encodings0, encodings1), 0.3, k=k)
+        assert_same_candidates(expected, (sims, indices))
+
+    def test_empty_encodings(self):
+        encoding = b'\x00' * 8
+        sims, (rec_is0, rec_is1), num_compared = dice_coefficient_numpy(([encoding], [encoding]), 0.0)
+        assert list(sims) == [0.0]
+        assert list(rec_is0) == list(rec_is1) == [0]
+
+    def test_empty_dataset(self):
+        sims, (rec_is0, rec_is1), num_compared = dice_coefficient_numpy(([], generate_encodings(2)), 0.5)
+        assert len(sims) == len(rec_is0) == len(rec_is1) == 0
+        assert num_compared == 0
+
+    def test_popcount_pruning(self):
+        sparse = [np.packbits(np.arange(1024) < 10).tobytes()] * 10
+        dense = [np.packbits(np.arange(1024) < 500).tobytes()] * 10
+        sims, _, num_compared = dice_coefficient_numpy((sparse + dense, sparse + dense), 0.8, tile_bytes=10 * 128)
+        # sparse and dense encodings can't be similar, so they are never compared
+        assert num_compared == 2 * 10 * 10
+        assert len(sims) == 2 * 10 * 10
+
+    def test_count_candidate_comparisons(self):
+        assert count_candidate_comparisons(np.array([10, 500]), np.array([10, 500, 501]), 0.8) == 3
+        assert count_candidate_comparisons(np.array([10, 500]), np.array([10, 500, 501]), 0.0) == 6
+
+
+class TestCompareEncodings:
+
+    @pytest.mark.parametrize('kernel', ['auto', 'anonlink', 'numpy'])
+    def test_kernels_agree(self, kernel):
+        encodings0 = generate_encodings(40)
+        encodings1 = generate_encodings(50)
+        expected = dice_coefficient_python((encodings0, encodings1), 0.4, k=40)
+        sims, indices, stats = compare_encodings(encodings0, encodings1, 0.4, k=40, kernel=kernel)
+        assert_same_candidates(expected, (sims, indices))
+        assert stats['comparisons'] == 40 * 50
+        if kernel != 'auto':
+            assert stats['kernel'] == kernel
+
+    def test_unknown_kernel(self):
+        with pytest.raises(ValueError):
+            compare_encodings(generate_encodings(1), generate_encodings(1), 0.5, kernel='magic')
+
+    @pytest.mark.parametrize('kernel', ['anonlink', 'numpy'])
+    @pytest.mark.parametrize('k', [None, 3])
+    def test_threaded_row_tiles(self, kernel, k, monkeypatch):
+        monkeypatch.setattr('entityservice.comparison.MIN_ROWS_PER_THREAD_TILE', 8)
+        encodings0 = generate_encodings(70)
+        encodings1 = generate_encodings(30)
+        expected = dice_coefficient_python((encodings0, encodings1), 0.3, k=k)
+        sims, indices, stats = compare_encodings(encodings0, encodings1, 0.3, k=k, kernel=kernel, num_threads=2)
+        assert stats['tiles'] > 1
+        assert stats['kernel'] == kernel
+        assert_same_candidates(expected, (sims, indices))
+
+    def test_small_chunks_are_not_tiled(self):
+        _, _, stats = compare_encodings(generate_encodings(20), generate_encodings(20), 0.5, num_threads=4)
+        assert stats['tiles'] == 1
+
+    def test_row_tiles_cover_all_rows(self):
+        tiles = _row_tiles(10_000, 3)
+        assert len(tiles) == 12
+        assert tiles[0][0] == 0 and tiles[-1][1] == 10_000
+        assert all(stop == start for (_, stop), (start, _) in zip(tiles, tiles[1:]))
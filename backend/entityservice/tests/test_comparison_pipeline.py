@@ -0,0 +1,235 @@
+import array
+import contextlib
+import io
+import random
+import threading
+
+import anonlink
+import pytest
+from tenacity import wait_none
+
+from entityservice.tasks.comparing import _split_into_fetch_units, _prefetch, _spill_comparison_results, \
+    _keep_canonical_pairs, _membership_table, _save_comparison_results_to_object_store, _ChunkFetcher
+
+
+class TestFetchUnits:
+
+    def test_single_block_package_fetched_per_chunk_pair(self):
+        package = [('a', 'b'), ('a', 'c'), ('d', 'c')]
+        assert _split_into_fetch_units(package, True) == [[('a', 'b')], [('a', 'c')], [('d', 'c')]]
+
+    def test_block_package_fetched_in_batches(self, monkeypatch):
+        monkeypatch.setattr('entityservice.tasks.comparing.FETCH_UNIT_NUM_BLOCK_PAIRS', 2)
+        package = [(i, i) for i in range(5)]
+        assert _split_into_fetch_units(package, False) == [[(0, 0), (1, 1)], [(2, 2), (3, 3)], [(4, 4)]]
+
+
+class TestPrefetch:
+
+    @pytest.mark.parametrize('depth', [1, 2, 5])
+    def test_order_and_depth(self, depth):
+        fetched = []
+        in_flight = []
+
+        def fetch(unit):
+            fetched.append(unit)
+            return unit * 10
+
+        results = []
+        for result in _prefetch(fetch, range(8), depth):
+            # units fetched but not yet consumed, including the current one
+            in_flight.append(len(fetched) - len(results))
+            results.append(result)
+        assert results == [unit * 10 for unit in range(8)]
+        assert max(in_flight) <= depth
+
+    def test_fetch_error_is_raised(self):
+        def fetch(unit):
+            if unit == 2:
+                raise ValueError(unit)
+            return unit
+
+        with pytest.raises(ValueError):
+            list(_prefetch(fetch, range(5), 2))
+
+    def test_pending_fetches_cancelled_on_close(self):
+        started = []
+        release = threading.Event()
+
+        def fetch(unit):
+            started.append(unit)
+            release.wait(5)
+            return unit
+
+        units = _prefetch(fetch, range(10), 3)
+        release.set()
+        assert next(units) == 0
+        units.close()
+        assert len(started) < 10
+
+
+class TestSpill:
+
+    def test_no_candidates(self):
+        empty = array.array('d'), (array.array('I'), array.array('I')), 0, 1
+        assert _spill_comparison_results([empty]) is None
+
+    def test_results_are_merged_sorted(self):
+        chunk_results = [
+            (array.array('d', [0.9, 0.7]), (array.array('I', [1, 2]), array.array('I', [3, 4])), 0, 1),
+            (array.array('d', [0.95, 0.8]), (array.array('I', [5, 6]), array.array('I', [7, 8])), 0, 1),
+        ]
+        spill_file, size = _spill_comparison_results(chunk_results)
+        assert len(spill_file.read()) == size
+        spill_file.seek(0)
+        sims, (dset_is0, dset_is1), (rec_is0, rec_is1) = anonlink.serialization.load_candidate_pairs(spill_file)
+        spill_file.close()
+        assert list(sims) == [0.95, 0.9, 0.8, 0.7]
+        assert list(rec_is0) == [5, 1, 6, 2]
+        assert list(rec_is1) == [7, 3, 8, 4]
+        assert set(dset_is0) == {0} and set(dset_is1) == {1}
+
+
+class FlakyObjectStore:
+    """Fails the first upload after reading part of the stream."""
+
+    def __init__(self):
+        self.attempts = 0
+        self.uploaded = None
+
+    def put_object(self, bucket, name, data, length):
+        self.attempts += 1
+        if self.attempts == 1:
+            data.read(10)
+            raise ConnectionError('connection reset')
+        self.uploaded = data.read()
+
+
+class TestSaveResults:
+
+    @pytest.mark.parametrize('num_spills', [1, 2])
+    def test_retry_uploads_whole_file(self, monkeypatch, num_spills):
+        object_store = FlakyObjectStore()
+        monkeypatch.setattr('entityservice.tasks.comparing.connect_to_object_store', lambda: object_store)
+        spills = [_spill_comparison_results([
+            (array.array('d', [0.9 - i / 10, 0.5]), (array.array('I', [i, 2]), array.array('I', [3, i])), 0, 1)])
+            for i in range(num_spills)]
+
+        save = _save_comparison_results_to_object_store.retry_with(wait=wait_none())
+        file_size = save(spills, 'results', None)
+
+        assert object_store.attempts == 2
+        assert len(object_store.uploaded) == file_size
+        sims, _, _ = anonlink.serialization.load_candidate_pairs(io.BytesIO(object_store.uploaded))
+        assert len(sims) == 2 * num_spills
+        for spill_file, _ in spills:
+            spill_file.close()
+
+
+class TestChunkFetcher:
+
+    def test_single_block_chunks_fetched_once(self, monkeypatch):
+        fetched = []
+
+        def get_encoding_chunk(conn, chunk_info, encoding_size, cache=None):
+            fetched.append(chunk_info['range'])
+            return object(), 10
+
+        monkeypatch.setattr('entityservice.tasks.comparing.DBConn', contextlib.nullcontext)
+        monkeypatch.setattr('entityservice.tasks.comparing.unpack_package', lambda unit: unit)
+        monkeypatch.setattr('entityservice.tasks.comparing.get_encoding_chunk', get_encoding_chunk)
+
+        def chunk(dp_id, start):
+            return {'dataproviderId': dp_id, 'block_id': 1, 'range': [start, start + 10]}
+
+        # the chunk pairs of a package comparing the slots 0 and 1 of a block of three data providers
+        package = [(chunk(dp1, a), chunk(dp2, b)) for dp1, dp2 in [(1, 2), (1, 3), (2, 3)] for a, b in [(0, 10), (10, 0)]]
+        fetcher = _ChunkFetcher(128, None, True)
+        for unit in _split_into_fetch_units(package, True):
+            fetcher.fetch(unit)
+
+        assert len(fetched) == 6
+        assert fetcher.num_encodings == 60
+
+    def test_single_block_memberships_looked_up_once(self, monkeypatch):
+        looked_up = []
+
+        def get_multi_block_memberships(conn, block_ranges):
+            looked_up.append(block_ranges)
+            # the first record of each range also belongs to block 'a'
+            return [{start: frozenset({'a', 'b'})} for _, start, _, _ in block_ranges]
+
+        monkeypatch.setattr('entityservice.tasks.comparing.DBConn', contextlib.nullcontext)
+        monkeypatch.setattr('entityservice.tasks.comparing.unpack_package', lambda unit: unit)
+        monkeypatch.setattr('entityservice.tasks.comparing.get_encoding_chunk', lambda *args, **kwargs: (None, 10))
+        monkeypatch.setattr('entityservice.tasks.comparing.get_multi_block_memberships', get_multi_block_memberships)
+        monkeypatch.setattr('entityservice.tasks.comparing.get_block_names', lambda conn, block_ids: {7: 'b'})
+
+        def chunk(dp_id, start):
+            return {'dataproviderId': dp_id, 'block_id': 7, 'range': [start, start + 10]}
+
+        package = [(chunk(1, a), chunk(2, b)) for a, b in [(0, 0), (0, 10), (10, 10)]]
+        fetcher = _ChunkFetcher(128, None, True, deduplicate=True)
+        units = [fetcher.fetch(unit) for unit in _split_into_fetch_units(package, True)]
+
+        # one query per unit, only for the ranges not looked up yet
+        assert looked_up == [[(7, 0, 10, None), (7, 0, 10, None)], [(7, 10, 20, None)], [(7, 10, 20, None)]]
+        chunk_dp1, chunk_dp2 = units[1][0]
+        assert (chunk_dp1['block_name'], chunk_dp1['block_rank']) == ('b', 1)
+        assert list(chunk_dp1['block_memberships'][0]) == [0]
+        assert list(chunk_dp2['block_memberships'][0]) == [10]
+
+
+class TestCanonicalPairs:
+
+    def _chunk(self, block_name, memberships, names='abcdefgh'):
+        block_ranks = {name: rank for rank, name in enumerate(names)}
+        return {'block_name': block_name, 'block_rank': block_ranks[block_name],
+                'block_memberships': _membership_table(memberships, block_ranks)}
+
+    def test_pairs_only_kept_in_lowest_shared_block(self):
+        sims = array.array('d', [0.9, 0.8, 0.7, 0.6])
+        rec_is0 = array.array('I', [1, 2, 3, 4])
+        rec_is1 = array.array('I', [10, 20, 30, 40])
+        memberships0 = {1: frozenset('ab'), 2: frozenset('bc'), 3: frozenset('ab')}
+        memberships1 = {10: frozenset('ab'), 20: frozenset('bc'), 30: frozenset('bd')}
+        # in block 'b': pair (1, 10) belongs to 'a', (2, 20) to 'b', (3, 30) only shares 'b',
+        # and record 4 only belongs to 'b'.
+        kept_sims, kept_is0, kept_is1, dropped = _keep_canonical_pairs(
+            sims, rec_is0, rec_is1, self._chunk('b', memberships0), self._chunk('b', memberships1))
+        assert list(kept_sims) == [0.8, 0.7, 0.6]
+        assert list(kept_is0) == [2, 3, 4]
+        assert list(kept_is1) == [20, 30, 40]
+        assert dropped == 1
+
+        # the same pairs found in block 'a'
+        kept_sims, kept_is0, kept_is1, dropped = _keep_canonical_pairs(
+            sims[:1], rec_is0[:1], rec_is1[:1], self._chunk('a', memberships0), self._chunk('a', memberships1))
+        assert list(kept_is0) == [1] and dropped == 0
+
+    def test_no_memberships(self):
+        sims, rec_is0, rec_is1 = array.array('d', [0.9]), array.array('I', [1]), array.array('I', [2])
+        assert _keep_canonical_pairs(sims, rec_is0, rec_is1, self._chunk('a', {}), self._chunk('a', {1: 'ab'})) \
+            == (sims, rec_is0, rec_is1, 0)
+
+    def test_matches_pairwise_definition(self):
+        rng = random.Random(0)
+        names = 'abcdefgh'
+        memberships0 = {i: frozenset(rng.sample(names, rng.randint(2, 5))) | {'d'} for i in range(0, 200, 2)}
+        memberships1 = {i: frozenset(rng.sample(names, rng.randint(2, 5))) | {'d'} for i in range(0, 200, 3)}
+        rec_is0 = array.array('I', [rng.randrange(200) for _ in range(1000)])
+        rec_is1 = array.array('I', [rng.randrange(200) for _ in range(1000)])
+        sims = array.array('d', [rng.random() for _ in range(1000)])
+
+        def is_canonical(rec_i0, rec_i1):
+            shared_blocks = memberships0.get(rec_i0, {'d'}) & memberships1.get(rec_i1, {'d'})
+            return min(shared_blocks) == 'd'
+
+        kept = [i for i in range(1000) if is_canonical(rec_is0[i], rec_is1[i])]
+        kept_sims, kept_is0, kept_is1, dropped = _keep_canonical_pairs(
+            sims, rec_is0, rec_is1, self._chunk('d', memberships0), self._chunk('d', memberships1))
+        assert 0 < dropped < 1000
+        assert dropped == 1000 - len(kept)
+        assert list(kept_sims) == [sims[i] for i in kept]
+        assert list(kept_is0) == [rec_is0[i] for i in kept]
+        assert list(kept_is1) == [rec_is1[i] for i in kept]
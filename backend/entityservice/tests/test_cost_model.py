@@ -0,0 +1,49 @@
+import pytest
+
+from entityservice.cost_model import CostModel, LinearFit
+
+
+class TestLinearFit:
+
+    def test_solve(self):
+        fit = LinearFit()
+        for x in range(1, 100):
+            fit.add(x, 2.0 + 0.5 * x)
+        intercept, slope = fit.solve()
+        assert intercept == pytest.approx(2.0)
+        assert slope == pytest.approx(0.5)
+
+    def test_solve_single_x(self):
+        # all samples have the same x, so we can't tell the intercept apart
+        fit = LinearFit()
+        for _ in range(10):
+            fit.add(100, 5.0)
+        assert fit.solve() == (0.0, pytest.approx(0.05))
+
+    def test_solve_empty(self):
+        assert LinearFit().solve() == (0.0, 0.0)
+
+
+class TestCostModel:
+
+    def make_model(self, **kwargs):
+        params = dict(task_overhead=1.0, fetch_latency=0.5, fetch_per_encoding=1e-5,
+                      chunk_overhead=0.01, compare_per_comparison=1e-8)
+        params.update(kwargs)
+        return CostModel(**params)
+
+    def test_estimate_package(self):
+        model = self.make_model()
+        chunk = ({'range': (0, 1000)}, {'range': (100, 300)})
+        expected = 1.0 + 0.5 + 2 * (0.01 + 1e-5 * 1200 + 1e-8 * 1000 * 200)
+        assert model.estimate_package([chunk, chunk]) == pytest.approx(expected)
+
+    def test_chunk_size_aim(self):
+        model = self.make_model()
+        chunk_size_aim = model.chunk_size_aim(30)
+        n = int(chunk_size_aim ** 0.5)
+        assert model.estimate_package([({'range': (0, n)}, {'range': (0, n)})]) == pytest.approx(30, rel=1e-3)
+
+    def test_chunk_size_aim_unknown(self):
+        assert self.make_model(task_overhead=60).chunk_size_aim(30) is None
+        assert self.make_model(compare_per_comparison=0).chunk_size_aim(30) is None
@@ -0,0 +1,77 @@
+import array
+
+import numpy as np
+import pytest
+
+from entityservice.comparison import compare_encodings, pack_encodings
+from entityservice.encoding_block import EncodingBlock
+from entityservice.serialization import binary_format
+from entityservice.tests.util import generate_bytes
+
+
+def make_pairs(n, encoding_size=16):
+    return [(i * 7 + 1, generate_bytes(encoding_size)) for i in range(n)]
+
+
+class TestEncodingBlock:
+
+    def test_from_pairs(self):
+        pairs = make_pairs(10)
+        block = EncodingBlock.from_pairs(pairs, 16)
+        assert len(block) == 10
+        assert block.encoding_size == 16
+        assert block.entity_ids.dtype == np.uint32
+        assert block.encodings.shape == (10, 16)
+        assert block.to_pairs() == pairs
+
+    def test_from_binary(self):
+        pairs = make_pairs(10)
+        data = b''.join(binary_format(16).pack(*pair) for pair in pairs)
+        block = EncodingBlock.from_binary(data, 16)
+        assert block.to_pairs() == pairs
+        assert block.encodings.flags.c_contiguous
+
+    def test_empty(self):
+        assert len(EncodingBlock.from_pairs([], 16)) == 0
+        assert EncodingBlock.empty(16).encodings.shape == (0, 16)
+
+    def test_slices_share_arrays(self):
+        block = EncodingBlock.from_pairs(make_pairs(10), 16)
+        part = block[2:5]
+        assert part.to_pairs() == block.to_pairs()[2:5]
+        assert np.shares_memory(part.encodings, block.encodings)
+        assert np.shares_memory(part.entity_ids, block.entity_ids)
+
+    def test_no_instance_dict(self):
+        block = EncodingBlock.empty(16)
+        with pytest.raises(AttributeError):
+            block.extra = 1
+
+    def test_mismatched_lengths(self):
+        with pytest.raises(ValueError):
+            EncodingBlock([1, 2], np.zeros((3, 16), dtype=np.uint8))
+
+    def test_take_entity_ids(self):
+        block = EncodingBlock.from_pairs(make_pairs(10), 16)
+        entity_ids = block.take_entity_ids(array.array('I', [3, 0, 3]))
+        assert entity_ids == array.array('I', [22, 1, 22])
+        assert block.take_entity_ids(array.array('I')) == array.array('I')
+
+    def test_packed_without_copy(self):
+        block = EncodingBlock.from_pairs(make_pairs(10), 16)
+        packed = pack_encodings(block)
+        assert packed.shape == (10, 2)
+        assert np.shares_memory(packed, block.encodings)
+
+    @pytest.mark.parametrize('kernel', ['anonlink', 'numpy'])
+    def test_accepted_by_comparison_kernels(self, kernel):
+        pairs0, pairs1 = make_pairs(30), make_pairs(40)
+        # every record of the first block is also in the second one
+        pairs1[:30] = pairs0
+        expected = compare_encodings([e for _, e in pairs0], [e for _, e in pairs1], 1.0, kernel=kernel)
+        actual = compare_encodings(EncodingBlock.from_pairs(pairs0, 16), EncodingBlock.from_pairs(pairs1, 16), 1.0,
+                                   kernel=kernel)
+        assert list(actual[0]) == list(expected[0])
+        assert list(actual[1][0]) == list(expected[1][0])
+        assert list(actual[1][1]) == list(expected[1][1])
+        assert len(actual[0]) >= 30
@@ -5,19 +5,24 @@ import io
 
 import pytest
 
-from entityservice.encoding_storage import hash_block_name, stream_json_clksnblocks
-from entityservice.tests.util import serialize_bytes
+from entityservice.encoding_storage import hash_block_name, stream_json_clksnblocks, prepare_encodings, \
+    include_encoding_id_in_binary_stream, include_encoding_id_in_json_stream, DEFAULT_BLOCK_ID
+from entityservice.serialization import binary_format
+from entityservice.settings import Config
+from entityservice.tests.util import serialize_bytes, generate_bytes
 
 
 class TestEncodingStorage:
     def test_convert_encodings_from_json_to_binary_simple(self):
         filename = Path(__file__).parent / 'testdata' / 'test_encoding.json'
         with open(filename, 'rb') as f:
-            # stream_json_clksnblocks produces a generator of (entity_id, base64 encoding, list of blocks)
-            encoding_ids, encodings, blocks = list(zip(*stream_json_clksnblocks(f)))
+            # stream_json_clksnblocks produces a generator of (base64 encodings, block names) groups
+            groups = list(stream_json_clksnblocks(f))
+            assert len(groups) == 1
+            encoding_ids, _, blocks = prepare_encodings(0, groups[0], hash_blocks=True)
 
             assert len(encoding_ids) == 4
-            assert len(encodings) == 4
+            assert len(groups[0][0]) == 4
             first_blocks = list(blocks[0])
             assert len(first_blocks) == 1
             assert first_blocks[0] == hash_block_name('1')
@@ -33,21 +38,31 @@ class TestEncodingStorage:
     def test_convert_encodings_from_json_to_binary_short(self):
         d = serialize_bytes(b'abcdabcd')
         json_data = io.BytesIO(b'{' + f'''"clknblocks": [["{d}", "02"]]'''.encode() + b'}')
-        encoding_ids, encodings, blocks = list(zip(*stream_json_clksnblocks(json_data)))
+        [group] = stream_json_clksnblocks(json_data)
+        _, encodings, blocks = prepare_encodings(0, group, hash_blocks=True)
 
-        assert len(encodings[0]) == 8
+        assert encodings.dtype.itemsize == 4 + 8
         assert hash_block_name("02") in blocks[0]
 
     def test_convert_encodings_from_json_to_binary_large_block_name(self):
         d = serialize_bytes(b'abcdabcd')
         large_block_name = 'b10ck' * 64
         json_data = io.BytesIO(b'{' + f'''"clknblocks": [["{d}", "{large_block_name}"]]'''.encode() + b'}')
-        encoding_ids, encodings, blocks = list(zip(*stream_json_clksnblocks(json_data)))
+        [group] = stream_json_clksnblocks(json_data)
+        _, encodings, blocks = prepare_encodings(0, group, hash_blocks=True)
 
         assert len(hash_block_name(large_block_name)) <= 64
-        assert len(encodings[0]) == 8
+        assert encodings.dtype.itemsize == 4 + 8
         assert hash_block_name(large_block_name) in blocks[0]
 
+    def test_convert_encodings_from_json_in_groups(self):
+        records = ', '.join(f'["{serialize_bytes(generate_bytes(8))}", "{i}"]' for i in range(5))
+        json_data = io.BytesIO(f'{{"clknblocks": [{records}]}}'.encode())
+        groups = list(stream_json_clksnblocks(json_data, group_size=2))
+
+        assert [len(encodings) for encodings, _ in groups] == [2, 2, 1]
+        assert [blocks for _, block_names in groups for blocks in block_names] == [[str(i)] for i in range(5)]
+
     def test_hash_block_names_speed(self):
         timeout = 10
         input_strings = [str(i) for i in range(1_000_000)]
@@ -57,3 +72,46 @@ class TestEncodingStorage:
             hash_block_name(input_str)
             if i % 10_000 == 0:
                 assert time.time() <= (start_time + timeout)
+
+    def test_prepare_encodings(self):
+        encodings = [generate_bytes(8) for _ in range(3)]
+        group = [serialize_bytes(encoding) for encoding in encodings], [['1'], ['1', 2], []]
+
+        entity_ids, binary_encodings, blocks = prepare_encodings(10, group, hash_blocks=True)
+
+        assert entity_ids.tolist() == [10, 11, 12]
+        assert binary_encodings.tobytes() == b''.join(binary_format(8).pack(i, e) for i, e in zip([10, 11, 12], encodings))
+        assert blocks == [[hash_block_name('1')], [hash_block_name('1'), hash_block_name(2)], []]
+
+    def test_prepare_binary_slab(self):
+        encodings = [generate_bytes(8) for _ in range(3)]
+        group = b''.join(encodings), [['1']] * 3
+
+        entity_ids, binary_encodings, blocks = prepare_encodings(0, group, encoding_size=8)
+
+        assert binary_encodings.tobytes() == b''.join(binary_format(8).pack(i, e) for i, e in enumerate(encodings))
+        assert blocks == [['1']] * 3
+
+    def test_prepare_encodings_of_wrong_size(self):
+        with pytest.raises(ValueError):
+            prepare_encodings(0, ([serialize_bytes(generate_bytes(8)), serialize_bytes(generate_bytes(4))], [[], []]))
+        with pytest.raises(ValueError):
+            prepare_encodings(0, ([serialize_bytes(generate_bytes(8))], [[]]), encoding_size=16)
+        with pytest.raises(ValueError):
+            prepare_encodings(0, (generate_bytes(20), [[], [], []]), encoding_size=8)
+
+    def test_binary_stream_read_in_slabs(self, monkeypatch):
+        monkeypatch.setattr(Config, 'INGESTION_GROUP_SIZE', 4)
+        encodings = [generate_bytes(8) for _ in range(10)]
+        stream = io.BytesIO(b''.join(encodings))
+
+        groups = list(include_encoding_id_in_binary_stream(stream, 8, 10))
+
+        assert [len(block_names) for _, block_names in groups] == [4, 4, 2]
+        assert b''.join(slab for slab, _ in groups) == b''.join(encodings)
+        assert all(block_names == [[DEFAULT_BLOCK_ID]] * len(block_names) for _, block_names in groups)
+
+    def test_json_stream_grouped(self, monkeypatch):
+        monkeypatch.setattr(Config, 'INGESTION_GROUP_SIZE', 2)
+        groups = list(include_encoding_id_in_json_stream(iter(['a', 'b', 'c']), 8, 3, block_names=[['1'], ['2'], ['3']]))
+        assert groups == [(['a', 'b'], [['1'], ['2']]), (['c'], [['3']])]
@@ -0,0 +1,145 @@
+import contextlib
+import threading
+
+import pytest
+
+from entityservice import ingestion
+from entityservice.ingestion import group_records, run_pipeline, ingest_encodings
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.written = []
+        self.rolled_back = False
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+class FakeConnections:
+
+    def __init__(self):
+        self.connections = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def __call__(self):
+        conn = FakeConnection()
+        with self.lock:
+            self.connections.append(conn)
+        yield conn
+
+    @property
+    def written(self):
+        return [item for conn in self.connections for item in conn.written]
+
+
+def write(conn, prepared):
+    conn.written.extend(prepared)
+
+
+def prepare(first_record, group):
+    return [(first_record + i, record.upper()) for i, record in enumerate(group)]
+
+
+class TestGroupRecords:
+
+    def test_groups(self):
+        assert list(group_records('abcdefg', 3)) == [list('abc'), list('def'), ['g']]
+
+    def test_empty(self):
+        assert list(group_records([], 3)) == []
+
+
+class TestRunPipeline:
+
+    @pytest.mark.parametrize('num_workers, num_writers, max_in_flight', [(1, 1, 1), (4, 2, 3), (3, 3, 16)])
+    def test_records_numbered_in_order(self, num_workers, num_writers, max_in_flight):
+        records = [f'record{i}' for i in range(1000)]
+        connections = FakeConnections()
+
+        num_records = run_pipeline(group_records(records, 7), prepare, write, num_workers, num_writers,
+                                   max_in_flight, connect=connections)
+
+        assert num_records == len(records)
+        assert len(connections.connections) == num_writers
+        assert sorted(connections.written) == [(i, record.upper()) for i, record in enumerate(records)]
+        assert not any(conn.rolled_back for conn in connections.connections)
+
+    def test_groups_in_flight_bounded(self):
+        max_in_flight = 2
+        read, written = [], []
+
+        def groups():
+            for i in range(20):
+                # groups read but not yet written
+                assert len(read) - len(written) <= max_in_flight
+                read.append(i)
+                yield [str(i)]
+
+        def record_write(conn, prepared):
+            written.extend(prepared)
+
+        run_pipeline(groups(), prepare, record_write, 2, 1, max_in_flight, connect=FakeConnections())
+        assert len(written) == 20
+
+    def test_worker_error(self):
+        connections = FakeConnections()
+
+        def failing_prepare(first_record, group):
+            if first_record >= 50:
+                raise ValueError('invalid encoding')
+            return prepare(first_record, group)
+
+        with pytest.raises(ValueError, match='invalid encoding'):
+            run_pipeline(group_records(['a'] * 1000, 10), failing_prepare, write, 2, 2, 4, connect=connections)
+        assert all(conn.rolled_back for conn in connections.connections)
+
+    def test_writer_error(self):
+        connections = FakeConnections()
+
+        def failing_write(conn, prepared):
+            raise IOError('connection lost')
+
+        with pytest.raises(IOError, match='connection lost'):
+            run_pipeline(group_records(['a'] * 1000, 10), prepare, failing_write, 2, 2, 4, connect=connections)
+        assert all(conn.rolled_back for conn in connections.connections)
+
+    def test_parser_error(self):
+        connections = FakeConnections()
+
+        def groups():
+            yield ['a', 'b']
+            raise ValueError('invalid json')
+
+        with pytest.raises(ValueError, match='invalid json'):
+            run_pipeline(groups(), prepare, write, 2, 1, 4, connect=connections)
+        assert all(conn.rolled_back for conn in connections.connections)
+
+    def test_connection_error(self):
+        def connect():
+            raise ConnectionError('no connection available')
+
+        with pytest.raises(ConnectionError):
+            run_pipeline(group_records(['a'] * 100, 1), prepare, write, 2, 1, 2, connect=connect)
+
+
+class TestIngestEncodings:
+
+    def test_encodings_deleted_on_failure(self, monkeypatch):
+        deleted = []
+
+        class FakeConn:
+            def commit(self):
+                pass
+
+        def failing_pipeline(*args, **kwargs):
+            raise IOError('connection lost')
+
+        monkeypatch.setattr(ingestion, 'run_pipeline', failing_pipeline)
+        monkeypatch.setattr(ingestion, 'delete_dataprovider_encodings', lambda conn, dp_id: deleted.append(dp_id))
+
+        with pytest.raises(IOError, match='connection lost'):
+            ingest_encodings(FakeConn(), 42, [], prepare, block_lookup={})
+        assert deleted == [42]
@@ -0,0 +1,61 @@
+import itertools
+
+import pytest
+
+from entityservice.popcount_banding import max_dice_coefficient, split_into_bands, plan_block_comparisons, \
+    count_planned_comparisons
+
+
+def test_max_dice_coefficient():
+    assert max_dice_coefficient((10, 20, 5), (15, 30, 5)) == 1.0
+    assert max_dice_coefficient((10, 20, 5), (30, 40, 5)) == pytest.approx(2 * 20 / 50)
+    assert max_dice_coefficient((30, 40, 5), (10, 20, 5)) == pytest.approx(2 * 20 / 50)
+
+
+def test_split_into_bands():
+    histogram = {1: 3, 2: 3, 5: 1, 7: 10, 8: 1}
+    bands = split_into_bands(histogram, 4)
+    assert bands == [(1, 2, 6), (5, 7, 11), (8, 8, 1)]
+    assert sum(band[2] for band in bands) == sum(histogram.values())
+
+
+def test_split_into_single_band():
+    assert split_into_bands({3: 1, 4: 1}, 100) == [(3, 4, 2)]
+
+
+class TestPlanBlockComparisons:
+
+    def test_no_histogram(self):
+        assert plan_block_comparisons(None, 100, {1: 100}, 100, 0.8, 100) == [(None, None)]
+
+    def test_inconsistent_histogram(self):
+        # the histogram doesn't account for all encodings in the block
+        assert plan_block_comparisons({1: 50}, 100, {1: 100}, 100, 0.8, 100) == [(None, None)]
+
+    def test_small_blocks(self):
+        assert plan_block_comparisons({10: 5}, 5, {12: 5}, 5, 0.8, 100) == [(None, None)]
+        assert plan_block_comparisons({10: 5}, 5, {500: 5}, 5, 0.8, 100) == []
+
+    def test_no_threshold(self):
+        assert plan_block_comparisons({10: 50}, 50, {500: 50}, 50, 0.0, 100) == [(None, None)]
+
+    @pytest.mark.parametrize('threshold', [0.5, 0.8, 0.95])
+    def test_banded_blocks(self, threshold):
+        histogram0 = {popcount: 10 for popcount in range(100, 600, 10)}
+        histogram1 = {popcount: 20 for popcount in range(105, 605, 20)}
+        size0, size1 = sum(histogram0.values()), sum(histogram1.values())
+        band_pairs = plan_block_comparisons(histogram0, size0, histogram1, size1, threshold, 2000)
+        assert len(band_pairs) > 1
+        # every pair of popcounts that could reach the threshold is covered by exactly one band pair
+        for pa, pb in itertools.product(histogram0, histogram1):
+            covering = [(b0, b1) for b0, b1 in band_pairs if b0[0] <= pa <= b0[1] and b1[0] <= pb <= b1[1]]
+            if 2 * min(pa, pb) / (pa + pb) >= threshold:
+                assert len(covering) == 1
+            else:
+                assert len(covering) <= 1
+        assert count_planned_comparisons(band_pairs, size0, size1) < size0 * size1
+
+
+def test_count_planned_comparisons():
+    assert count_planned_comparisons([(None, None)], 10, 20) == 200
+    assert count_planned_comparisons([((1, 2, 3), (1, 2, 4)), ((3, 4, 5), (3, 4, 6))], 8, 10) == 3 * 4 + 5 * 6
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from entityservice import run_estimates
+from entityservice.encoding_block import EncodingBlock
+from entityservice.run_estimates import estimate_candidate_rate, estimate_run
+
+ENCODING_SIZE = 8
+MATCHING = b'\xff' * ENCODING_SIZE
+NOT_MATCHING = b'\x00' * (ENCODING_SIZE - 1) + b'\x01'
+
+# block name, block id and number of encodings of the blocks of two data providers
+BLOCKS = {
+    1: [('a', 10, 40), ('b', 11, 30), ('c', 12, 5)],
+    2: [('a', 20, 50), ('b', 21, 10), ('d', 22, 7)],
+}
+
+
+def fake_get_encoding_chunk(conn, chunk_info, encoding_size):
+    """Every other encoding of the second data provider matches the encodings of the first one."""
+    start, stop = chunk_info['range']
+    if chunk_info['dataproviderId'] == 1:
+        encodings = [MATCHING] * (stop - start)
+    else:
+        encodings = [MATCHING if i % 2 == 0 else NOT_MATCHING for i in range(start, stop)]
+    return EncodingBlock.from_pairs(zip(range(start, stop), encodings), encoding_size), stop - start
+
+
+@pytest.fixture
+def fake_project(monkeypatch):
+    monkeypatch.setattr(run_estimates, 'get_dataprovider_ids', lambda conn, project_id: [1, 2])
+    monkeypatch.setattr(run_estimates, 'get_block_metadata', lambda conn, dp_id: BLOCKS[dp_id])
+    monkeypatch.setattr(run_estimates, 'get_project_encoding_size', lambda conn, project_id: ENCODING_SIZE)
+    monkeypatch.setattr(run_estimates, 'get_project_column', lambda conn, project_id, column: 'groups')
+    monkeypatch.setattr(run_estimates, 'get_block_popcount_histograms', lambda conn, dp_id: [])
+    monkeypatch.setattr(run_estimates, 'get_total_comparisons_for_project',
+                        lambda conn, project_id, threshold, chunk_size_aim: 40 * 50 + 30 * 10)
+    monkeypatch.setattr(run_estimates, 'get_latest_rate', lambda conn, default: 100)
+    monkeypatch.setattr(run_estimates, 'get_encoding_chunk', fake_get_encoding_chunk)
+
+
+class TestEstimateRun:
+
+    def test_estimate(self, fake_project):
+        estimate = estimate_run(None, 'project', 0.9, sample_comparisons=10_000, rng=random.Random(0))
+        assert estimate['comparisons'] == 2300
+        assert 0 < estimate['sampled_comparisons'] <= 10_000
+        assert estimate['candidate_pairs'] == pytest.approx(2300 / 2, rel=0.05)
+        assert estimate['seconds'] == 23
+        assert estimate['peak_memory_bytes'] > estimate['candidate_pairs'] * run_estimates.CANDIDATE_PAIR_BYTES
+        assert estimate['exceeded_limits'] == []
+
+    def test_pruned_block_pair(self, fake_project, monkeypatch):
+        # the popcounts of the blocks 'b' rule out any similarity above the threshold
+        histograms = {1: [(11, {64: 30})], 2: [(21, {1: 10})]}
+        monkeypatch.setattr(run_estimates, 'get_block_popcount_histograms', lambda conn, dp_id: histograms[dp_id])
+        monkeypatch.setattr(run_estimates, 'get_total_comparisons_for_project',
+                            lambda conn, project_id, threshold, chunk_size_aim: 40 * 50)
+        monkeypatch.setattr(run_estimates.Config, 'CHUNK_SIZE_AIM', 10_000)
+        monkeypatch.setattr(run_estimates.Config, 'CELERYD_CONCURRENCY', 3)
+
+        estimate = estimate_run(None, 'project', 0.9, sample_comparisons=10_000, rng=random.Random(0))
+        assert estimate['comparisons'] == 2000
+        assert estimate['candidate_pairs'] == pytest.approx(2000 / 2, rel=0.05)
+        chunk_memory_bytes = 2 * 100 * ENCODING_SIZE * 3
+        assert estimate['peak_memory_bytes'] == \
+            estimate['candidate_pairs'] * run_estimates.CANDIDATE_PAIR_BYTES + chunk_memory_bytes
+
+    def test_sample_budget(self, fake_project):
+        estimate = estimate_run(None, 'project', 0.9, sample_comparisons=200, rng=random.Random(0))
+        assert estimate['sampled_comparisons'] <= 200
+
+    def test_exceeded_limits(self, fake_project, monkeypatch):
+        monkeypatch.setattr(run_estimates.Config, 'SOLVER_MAX_CANDIDATE_PAIRS', 100)
+        estimate = estimate_run(None, 'project', 0.9, sample_comparisons=10_000, rng=random.Random(0))
+        assert estimate['exceeded_limits'] == ['SOLVER_MAX_CANDIDATE_PAIRS']
+
+    def test_unknown_comparison_rate(self, fake_project, monkeypatch):
+        monkeypatch.setattr(run_estimates, 'get_latest_rate', lambda conn, default: default)
+        assert estimate_run(None, 'project', 0.9, sample_comparisons=10_000)['seconds'] is None
+
+
+def test_no_common_blocks():
+    assert estimate_candidate_rate(None, [], 0.9, ENCODING_SIZE, 1000) == (0.0, 0)
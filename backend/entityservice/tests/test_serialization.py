@@ -2,12 +2,15 @@ import io
 import json
 import random
 import unittest
+import unittest.mock
 from array import array
 
 import anonlink
+import numpy as np
 
+from entityservice import serialization
 from entityservice.serialization import deserialize_bytes, generate_scores, binary_pack_filters, \
-    binary_unpack_filters, binary_unpack_one, binary_format
+    binary_unpack_filters, binary_unpack_one, binary_format, binary_pack_encodings, deserialize_bytes_batch
 from entityservice.tests.util import serialize_bytes, generate_bytes
 
 
@@ -81,6 +84,60 @@ class SerializationTest(unittest.TestCase):
                                                   encoding_size=encoding_size)
         assert filters == laundered_filters
 
+    def test_binary_pack_encodings(self):
+        encoding_size = 13
+        entity_ids = [random.randint(0, 2 ** 32 - 1) for _ in range(10)]
+        encodings = [generate_bytes(encoding_size) for _ in range(10)]
+        packed = binary_pack_encodings(entity_ids, np.frombuffer(b''.join(encodings), dtype=np.uint8).reshape(10, -1))
+        assert packed.tobytes() == b''.join(binary_pack_filters(zip(entity_ids, encodings), encoding_size))
+
+    def test_deserialize_bytes_batch(self):
+        for encoding_size in (1, 2, 3, 128):
+            encodings = [generate_bytes(encoding_size) for _ in range(10)]
+            decoded = deserialize_bytes_batch([serialize_bytes(encoding) for encoding in encodings])
+            assert decoded.shape == (10, encoding_size)
+            assert [bytes(encoding) for encoding in decoded] == encodings
+
+    def test_deserialize_bytes_batch_of_different_sizes(self):
+        with self.assertRaises(ValueError):
+            deserialize_bytes_batch([serialize_bytes(generate_bytes(8)), serialize_bytes(generate_bytes(9))])
+
+
+class _ObjectResponse(io.BytesIO):
+
+    def __init__(self, data, opened):
+        super().__init__(data)
+        self.released = False
+        opened.append(self)
+
+    def release_conn(self):
+        self.released = True
+
+
+class ShardedSimilarityScoresTest(unittest.TestCase):
+
+    def test_shards_closed(self):
+        opened = []
+        shards = {}
+        for name, sims, rec_is in [('a', [0.9, 0.7], [1, 3]), ('b', [0.8], [2])]:
+            candidate_pairs = (array('d', sims), (array('I', [0] * len(sims)), array('I', [1] * len(sims))),
+                               (array('I', rec_is), array('I', rec_is)))
+            file_iter, _ = anonlink.serialization.dump_candidate_pairs_iter(candidate_pairs)
+            shards[name] = b''.join(file_iter)
+
+        class FakeObjectStore:
+            def get_object(self, bucket, name):
+                return _ObjectResponse(shards[name], opened)
+
+        with unittest.mock.patch.object(serialization, 'connect_to_object_store', FakeObjectStore):
+            response = serialization.get_sharded_similarity_scores(['a', 'b'])
+        scores = json.loads(''.join(response.response))['similarity_scores']
+        response.close()
+
+        assert [score[2] for score in scores] == [0.9, 0.8, 0.7]
+        assert len(opened) == 2
+        assert all(shard.closed and shard.released for shard in opened)
+
 
 if __name__ == "__main__":
     unittest.main()
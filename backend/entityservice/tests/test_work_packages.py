@@ -0,0 +1,72 @@
+import pytest
+
+from entityservice.tasks import comparing
+from entityservice.tasks.comparing import _package_payload, _load_package, _split_into_fetch_units
+from entityservice.work_packages import encode_package, decode_package, pack_package, unpack_package, \
+    is_single_block_package
+
+
+def _chunk(dp_id, dataset_index, block_id, chunk_range, popcounts=None):
+    chunk = {'dataproviderId': dp_id, 'datasetIndex': dataset_index, 'block_id': block_id, 'range': chunk_range}
+    if popcounts is not None:
+        chunk['popcounts'] = popcounts
+    return chunk
+
+
+PACKAGE = [
+    (_chunk(33, 0, 1, (0, 100)), _chunk(34, 1, 7, (0, 50))),
+    (_chunk(33, 0, 2, (100, 200), (10, 20)), _chunk(35, 2, 8, (0, 2 ** 40), (15, 30))),
+]
+
+
+class TestCodec:
+
+    def test_round_trip(self):
+        assert unpack_package(decode_package(encode_package(PACKAGE))) == PACKAGE
+
+    def test_empty_package(self):
+        assert unpack_package(decode_package(encode_package([]))) == []
+
+    def test_unpacked_values_are_python_ints(self):
+        (left, right), _ = unpack_package(pack_package(PACKAGE))
+        assert all(type(value) is int for value in (left['dataproviderId'], left['block_id'], *right['range']))
+
+    def test_unpack_fetch_units(self, monkeypatch):
+        monkeypatch.setattr(comparing, 'FETCH_UNIT_NUM_BLOCK_PAIRS', 1)
+        units = _split_into_fetch_units(pack_package(PACKAGE), False)
+        assert [unpack_package(unit) for unit in units] == [PACKAGE[:1], PACKAGE[1:]]
+
+    def test_single_block_package(self):
+        assert not is_single_block_package(pack_package(PACKAGE))
+        single_block = [(_chunk(33, 0, 1, (0, 10)), _chunk(34, 1, 7, (0, 10))),
+                        (_chunk(33, 0, 1, (10, 20)), _chunk(34, 1, 7, (0, 10)))]
+        assert is_single_block_package(pack_package(single_block))
+
+    def test_compact(self):
+        import json
+        package = [(_chunk(33, 0, i, (0, 10)), _chunk(34, 1, i + 1000, (0, 10))) for i in range(10000)]
+        assert len(encode_package(package)) < len(json.dumps(package)) / 4
+
+
+class TestPayload:
+
+    def test_small_package_inline(self):
+        payload = _package_payload('run', 3, PACKAGE)
+        assert set(payload) == {'encoded'}
+        assert unpack_package(_load_package('run', payload)) == PACKAGE
+
+    def test_large_package_stored(self, monkeypatch):
+        stored = {}
+        monkeypatch.setattr(comparing, 'WORK_PACKAGE_INLINE_MAX_BYTES', 10)
+        monkeypatch.setattr(comparing, 'save_work_package',
+                            lambda run_id, package_id, encoded: stored.__setitem__((run_id, package_id), encoded))
+        monkeypatch.setattr(comparing, 'load_work_package', lambda run_id, package_id: stored.get((run_id, package_id)))
+        payload = _package_payload('run', 3, PACKAGE)
+        assert payload == {'stored': 3}
+        assert unpack_package(_load_package('run', payload)) == PACKAGE
+        stored.clear()
+        with pytest.raises(comparing.InactiveRun):
+            _load_package('run', payload)
+
+    def test_unencoded_package(self):
+        assert unpack_package(_load_package('run', [list(chunk_pair) for chunk_pair in PACKAGE])) == PACKAGE
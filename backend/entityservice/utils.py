@@ -87,6 +87,17 @@ def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
     return io.BufferedReader(IterRawStream(iterable), buffer_size=buffer_size)
 
 
+def unique_values_iter(iterable):
+    """ yields only the unique values of a **sorted** iterable """
+    it = iter(iterable)
+    previous = next(it)
+    yield previous
+    for item in it:
+        if item != previous:
+            previous = item
+            yield item
+
+
 def safe_fail_request(status_code, message, **kwargs):
     """
     generates an error message in the right format.
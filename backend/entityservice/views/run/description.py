@@ -5,10 +5,10 @@ from tenacity import retry, wait_random_exponential, retry_if_exception_type, st
 
 from entityservice import database as db
 from entityservice.cache.active_runs import set_run_state_deleted
-from entityservice.database import delete_run_data, get_similarity_file_for_run
+from entityservice.database import delete_run_data, get_similarity_files_for_run
 from entityservice.views.auth_checks import abort_if_run_doesnt_exist, abort_if_invalid_results_token
 from entityservice.views.serialization import RunDescription
-from entityservice.tasks import delete_minio_objects
+from entityservice.tasks import delete_minio_objects, revoke_run_tasks
 
 logger = get_logger()
 
@@ -35,9 +35,9 @@ def _delete_run(run_id, log):
     set_run_state_deleted(run_id)
     with db.DBConn() as conn:
         log.debug("Retrieving run details from database")
-        similarity_file = get_similarity_file_for_run(conn, run_id)
+        similarity_files = get_similarity_files_for_run(conn, run_id)
         delete_run_data(conn, run_id)
-    return similarity_file
+    return similarity_files
 
 
 def delete(project_id, run_id):
@@ -46,12 +46,13 @@ def delete(project_id, run_id):
     authorize_run_detail(project_id, run_id)
     log.debug("approved request to delete run")
 
-    similarity_file = _delete_run(run_id, log)
+    similarity_files = _delete_run(run_id, log)
     log.debug("Deleted run from database")
+    revoke_run_tasks(run_id)
 
-    if similarity_file:
-        log.debug("Queuing task to remove similarities file from object store")
-        delete_minio_objects.delay([similarity_file], project_id)
+    if similarity_files:
+        log.debug("Queuing task to remove similarities files from object store")
+        delete_minio_objects.delay(similarity_files, project_id)
     return '', 204
 
 
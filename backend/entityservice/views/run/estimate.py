@@ -0,0 +1,37 @@
+from flask import request
+from structlog import get_logger
+import opentracing
+
+from entityservice import database as db
+from entityservice.run_estimates import estimate_run
+from entityservice.settings import Config
+from entityservice.utils import safe_fail_request
+from entityservice.views import bind_log_and_span
+from entityservice.views.auth_checks import abort_if_project_doesnt_exist, abort_if_invalid_results_token, \
+    abort_if_project_in_error_state
+from entityservice.views.serialization import RunEstimate
+
+logger = get_logger()
+
+
+def get(project_id, threshold):
+    log, parent_span = bind_log_and_span(project_id)
+    log.debug("Processing request to estimate the cost of a run", threshold=threshold)
+    abort_if_project_doesnt_exist(project_id)
+
+    # Check the caller has a valid results token.
+    abort_if_invalid_results_token(project_id, request.headers.get('Authorization'))
+
+    abort_if_project_in_error_state(project_id)
+
+    with db.DBConn() as conn:
+        number_parties = db.get_project_column(conn, project_id, 'parties')
+        if db.get_number_parties_ready(conn, project_id) < number_parties:
+            safe_fail_request(400, message="The encodings of all the data providers must be uploaded first")
+
+        with opentracing.tracer.start_span('estimate-run', child_of=parent_span):
+            estimate = estimate_run(conn, project_id, threshold,
+                                    sample_comparisons=Config.RUN_ESTIMATE_HTTP_SAMPLE_COMPARISONS)
+
+    log.info("Estimated the cost of a run", **estimate)
+    return RunEstimate().dump(estimate)
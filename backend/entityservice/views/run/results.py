@@ -4,7 +4,7 @@ import opentracing
 
 from entityservice.settings import Config as config
 from entityservice import database as db
-from entityservice.serialization import get_similarity_scores
+from entityservice.serialization import get_similarity_scores, get_sharded_similarity_scores
 from entityservice.utils import safe_fail_request
 from entityservice.views import bind_log_and_span
 from entityservice.views.auth_checks import abort_if_run_doesnt_exist, get_authorization_token_type_or_abort
@@ -49,12 +49,20 @@ def get_result(dbinstance, project_id, run_id, token):
 
     elif result_type == 'similarity_scores':
         logger.debug(f"Looking at request headers to determine result format")
+        manifest = db.get_similarity_scores_manifest(dbinstance, run_id)
         if 'RETURN-OBJECT-STORE-ADDRESS' in request.headers:
             logger.info("Returning object store filename for similarity scores")
             bucket = config.MINIO_BUCKET
             object_store_path = get_similarity_score_result_filename(dbinstance, run_id)
             logger.info("Retrieving temporary object store credentials")
-            return prepare_restricted_download_response(bucket, object_store_path)
+            response, status = prepare_restricted_download_response(bucket, object_store_path)
+            if manifest is not None:
+                # The credentials give access to all the shards under the path
+                response['manifest'] = manifest
+            return response, status
+        elif manifest is not None:
+            logger.info("Sharded similarity result being returned")
+            return get_sharded_similarity_scores([shard['file'] for shard in manifest['shards']])
         else:
             logger.info("Similarity result being returned")
             return get_similarity_score_result(dbinstance, run_id)
@@ -51,7 +51,7 @@ def get(project_id, run_id):
         # Computing similarity
         abs_val = progress_cache.get_comparison_count_for_run(run_id)
         if abs_val is not None:
-            max_val = progress_cache.get_total_number_of_comparisons(project_id)
+            max_val = progress_cache.get_total_number_of_comparisons_for_run(project_id, run_id)
             logger.debug(f"total comparisons: {max_val}")
     else:
         # Solving for mapping (no progress)
@@ -69,7 +69,7 @@ def get(project_id, run_id):
     if state == 'completed':
         status["time_started"] = run_status['time_started']
         status["time_completed"] = run_status['time_completed']
-        status["total_number_comparisons"] = progress_cache.get_total_number_of_comparisons(project_id)
+        status["total_number_comparisons"] = progress_cache.get_total_number_of_comparisons_for_run(project_id, run_id)
         return completed().dump(status)
     elif state == 'running' or state == 'queued' or state == 'created':
         status["time_started"] = run_status['time_started']
@@ -43,6 +43,15 @@ class RunListItem(Schema):
     state = fields.String()
 
 
+class RunEstimate(Schema):
+    comparisons = fields.Integer()
+    sampled_comparisons = fields.Integer()
+    candidate_pairs = fields.Integer()
+    seconds = fields.Float(allow_none=True)
+    peak_memory_bytes = fields.Integer()
+    exceeded_limits = fields.List(fields.String)
+
+
 class RunProgress(Schema):
     absolute = fields.Integer(required=True)
     description = fields.String()
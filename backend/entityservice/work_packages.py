@@ -0,0 +1,73 @@
+"""
+Compact encoding of the work packages of the comparison tasks.
+
+A work package, as created by :func:`entityservice.tasks.comparing._create_work_packages`, is a list
+of pairs of chunks. Each chunk is a dict with the keys ``dataproviderId``, ``datasetIndex``, ``block_id``,
+``range`` and optionally ``popcounts``. Work packages are sent to the comparison tasks as numpy structured
+arrays with one row per pair of chunks, compressed and base64 encoded.
+"""
+import base64
+import zlib
+
+import numpy as np
+
+_CHUNK_DTYPE = np.dtype([
+    ('dataproviderId', '<i8'),
+    ('datasetIndex', '<i4'),
+    ('block_id', '<i8'),
+    ('range', '<i8', (2,)),
+    # (lowest, highest) popcount of the chunk's encodings, NO_POPCOUNTS if the chunk isn't a popcount band
+    ('popcounts', '<i4', (2,)),
+])
+PACKAGE_DTYPE = np.dtype([('left', _CHUNK_DTYPE), ('right', _CHUNK_DTYPE)])
+
+NO_POPCOUNTS = -1
+
+
+def pack_package(package):
+    """Return the pairs of chunks of a work package as a structured array of ``PACKAGE_DTYPE``."""
+    packed = np.zeros(len(package), dtype=PACKAGE_DTYPE)
+    for side, chunks in zip(('left', 'right'), zip(*package)):
+        packed_side = packed[side]
+        packed_side['dataproviderId'] = [chunk['dataproviderId'] for chunk in chunks]
+        packed_side['datasetIndex'] = [chunk['datasetIndex'] for chunk in chunks]
+        packed_side['block_id'] = [chunk['block_id'] for chunk in chunks]
+        packed_side['range'] = [chunk['range'] for chunk in chunks]
+        packed_side['popcounts'] = [chunk.get('popcounts', (NO_POPCOUNTS, NO_POPCOUNTS)) for chunk in chunks]
+    return packed
+
+
+def unpack_package(packed):
+    """
+    Return the pairs of chunks of a packed work package, or of a slice of it, as new dicts.
+    """
+    sides = []
+    for side in ('left', 'right'):
+        packed_side = packed[side]
+        chunks = []
+        for dp_id, dataset_index, block_id, chunk_range, popcounts in zip(
+                packed_side['dataproviderId'].tolist(), packed_side['datasetIndex'].tolist(),
+                packed_side['block_id'].tolist(), packed_side['range'].tolist(), packed_side['popcounts'].tolist()):
+            chunk = {'dataproviderId': dp_id, 'datasetIndex': dataset_index, 'block_id': block_id,
+                     'range': tuple(chunk_range)}
+            if popcounts[0] != NO_POPCOUNTS:
+                chunk['popcounts'] = tuple(popcounts)
+            chunks.append(chunk)
+        sides.append(chunks)
+    return list(zip(*sides))
+
+
+def is_single_block_package(packed):
+    """Whether all chunks of a packed work package are parts of the same block (possibly of several data providers)."""
+    chunks = np.concatenate((packed['left'], packed['right']))
+    return len(np.unique(chunks['block_id'])) == len(np.unique(chunks['dataproviderId']))
+
+
+def encode_package(package):
+    """Encode a work package as a string."""
+    return base64.b64encode(zlib.compress(pack_package(package).tobytes())).decode()
+
+
+def decode_package(encoded_package):
+    """Decode a work package encoded with :func:`encode_package` into a structured array of ``PACKAGE_DTYPE``."""
+    return np.frombuffer(zlib.decompress(base64.b64decode(encoded_package)), dtype=PACKAGE_DTYPE)